@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import gettext_lazy as _
+from .erasure import request_erasure
 from .models import (
-    User, Category, Quest, Challenge, 
-    UserQuestProgress, UserChallengeCompletion,
-    PartnerOrganization, Partnership
+    AccountErasure, User, Category, Quest, QuestStateChange, Challenge, 
+    UserQuestProgress, UserChallengeCompletion, ExperienceLedgerEntry,
+    ArchivedQuestProgress, ArchivedChallengeCompletion,
+    OutboxMessage, PartnerOrganization, Partnership, ProgressEvent
 )
 
 @admin.register(User)
@@ -29,6 +31,31 @@ class CustomUserAdmin(UserAdmin):
             'fields': ('username', 'email', 'password1', 'password2'),
         }),
     )
+    
+    def delete_model(self, request, obj):
+        """Deactivate the account and erase its data in the background"""
+        request_erasure(obj)
+    
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            request_erasure(user)
+
+@admin.register(AccountErasure)
+class AccountErasureAdmin(admin.ModelAdmin):
+    """Read-only progress and reports of account erasures"""
+    list_display = ('user_id', 'status', 'stage', 'requested_at', 'finished_at')
+    list_filter = ('status', 'stage')
+    search_fields = ('user_id',)
+    readonly_fields = (
+        'user_id', 'status', 'stage', 'cursor', 'report', 'error', 'requested_at', 'started_at',
+        'finished_at'
+    )
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
 
 class ChallengeInline(admin.TabularInline):
     """Inline admin for challenges in Quest admin"""
@@ -36,6 +63,16 @@ class ChallengeInline(admin.TabularInline):
     extra = 1
     ordering = ('order',)
 
+class QuestStateChangeInline(admin.TabularInline):
+    """Recent activation/deactivation jobs in Quest admin"""
+    model = QuestStateChange
+    extra = 0
+    max_num = 0
+    fields = ('is_active', 'status', 'processed_count', 'created_at', 'finished_at')
+    readonly_fields = fields
+    can_delete = False
+    verbose_name_plural = _('Activation jobs')
+
 @admin.register(Quest)
 class QuestAdmin(admin.ModelAdmin):
     """Admin for Quest model"""
@@ -43,9 +80,26 @@ class QuestAdmin(admin.ModelAdmin):
     list_filter = ('quest_type', 'difficulty', 'is_active')
     search_fields = ('title', 'description')
     filter_horizontal = ('categories',)
-    inlines = [ChallengeInline]
+    inlines = [ChallengeInline, QuestStateChangeInline]
     readonly_fields = ('created_at', 'updated_at')
 
+@admin.register(QuestStateChange)
+class QuestStateChangeAdmin(admin.ModelAdmin):
+    """Read-only status of quest activation/deactivation jobs"""
+    list_display = ('quest', 'is_active', 'status', 'processed_count', 'created_at', 'finished_at')
+    list_filter = ('status', 'is_active')
+    search_fields = ('quest__title',)
+    readonly_fields = (
+        'quest', 'is_active', 'status', 'shard', 'cursor', 'processed_count', 'error',
+        'created_at', 'started_at', 'finished_at'
+    )
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     """Admin for Category model"""
@@ -68,6 +122,87 @@ class UserQuestProgressAdmin(admin.ModelAdmin):
     inlines = [UserChallengeCompletionInline]
     readonly_fields = ('progress',)
 
+@admin.register(ArchivedQuestProgress)
+class ArchivedQuestProgressAdmin(admin.ModelAdmin):
+    """Read-only admin for finished progress moved to the archive"""
+    list_display = ('user', 'quest', 'status', 'progress', 'start_date', 'completion_date', 'archived_at')
+    list_filter = ('status',)
+    search_fields = ('user__username', 'quest__title')
+    raw_id_fields = ('user', 'quest')
+    readonly_fields = (
+        'id', 'user', 'quest', 'status', 'progress', 'start_date', 'completion_date', 'archived_at'
+    )
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(ArchivedChallengeCompletion)
+class ArchivedChallengeCompletionAdmin(admin.ModelAdmin):
+    """Read-only admin for archived challenge completions"""
+    list_display = ('user', 'challenge', 'completed_at', 'archived_at')
+    search_fields = ('user__username', 'challenge__title')
+    raw_id_fields = ('user', 'challenge')
+    readonly_fields = (
+        'id', 'user', 'challenge', 'completed_at', 'evidence', 'evidence_photo', 'archived_at'
+    )
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(ExperienceLedgerEntry)
+class ExperienceLedgerEntryAdmin(admin.ModelAdmin):
+    """Read-only admin for the append-only XP ledger"""
+    list_display = ('user', 'source_type', 'source_id', 'amount', 'created_at')
+    list_filter = ('source_type',)
+    search_fields = ('user__username',)
+    readonly_fields = ('user', 'source_type', 'source_id', 'amount', 'created_at')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(ProgressEvent)
+class ProgressEventAdmin(admin.ModelAdmin):
+    """Read-only view of the append-only progress event log"""
+    list_display = ('id', 'kind', 'user', 'quest', 'challenge_id', 'created_at', 'projected')
+    list_filter = ('kind', 'projected')
+    search_fields = ('user__username', 'quest__title')
+    raw_id_fields = ('user', 'quest')
+    readonly_fields = ('user', 'quest', 'challenge_id', 'kind', 'created_at', 'projected')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    """Admin for task messages waiting to be relayed to the broker"""
+    list_display = ('id', 'task_name', 'attempts', 'created_at')
+    list_filter = ('task_name',)
+    readonly_fields = ('task_name', 'args', 'kwargs', 'attempts', 'created_at')
+    actions = ['retry_messages']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    @admin.action(description=_('Retry relaying selected messages'))
+    def retry_messages(self, request, queryset):
+        updated = queryset.update(attempts=0)
+        self.message_user(request, _('%d messages will be relayed again.') % updated)
+
 @admin.register(PartnerOrganization)
 class PartnerOrganizationAdmin(admin.ModelAdmin):
     """Admin for PartnerOrganization model"""
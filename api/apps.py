@@ -8,3 +8,8 @@ class ApiConfig(AppConfig):
     def ready(self):
         # Import signals to register them
         import api.signals  # noqa
+
+        # Export the reference cache and stampede statistics
+        from api import refcache, stampede
+        refcache.register_metrics()
+        stampede.register_metrics()
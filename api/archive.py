@@ -0,0 +1,223 @@
+"""
+Archival of finished quest progress.
+
+``UserQuestProgress`` and ``UserChallengeCompletion`` only grow, and years of
+completed or abandoned quests slow down every per-user query on them. The
+``archive_finished_progress`` job moves progress that finished before the
+start of the month ``PROGRESS_ARCHIVE_AFTER_MONTHS`` months ago, together with
+its challenge completions, to ``ArchivedQuestProgress`` and
+``ArchivedChallengeCompletion``. Rows keep their ids, and the history
+endpoints read both tables.
+
+The progress events of an archived stream are deleted with it. The archived
+row and completions are its compacted history, and keeping the events would
+let a replay resurrect the hot row. A user who starts an archived quest again
+starts a new attempt.
+
+On PostgreSQL the completion archive is range partitioned by month of
+``completed_at``. The empty table created by Django is converted on the first
+run, and a partition is created for each month the job writes to, so old
+months can be detached, dumped or dropped without touching the rest. Other
+databases keep it as a plain table.
+
+Each shard archives its own rows; see ``api.sharding``.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import (
+    ArchivedChallengeCompletion, ArchivedQuestProgress, Challenge, ProgressEvent,
+    UserChallengeCompletion, UserQuestProgress
+)
+from .sharding import shard_aliases
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK_SIZE = 500
+COMPLETION_FIELDS = ('id', 'user_id', 'challenge_id', 'completed_at', 'evidence', 'evidence_photo')
+
+# (alias, partition) pairs known to exist, so each is only created once per process
+_partitions = set()
+
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def archive_cutoff(months=None):
+    """Return the moment before which finished progress is archived"""
+    if months is None:
+        months = settings.PROGRESS_ARCHIVE_AFTER_MONTHS
+    return _add_months(_month_start(timezone.now()), -months)
+
+
+def partitioned(using):
+    """Whether the completion archive of shard ``using`` is stored in monthly partitions"""
+    return connections[using].vendor == 'postgresql'
+
+
+def ensure_partitioned(using):
+    """
+    Convert the completion archive of shard ``using`` into a table partitioned by month.
+
+    Only an empty table is converted. Returns whether the table is partitioned.
+    """
+    if not partitioned(using):
+        return False
+    connection = connections[using]
+    table = ArchivedChallengeCompletion._meta.db_table
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [table])
+        if cursor.fetchone():
+            return True
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {qn(table)})")
+        if cursor.fetchone()[0]:
+            logger.warning(f"{table} already holds rows and is left unpartitioned.")
+            return False
+
+        cursor.execute(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", [table]
+        )
+        primary_key = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() "
+            "AND tablename = %s AND indexname <> %s", [table, primary_key]
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        # A partitioned table's primary key has to include the partition key
+        staging = f'{table}_partitioned'
+        cursor.execute(
+            f"CREATE TABLE {qn(staging)} (LIKE {qn(table)} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE (completed_at)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {qn(staging)} ADD CONSTRAINT {qn(primary_key + '_p')} "
+            f"PRIMARY KEY (id, completed_at)"
+        )
+        cursor.execute(f"DROP TABLE {qn(table)}")
+        cursor.execute(f"ALTER TABLE {qn(staging)} RENAME TO {qn(table)}")
+        cursor.execute(
+            f"ALTER TABLE {qn(table)} RENAME CONSTRAINT {qn(primary_key + '_p')} TO {qn(primary_key)}"
+        )
+        for index in indexes:
+            cursor.execute(index)
+    _partitions.difference_update({key for key in _partitions if key[0] == using})
+    logger.info(f"Partitioned {table} on {using} by month.")
+    return True
+
+
+def ensure_partition(month, using):
+    """Create the archive partition of shard ``using`` holding completions of ``month``"""
+    month = _month_start(month)
+    connection = connections[using]
+    table = ArchivedChallengeCompletion._meta.db_table
+    name = f'{table}_p{month:%Y%m}'
+    if (using, name) in _partitions:
+        return name
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {qn(name)} PARTITION OF {qn(table)} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            [month, _add_months(month, 1)]
+        )
+    _partitions.add((using, name))
+    return name
+
+
+def _finished_before(cutoff, using):
+    pending_events = ProgressEvent.objects.using(using).filter(
+        user_id=OuterRef('user_id'), quest_id=OuterRef('quest_id'), projected=False
+    )
+    return UserQuestProgress.objects.using(using).filter(
+        Q(status='completed', completion_date__lt=cutoff)
+        | Q(status='abandoned', start_date__lt=cutoff)
+    ).exclude(Exists(pending_events))
+
+
+def _archive_chunk(pks, cutoff, using):
+    """Move the still finished progress rows among ``pks`` and their history to the archive"""
+    # Rows may have been restarted since the chunk was read
+    rows = list(_finished_before(cutoff, using).select_for_update().filter(pk__in=pks))
+    if not rows:
+        return 0
+    streams = {(row.user_id, row.quest_id) for row in rows}
+    user_ids = {user_id for user_id, _ in streams}
+    quest_ids = {quest_id for _, quest_id in streams}
+
+    # Challenges live on the shared database, so they are matched here instead of joined
+    challenge_quests = dict(
+        Challenge.objects.filter(quest_id__in=quest_ids).values_list('id', 'quest_id')
+    )
+    completions = [
+        completion for completion in UserChallengeCompletion.objects.using(using).filter(
+            user_id__in=user_ids, challenge_id__in=challenge_quests
+        ).values(*COMPLETION_FIELDS)
+        if (completion['user_id'], challenge_quests[completion['challenge_id']]) in streams
+    ]
+    event_ids = [
+        event_id for event_id, user_id, quest_id in ProgressEvent.objects.using(using).filter(
+            user_id__in=user_ids, quest_id__in=quest_ids
+        ).values_list('id', 'user_id', 'quest_id')
+        if (user_id, quest_id) in streams
+    ]
+
+    if partitioned(using):
+        for month in {_month_start(completion['completed_at']) for completion in completions}:
+            ensure_partition(month, using)
+    ArchivedQuestProgress.objects.using(using).bulk_create([
+        ArchivedQuestProgress(
+            id=row.pk, user_id=row.user_id, quest_id=row.quest_id, status=row.status,
+            start_date=row.start_date, completion_date=row.completion_date, progress=row.progress,
+        )
+        for row in rows
+    ], ignore_conflicts=True)
+    ArchivedChallengeCompletion.objects.using(using).bulk_create([
+        ArchivedChallengeCompletion(**{field: completion[field] for field in COMPLETION_FIELDS})
+        for completion in completions
+    ], ignore_conflicts=True)
+
+    UserChallengeCompletion.objects.using(using).filter(
+        pk__in=[completion['id'] for completion in completions]
+    ).delete()
+    ProgressEvent.objects.using(using).filter(pk__in=event_ids).delete()
+    UserQuestProgress.objects.using(using).filter(pk__in=[row.pk for row in rows]).delete()
+    return len(rows)
+
+
+def archive_finished_progress(months=None, chunk_size=ARCHIVE_CHUNK_SIZE, using=None):
+    """
+    Move progress finished more than ``months`` months ago to the archive.
+
+    Works through shard ``using``, or every shard. Each chunk is moved in its
+    own transaction. Returns the number of progress rows archived.
+    """
+    cutoff = archive_cutoff(months)
+    archived = 0
+    for alias in [using] if using else shard_aliases():
+        if partitioned(alias):
+            ensure_partitioned(alias)
+        finished = _finished_before(cutoff, alias).order_by('pk').values_list('pk', flat=True)
+        cursor = 0
+        while True:
+            pks = list(finished.filter(pk__gt=cursor)[:chunk_size])
+            if not pks:
+                break
+            with transaction.atomic(using=alias):
+                archived += _archive_chunk(pks, cutoff, alias)
+            cursor = pks[-1]
+
+    logger.info(f"Archived {archived} progress rows finished before {cutoff:%Y-%m-%d}.")
+    return archived
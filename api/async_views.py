@@ -0,0 +1,318 @@
+"""
+Async read path for ASGI deployments.
+
+With ``ASYNC_READ_VIEWS`` enabled, GET requests to the hottest read endpoints
+are served by the async views below instead of their DRF viewsets:
+
+    quests/, quests/<id>/
+    challenges/, challenges/<id>/
+    quest-progress/
+    users/me/
+
+They authenticate, filter, page and serialize like the viewsets, but load
+users and rows through Django's async ORM, so under an ASGI server a single
+worker process serves many slow clients at once instead of holding a thread
+for each. The viewsets' filter backends and serializers are reused as they
+are; they run in a worker thread after the rows have been loaded, because
+some of them validate against the database or read cached counters.
+
+Other methods on these paths, the browsable API and format suffixes are
+still served by the viewsets.
+
+``live_stream`` is the server-sent event stream of ``api.live``. It is routed
+whatever ``ASYNC_READ_VIEWS`` says, but needs an ASGI server.
+"""
+import math
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from rest_framework import exceptions
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import authentication, live, replicas, views
+from .models import ArchivedQuestProgress, Challenge, Quest, UserQuestProgress
+from .renderers import MessagePackRenderer, ORJSONRenderer
+from .serializers import UserSerializer
+from .xp import level_for_xp, pending_xp
+
+jwt_authentication = authentication.CachedJWTAuthentication()
+# JSON first: it is also served to clients whose Accept matches neither
+renderers = [ORJSONRenderer(), MessagePackRenderer()]
+negotiation = DefaultContentNegotiation()
+
+
+async def authenticate(request):
+    """
+    Return ``(user, token)`` for ``request`` like the viewsets' authentication.
+
+    Bearer tokens are validated as ``CachedJWTAuthentication`` validates them,
+    with the user's state loaded through the async ORM; other requests use the
+    session.
+    """
+    header = jwt_authentication.get_header(request)
+    raw_token = jwt_authentication.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return await request.auser(), None
+
+    token = jwt_authentication.get_validated_token(raw_token)
+    user = await authentication.aget_user(token)
+    return user, token
+
+
+def select_renderer(request):
+    """Return the renderer ``request`` asks for in ``Accept`` or ``?format=``"""
+    if request is None:
+        return renderers[0]
+    if not isinstance(request, Request):
+        request = Request(request)
+    try:
+        return negotiation.select_renderer(request, renderers)[0]
+    except exceptions.NotAcceptable:
+        return renderers[0]
+
+
+def render(data, status=200, request=None):
+    renderer = select_renderer(request)
+    response = HttpResponse(renderer.render(data), status=status, content_type=renderer.media_type)
+    response['Vary'] = 'Accept'
+    return response
+
+
+def render_error(request, exc):
+    """Render an API error the way DRF's exception handler does"""
+    if isinstance(exc, Http404):
+        exc = exceptions.NotFound(*exc.args)
+    data = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+    response = render(data, exc.status_code, request)
+    if exc.status_code == 401:
+        response['WWW-Authenticate'] = jwt_authentication.authenticate_header(request)
+    return response
+
+
+def read_view(viewset, action):
+    """
+    Turn ``handler(view, **kwargs)`` into an async view for ``viewset``'s ``action``.
+
+    ``view`` is a viewset instance holding the authenticated request, so its
+    queryset, filter, pagination and serializer hooks can be reused. Reads go
+    to the replicas when the viewset would send them there.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, **kwargs):
+            view = viewset(args=(), kwargs=kwargs, format_kwarg=None, action=action, headers={})
+            replica_token = None
+            try:
+                user, token = await authenticate(request)
+                if not user.is_authenticated:
+                    raise exceptions.NotAuthenticated()
+                request.user = user
+                view.request = Request(request)
+                view.request.user, view.request.auth = user, token
+                if view.get_read_from_replica() and not await replicas.ais_pinned(user):
+                    replica_token = replicas.start_replica_reads()
+                return render(await handler(view, **kwargs), request=view.request)
+            except (exceptions.APIException, Http404) as exc:
+                return render_error(request, exc)
+            finally:
+                if replica_token is not None:
+                    replicas.end_replica_reads(replica_token)
+        return wrapper
+    return decorator
+
+
+async def filter_queryset(view, queryset):
+    # Filter backends may look up the objects they filter by
+    return await sync_to_async(view.filter_queryset)(queryset)
+
+
+async def paginate(view, queryset):
+    """Return the requested page of ``queryset`` and its links, like the viewset's paginator"""
+    paginator = view.paginator
+    page_size = paginator.get_page_size(view.request) if paginator is not None else None
+    if not page_size:
+        return [row async for row in queryset], None
+
+    count = await queryset.acount()
+    pages = max(math.ceil(count / page_size), 1)
+    page_number = view.request.query_params.get(paginator.page_query_param) or 1
+    if page_number in paginator.last_page_strings:
+        page_number = pages
+    try:
+        number = int(page_number)
+    except (TypeError, ValueError):
+        number = 0
+    if not 1 <= number <= pages:
+        raise exceptions.NotFound(paginator.invalid_page_message.format(
+            page_number=page_number, message='That page number is not valid'
+        ))
+
+    rows = [row async for row in queryset[(number - 1) * page_size:number * page_size]]
+    url = view.request.build_absolute_uri()
+    param = paginator.page_query_param
+    if number == 1:
+        previous_url = None
+    elif number == 2:
+        previous_url = remove_query_param(url, param)
+    else:
+        previous_url = replace_query_param(url, param, number - 1)
+    return rows, {
+        'count': count,
+        'next': replace_query_param(url, param, number + 1) if number < pages else None,
+        'previous': previous_url,
+    }
+
+
+async def serialize(view, instance, many=False):
+    # Counter fields read the cache
+    serializer = view.get_serializer(instance, many=many)
+    return await sync_to_async(lambda: serializer.data)()
+
+
+async def serialize_page(view, rows, page):
+    data = await serialize(view, rows, many=True)
+    if page is None:
+        return data
+    return {**page, 'results': data}
+
+
+async def quest_queryset(view):
+    user = view.request.user
+    queryset = view.queryset.all()
+    if 'user_status' in view.request.query_params:
+        progress = [pair async for pair in views.progress_statuses(UserQuestProgress, user)]
+        archived = [pair async for pair in views.progress_statuses(ArchivedQuestProgress, user)]
+        queryset = view.with_user_status(queryset, progress, archived)
+    queryset = await filter_queryset(view, queryset)
+    return queryset.prefetch_related('challenges', 'categories')
+
+
+@read_view(views.QuestViewSet, 'list')
+async def quest_list(view):
+    rows, page = await paginate(view, await quest_queryset(view))
+    return await serialize_page(view, rows, page)
+
+
+@read_view(views.QuestViewSet, 'retrieve')
+async def quest_detail(view, pk):
+    quest = await (await quest_queryset(view)).filter(pk=pk).afirst()
+    if quest is None:
+        raise Http404('No Quest matches the given query.')
+    return await serialize(view, quest)
+
+
+async def challenge_queryset(view):
+    return await filter_queryset(view, Challenge.objects.all())
+
+
+@read_view(views.ChallengeViewSet, 'list')
+async def challenge_list(view):
+    rows, page = await paginate(view, await challenge_queryset(view))
+    return await serialize_page(view, rows, page)
+
+
+@read_view(views.ChallengeViewSet, 'retrieve')
+async def challenge_detail(view, pk):
+    challenge = await (await challenge_queryset(view)).filter(pk=pk).afirst()
+    if challenge is None:
+        raise Http404('No Challenge matches the given query.')
+    return await serialize(view, challenge)
+
+
+@read_view(views.UserQuestProgressViewSet, 'list')
+async def progress_list(view):
+    hot = await filter_queryset(view, view.get_queryset())
+    archived = await filter_queryset(view, view.get_archive_queryset())
+    keys, page = await paginate(view, view.merge_querysets(hot, archived))
+    hot_rows = await hot.ain_bulk([key[1] for key in keys if not key[0]])
+    archived_rows = await archived.ain_bulk([key[1] for key in keys if key[0]])
+    rows = [
+        row for row in ((archived_rows if key[0] else hot_rows).get(key[1]) for key in keys)
+        if row is not None
+    ]
+
+    # Quest titles come from the catalog on the shared database
+    quests = await Quest.objects.ain_bulk({row.quest_id for row in rows})
+    for row in rows:
+        if row.quest_id in quests:
+            row.quest = quests[row.quest_id]
+    return await serialize_page(view, rows, page)
+
+
+@read_view(views.UserViewSet, 'me')
+async def me(view):
+    user = await authentication.afull_user(view.request.user)
+    data = UserSerializer(user).data
+
+    # Include XP awarded but not yet flushed to the user row
+    pending = await sync_to_async(pending_xp)(user.id)
+    if pending:
+        data['experience_points'] += pending
+        data['level'] = level_for_xp(data['experience_points'])
+    return data
+
+
+@require_GET
+async def live_stream(request):
+    """Stream the live updates of the authenticated user as server-sent events"""
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be held for as long as the client stays connected
+        return render({'detail': 'Live updates need an ASGI server.'}, status=501)
+    try:
+        user, _ = await authenticate(request)
+        if not user.is_authenticated:
+            raise exceptions.NotAuthenticated()
+    except exceptions.APIException as exc:
+        return render_error(request, exc)
+
+    response = StreamingHttpResponse(live.stream(user.pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def read_path(route, handler, viewset, actions, **initkwargs):
+    """``path()`` serving JSON GET requests with ``handler`` and the rest with the viewset"""
+    fallback = sync_to_async(viewset.as_view(actions, **initkwargs))
+
+    @csrf_exempt
+    async def view(request, *args, **kwargs):
+        if (
+            request.method == 'GET'
+            and 'format' not in request.GET
+            and 'text/html' not in request.headers.get('Accept', '')
+        ):
+            return await handler(request, **kwargs)
+        return await fallback(request, *args, **kwargs)
+    return path(route, view)
+
+
+LIST_ACTIONS = {'get': 'list', 'post': 'create'}
+DETAIL_ACTIONS = {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}
+
+urlpatterns = [
+    read_path('quests/', quest_list, views.QuestViewSet, LIST_ACTIONS, basename='quest', detail=False),
+    read_path(
+        'quests/<int:pk>/', quest_detail, views.QuestViewSet, DETAIL_ACTIONS, basename='quest', detail=True
+    ),
+    read_path(
+        'challenges/', challenge_list, views.ChallengeViewSet, LIST_ACTIONS, basename='challenge', detail=False
+    ),
+    read_path(
+        'challenges/<int:pk>/', challenge_detail, views.ChallengeViewSet, DETAIL_ACTIONS,
+        basename='challenge', detail=True
+    ),
+    read_path(
+        'quest-progress/', progress_list, views.UserQuestProgressViewSet, LIST_ACTIONS,
+        basename='questprogress', detail=False
+    ),
+    read_path('users/me/', me, views.UserViewSet, {'get': 'me'}, basename='user', detail=False),
+]
@@ -0,0 +1,174 @@
+"""
+JWT authentication without a user row per request.
+
+simplejwt's ``JWTAuthentication`` loads the whole ``User`` row, profile text
+and preferences included, to authenticate every request, although views
+mostly need the user's id and flags. ``CachedJWTAuthentication`` instead
+takes the user id from the token and the user's auth state (username and the
+active, staff and superuser flags) from a per-process cache. On a miss the
+state is loaded with a slim ``only()`` query and kept for
+``AUTH_USER_CACHE_SECONDS``.
+
+Requests get a ``User`` with just those fields loaded; the others are
+deferred and loaded on first access. Views that show the profile load it with
+``full_user``. Saving or deleting a user drops their cached state in the
+saving process once the change commits (see ``api.signals``). Other processes
+notice a password change or deactivation when their entry expires, so keep
+the timeout short.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .sharding import SHARED_DATABASE
+
+User = get_user_model()
+
+# Fields loaded on the users that authenticate requests
+SLIM_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+MAX_CACHED_USERS = 10000
+
+AuthState = namedtuple('AuthState', 'username is_active is_staff is_superuser password_hash')
+
+
+class AuthStateCache:
+    """Per-process ``{user_id: AuthState}`` whose entries expire"""
+
+    def __init__(self, max_size=MAX_CACHED_USERS):
+        self.max_size = max_size
+        # Bumped by every discard, so a state loaded before it is not stored
+        self.generation = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            expires_at, state = self._states.get(user_id, (0, None))
+        return state if expires_at > time.monotonic() else None
+
+    def set(self, user_id, state, timeout, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._states[user_id] = (time.monotonic() + timeout, state)
+            self._states.move_to_end(user_id)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self.generation += 1
+            self._states.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._states.clear()
+
+
+auth_states = AuthStateCache()
+
+
+def forget_user(user_id):
+    """Drop the cached auth state of ``user_id`` in this process"""
+    auth_states.discard(user_id)
+
+
+def _slim_queryset(user_id):
+    return User.objects.only(*SLIM_FIELDS, 'password').filter(**{jwt_settings.USER_ID_FIELD: user_id})
+
+
+def _remember(user_id, user, generation):
+    """Cache and return the auth state of ``user`` as loaded by ``_slim_queryset``"""
+    if user is None:
+        return None
+    state = AuthState(
+        user.username, user.is_active, user.is_staff, user.is_superuser,
+        get_md5_hash_password(user.password),
+    )
+    auth_states.set(user_id, state, settings.AUTH_USER_CACHE_SECONDS, generation)
+    return state
+
+
+def slim_user(user_id, state):
+    """Return a ``User`` with only the fields in ``state`` loaded"""
+    values = {
+        'id': user_id, 'username': state.username, 'is_active': state.is_active,
+        'is_staff': state.is_staff, 'is_superuser': state.is_superuser,
+    }
+    return User.from_db(
+        SHARED_DATABASE, list(values),
+        [values[field.attname] for field in User._meta.concrete_fields if field.attname in values]
+    )
+
+
+def check_state(validated_token, state):
+    """Raise if the user behind ``validated_token`` may not authenticate"""
+    if state is None:
+        raise exceptions.AuthenticationFailed(_('User not found'), code='user_not_found')
+    if not state.is_active:
+        raise exceptions.AuthenticationFailed(_('User is inactive'), code='user_inactive')
+    if jwt_settings.CHECK_REVOKE_TOKEN and (
+        validated_token.get(jwt_settings.REVOKE_TOKEN_CLAIM) != state.password_hash
+    ):
+        raise exceptions.AuthenticationFailed(
+            _("The user's password has been changed."), code='password_changed'
+        )
+
+
+def token_user_id(validated_token):
+    try:
+        return validated_token[jwt_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken(_('Token contained no recognizable user identification'))
+
+
+def get_user(validated_token):
+    """Return the slim user of ``validated_token``, as ``JWTAuthentication.get_user`` would"""
+    user_id = token_user_id(validated_token)
+    state = auth_states.get(user_id)
+    if state is None:
+        generation = auth_states.generation
+        state = _remember(user_id, _slim_queryset(user_id).first(), generation)
+    check_state(validated_token, state)
+    return slim_user(user_id, state)
+
+
+async def aget_user(validated_token):
+    """``get_user`` for async views"""
+    user_id = token_user_id(validated_token)
+    state = auth_states.get(user_id)
+    if state is None:
+        generation = auth_states.generation
+        state = _remember(user_id, await _slim_queryset(user_id).afirst(), generation)
+    check_state(validated_token, state)
+    return slim_user(user_id, state)
+
+
+def full_user(user):
+    """Return ``user`` with every field loaded"""
+    if not user.get_deferred_fields():
+        return user
+    return User.objects.get(pk=user.pk)
+
+
+async def afull_user(user):
+    if not user.get_deferred_fields():
+        return user
+    return await User.objects.aget(pk=user.pk)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` returning slim users from the auth state cache"""
+
+    def get_user(self, validated_token):
+        return get_user(validated_token)
@@ -0,0 +1,132 @@
+"""
+Response compression.
+
+``CompressionMiddleware`` compresses responses with brotli or gzip, whichever
+the client prefers in ``Accept-Encoding``. Bodies smaller than
+``COMPRESSION_MIN_SIZE`` bytes, streaming responses (live updates) and types
+that do not shrink, such as images, are sent as they are.
+
+Compressing a page anew for every request spends CPU on the same bytes over
+and over. Responses shared between users, such as the cached list pages (see
+``api.views``), are therefore marked with ``cache_variants``. Their compressed
+bodies are kept in the cache under a digest of the uncompressed body, and a
+later response with the same body reuses them. Such a body is compressed
+only once, so it is compressed harder.
+
+Brotli needs the ``Brotli`` package. Without it, only gzip is offered.
+"""
+import gzip
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+VARIANT_KEY = 'compressed:{encoding}:{digest}'
+VARIANT_TIMEOUT = 60 * 60
+COMPRESSIBLE_TYPES = (
+    'application/json', 'application/msgpack', 'application/javascript', 'application/xml',
+)
+
+
+def gzip_compress(content, cached):
+    return gzip.compress(content, compresslevel=9 if cached else 6, mtime=0)
+
+
+def brotli_compress(content, cached):
+    return brotli.compress(content, quality=9 if cached else 4)
+
+
+# Encoding -> compress(content, cached), in order of preference
+ENCODERS = {'gzip': gzip_compress}
+if brotli is not None:
+    ENCODERS = {'br': brotli_compress, **ENCODERS}
+
+
+def negotiate(accept_encoding):
+    """Return the encoding to use for ``Accept-Encoding``, or ``None`` for none"""
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in ENCODERS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return (
+        content_type.startswith('text/')
+        or content_type.endswith('+json')
+        or content_type in COMPRESSIBLE_TYPES
+    )
+
+
+def compress(content, encoding, cached=False):
+    """Return ``content`` compressed with ``encoding``, reusing the cached copy if ``cached``"""
+    if not cached:
+        return ENCODERS[encoding](content, False)
+    key = VARIANT_KEY.format(encoding=encoding, digest=hashlib.md5(content).hexdigest())
+    compressed = cache.get(key)
+    if compressed is None:
+        compressed = ENCODERS[encoding](content, True)
+        cache.set(key, compressed, VARIANT_TIMEOUT)
+    return compressed
+
+
+def cache_variants(response):
+    """Mark ``response`` as shared between users, so its compressed bodies are cached"""
+    response.cache_compressed_variants = True
+    return response
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Compress responses with the encoding the client prefers"""
+
+    def process_response(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if not is_compressible(response.get('Content-Type', '')):
+            return response
+        # Other requests for the URL may get another encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        compressed = compress(
+            response.content, encoding, getattr(response, 'cache_compressed_variants', False)
+        )
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The body is no longer byte-for-byte the one the ETag was computed for
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
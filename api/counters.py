@@ -0,0 +1,122 @@
+"""
+Sharded popularity counters.
+
+A counter such as ``quest:12:started`` is spread over ``COUNTER_SHARDS`` rows
+and every increment lands on a random shard, so a quest that everyone starts at
+once during a featured partnership launch does not serialize on a single hot
+row. Reads sum the shards and cache the totals briefly; ``compact_counters``
+periodically folds the shards of each counter back into one row.
+"""
+import logging
+import random
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import CounterShard
+
+logger = logging.getLogger(__name__)
+
+COUNTER_SHARDS = 16
+COUNTER_CACHE_KEY = 'counter:{name}'
+COUNTER_CACHE_TIMEOUT = 60
+
+
+def quest_counter_names(quest_id):
+    return {
+        'started': f'quest:{quest_id}:started',
+        'completed': f'quest:{quest_id}:completed',
+    }
+
+
+def partnership_counter_names(partnership_id):
+    return {
+        'redemptions': f'partnership:{partnership_id}:redemptions',
+    }
+
+
+def increment(name, amount=1):
+    """Add ``amount`` to a random shard of the counter"""
+    shard = random.randrange(COUNTER_SHARDS)
+    shards = CounterShard.objects.filter(name=name, shard=shard)
+    if shards.update(count=F('count') + amount):
+        return
+    try:
+        with transaction.atomic():
+            CounterShard.objects.create(name=name, shard=shard, count=amount)
+    except IntegrityError:
+        # Another request created the shard first
+        shards.update(count=F('count') + amount)
+
+
+def get_counts(names):
+    """Return ``{name: total}`` for the counters, summing shards on a cache miss"""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    keys = {COUNTER_CACHE_KEY.format(name=name): name for name in names}
+    cached = cache.get_many(keys)
+    counts = {keys[key]: value for key, value in cached.items()}
+
+    missing = [name for name in names if name not in counts]
+    if missing:
+        totals = dict.fromkeys(missing, 0)
+        totals.update(
+            CounterShard.objects.filter(name__in=missing)
+            .values('name').annotate(total=Sum('count'))
+            .values_list('name', 'total')
+        )
+        cache.set_many(
+            {COUNTER_CACHE_KEY.format(name=name): total for name, total in totals.items()},
+            COUNTER_CACHE_TIMEOUT,
+        )
+        counts.update(totals)
+    return counts
+
+
+def reset(totals):
+    """Replace counters with exact ``{name: total}`` values, e.g. after a rebuild"""
+    with transaction.atomic():
+        CounterShard.objects.filter(name__in=list(totals)).delete()
+        CounterShard.objects.bulk_create([
+            CounterShard(name=name, shard=0, count=total)
+            for name, total in totals.items() if total
+        ])
+    cache.delete_many([COUNTER_CACHE_KEY.format(name=name) for name in totals])
+
+
+def compact_counters(batch_size=500):
+    """
+    Merge the shards of every counter into a single row.
+
+    Counters are processed in batches, each in its own short transaction that
+    locks only the shards it folds. Returns the number of shard rows removed.
+    """
+    removed = 0
+    names = CounterShard.objects.values('name').annotate(
+        shards=Count('id')
+    ).filter(shards__gt=1).order_by('name').values_list('name', flat=True)
+
+    last_name = ''
+    while True:
+        batch = list(names.filter(name__gt=last_name)[:batch_size])
+        if not batch:
+            break
+        for name in batch:
+            with transaction.atomic():
+                rows = list(
+                    CounterShard.objects.select_for_update()
+                    .filter(name=name).order_by('shard')
+                )
+                if len(rows) < 2:
+                    continue
+                keep, *merged = rows
+                keep.count = sum(row.count for row in rows)
+                keep.save(update_fields=['count'])
+                CounterShard.objects.filter(pk__in=[row.pk for row in merged]).delete()
+                removed += len(merged)
+        last_name = batch[-1]
+
+    logger.info(f"Compacted counters, removed {removed} shard rows.")
+    return removed
@@ -0,0 +1,58 @@
+"""
+Transaction-scoped side effects.
+
+Signal handlers register work with ``defer(func, *args)`` instead of doing it
+inline. Work items are deduplicated by ``(func, args)`` and run once, in
+registration order, when the outermost transaction commits. Saving a quest
+with twenty inline challenges therefore replays that quest's progress once,
+and bumping a cache version happens once however many rows changed.
+
+Outside a transaction the work runs immediately. Items are dropped together
+with the transaction if it rolls back. An item registered inside a savepoint
+that is later rolled back still runs if the same item was registered before
+the savepoint, so deferred work must be idempotent (recomputations and cache
+invalidations are).
+"""
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredCall:
+    """One deduplicated work item, registered as an on_commit hook"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        try:
+            self.func(*self.args)
+        except Exception:
+            logger.exception(f"Deferred {self.func.__name__}{self.args} failed.")
+
+
+def defer(func, *args, using=DEFAULT_DB_ALIAS):
+    """Run ``func(*args)`` once after the current transaction commits"""
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        func(*args)
+        return
+
+    if not connection.run_on_commit:
+        # Nothing is pending, so calls remembered from earlier transactions are stale
+        connection._deferred_calls = {}
+    pending = connection.__dict__.setdefault('_deferred_calls', {})
+    key = (func, args)
+    call = pending.get(key)
+    # The hook is gone once it ran or its savepoint rolled back
+    if call is not None and not call.done and any(
+        hook is call for _, hook, _ in connection.run_on_commit
+    ):
+        return
+    pending[key] = call = DeferredCall(func, args)
+    transaction.on_commit(call, using=using)
@@ -0,0 +1,199 @@
+"""
+Account erasure pipeline.
+
+Deleting an account used to cascade synchronously to every progress row,
+challenge completion and evidence photo of the user in one transaction. Now
+``request_erasure`` only anonymizes and deactivates the account, which takes
+effect immediately, and records an ``AccountErasure``. The ``erase_account``
+task then works through the user's data stage by stage:
+
+    completions -> archived completions -> events -> progress
+    -> archived progress -> ledger -> account
+
+Each chunk is deleted in its own transaction and advances a primary key
+cursor stored on the erasure, so a failed or interrupted run resumes where it
+stopped. The data stages delete from the user's shard, which commits before
+the cursor that records it. Media files are removed after their rows are
+committed. The counts of everything removed are kept in
+``AccountErasure.report``.
+
+A run killed with its worker stays ``running``. Once it has been running for
+``ERASURE_STALL_TIMEOUT``, ``resume_stalled_erasures`` (run periodically) or
+a new request for the account queues it again.
+"""
+import logging
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from . import outbox
+from .models import (
+    AccountErasure, ArchivedChallengeCompletion, ArchivedQuestProgress, ExperienceLedgerEntry,
+    ProgressEvent, UserChallengeCompletion, UserQuestProgress
+)
+from .sharding import shard_for_user
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+ERASURE_CHUNK_SIZE = 500
+ERASURE_STALL_TIMEOUT = timedelta(hours=1)
+
+# Stage -> (model, media field, report key for its files)
+STAGE_MODELS = {
+    'completions': (UserChallengeCompletion, 'evidence_photo', 'evidence_photos'),
+    'archived_completions': (ArchivedChallengeCompletion, 'evidence_photo', 'evidence_photos'),
+    'events': (ProgressEvent, None, None),
+    'progress': (UserQuestProgress, None, None),
+    'archived_progress': (ArchivedQuestProgress, None, None),
+    'ledger': (ExperienceLedgerEntry, None, None),
+}
+
+
+def request_erasure(user):
+    """
+    Anonymize and deactivate ``user`` now and schedule erasure of their data.
+
+    Returns the ``AccountErasure``; a second request for the same account
+    returns the existing erasure, restarting it if it had failed or stalled.
+    """
+    # Imported here because api.tasks imports this module
+    from .tasks import erase_account
+
+    with transaction.atomic():
+        existing = AccountErasure.objects.filter(user_id=user.pk).first()
+        if existing is not None:
+            if existing.status == 'failed':
+                outbox.enqueue(erase_account, existing.pk)
+            elif existing.status == 'running' and (existing.started_at or existing.requested_at) < _stall_cutoff():
+                _restart([existing.pk])
+            return existing
+
+        user.email = f'deleted_{user.pk}@example.com'
+        user.username = f'deleted_{user.pk}'
+        user.first_name = ''
+        user.last_name = ''
+        user.bio = ''
+        user.notification_preferences = {}
+        user.is_subscribed = False
+        user.is_active = False
+        user.set_unusable_password()
+        user.save(update_fields=[
+            'email', 'username', 'first_name', 'last_name', 'bio',
+            'notification_preferences', 'is_subscribed', 'is_active', 'password'
+        ])
+
+        erasure = AccountErasure.objects.create(user_id=user.pk)
+        outbox.enqueue(erase_account, erasure.pk)
+    return erasure
+
+
+def _stall_cutoff():
+    return timezone.now() - ERASURE_STALL_TIMEOUT
+
+
+def _restart(erasure_ids):
+    """Queue stalled erasures again, restarting their clocks so they are queued once"""
+    from .tasks import erase_account
+
+    AccountErasure.objects.filter(pk__in=erasure_ids).update(started_at=timezone.now())
+    for erasure_id in erasure_ids:
+        outbox.enqueue(erase_account, erasure_id)
+
+
+def resume_stalled_erasures():
+    """Queue again the erasures whose run died without failing; returns how many"""
+    with transaction.atomic():
+        erasure_ids = list(
+            AccountErasure.objects.select_for_update(skip_locked=True)
+            .filter(status='running', started_at__lt=_stall_cutoff())
+            .values_list('pk', flat=True)
+        )
+        _restart(erasure_ids)
+    if erasure_ids:
+        logger.warning(f"Resumed {len(erasure_ids)} stalled account erasures.")
+    return len(erasure_ids)
+
+
+def _delete_files(files):
+    for file in files:
+        try:
+            file.storage.delete(file.name)
+        except Exception as e:
+            logger.warning(f"Could not delete {file.name}: {e}")
+
+
+def _erase_chunk(model, user_id, erasure, chunk_size, file_field=None):
+    """Delete the next chunk of ``model`` rows of the user and return (rows, files)"""
+    rows = model.objects.for_user(user_id).filter(pk__gt=erasure.cursor).order_by('pk')
+    if file_field:
+        chunk = list(rows.only('pk', file_field)[:chunk_size])
+        pks = [row.pk for row in chunk]
+        files = [getattr(row, file_field) for row in chunk if getattr(row, file_field)]
+    else:
+        pks = list(rows.values_list('pk', flat=True)[:chunk_size])
+        files = []
+    if pks:
+        model.objects.using(shard_for_user(user_id)).filter(pk__in=pks).delete()
+        erasure.cursor = pks[-1]
+    return len(pks), files
+
+
+def _count(erasure, key, amount):
+    erasure.report[key] = erasure.report.get(key, 0) + amount
+
+
+def erase(erasure_id, chunk_size=ERASURE_CHUNK_SIZE):
+    """
+    Run (or resume) an account erasure to completion.
+
+    Returns the erasure report.
+    """
+    erasure = AccountErasure.objects.get(pk=erasure_id)
+    if erasure.status == 'completed':
+        return erasure.report
+    erasure.status = 'running'
+    erasure.started_at = timezone.now()
+    erasure.error = ''
+    erasure.save(update_fields=['status', 'started_at', 'error'])
+
+    shard = shard_for_user(erasure.user_id)
+    while erasure.stage != 'account':
+        model, file_field, file_key = STAGE_MODELS[erasure.stage]
+        with transaction.atomic(), transaction.atomic(using=shard):
+            count, files = _erase_chunk(model, erasure.user_id, erasure, chunk_size, file_field)
+            if count:
+                _count(erasure, erasure.stage, count)
+            else:
+                erasure.stage = AccountErasure.STAGES[AccountErasure.STAGES.index(erasure.stage) + 1]
+                erasure.cursor = 0
+            erasure.save(update_fields=['stage', 'cursor', 'report'])
+        if files:
+            _delete_files(files)
+            _count(erasure, file_key, len(files))
+            erasure.save(update_fields=['report'])
+
+    with transaction.atomic():
+        user = User.objects.filter(pk=erasure.user_id).first()
+        files = []
+        if user is not None:
+            if user.profile_picture:
+                files.append(user.profile_picture)
+            user.delete()
+            _count(erasure, 'account', 1)
+        erasure.status = 'completed'
+        erasure.finished_at = timezone.now()
+        erasure.save(update_fields=['status', 'finished_at', 'report'])
+    if files:
+        _delete_files(files)
+        _count(erasure, 'profile_pictures', len(files))
+        erasure.save(update_fields=['report'])
+
+    logger.info(f"Erased user {erasure.user_id}: {erasure.report}")
+    return erasure.report
+
+
+def mark_failed(erasure_id, error):
+    AccountErasure.objects.filter(pk=erasure_id).update(status='failed', error=str(error))
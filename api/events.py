@@ -0,0 +1,382 @@
+"""
+Event-sourced quest progress.
+
+Everything that changes quest progress is appended to the ``ProgressEvent``
+log: quest starts, challenge completions, abandonments and challenges being
+added to or removed from a quest. ``UserQuestProgress`` is a projection of the
+log. Each user/quest stream of events is folded in order (``fold``) against the
+quest's current challenges, and the result is written to the progress row.
+When a fold first finds every challenge done, the projector appends a
+``QUEST_COMPLETED`` event and awards the quest's XP. XP, the popularity counters
+and the leaderboards are updated from there, so XP is awarded in exactly one
+place.
+
+Requests project at most the stream they touched: ``start_quest`` projects it
+inline so it can return the new progress, and challenge completions project it
+once the request commits (``project_stream``). Changes to a quest's challenges
+only append; ``project_pending`` replays the quest in a worker, and also
+catches up on anything else left unprojected. ``rebuild_projections`` replays
+the whole log in chunks to rebuild progress rows and the summaries derived
+from them.
+
+A user's events and progress rows live on the user's shard (``api.sharding``),
+so a stream is always projected within one database. Catch-up and replays go
+through the shards one at a time.
+"""
+import itertools
+import logging
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q
+from django.utils import timezone
+
+from . import counters, leaderboards, outbox, xp
+from .models import (
+    ArchivedQuestProgress, Challenge, ExperienceLedgerEntry, ProgressEvent, Quest,
+    UserChallengeCompletion, UserQuestProgress
+)
+from .progress import ensure_progress_rows
+from .sharding import shard_aliases, shard_for_user
+
+logger = logging.getLogger(__name__)
+
+PROJECT_BATCH_SIZE = 1000
+REPLAY_CHUNK_SIZE = 1000
+
+EVENT_FIELDS = ('id', 'user_id', 'quest_id', 'challenge_id', 'kind', 'created_at', 'projected')
+PROJECTED_FIELDS = ('status', 'start_date', 'completion_date', 'progress')
+
+Projection = namedtuple('Projection', PROJECTED_FIELDS + ('complete',))
+
+
+def append(kind, quest_id, user_id=None, challenge_id=None, projected=False):
+    """
+    Append an event to the log.
+
+    A user's events go to the user's shard. Quest structure events have no
+    user and are appended to every shard, so each shard's log is complete.
+    """
+    aliases = shard_aliases() if user_id is None else [shard_for_user(user_id)]
+    for alias in aliases:
+        event = ProgressEvent.objects.using(alias).create(
+            kind=kind, quest_id=quest_id, user_id=user_id,
+            challenge_id=challenge_id, projected=projected,
+        )
+    return event
+
+
+def fold(events, challenge_ids):
+    """
+    Fold one user's events for a quest, oldest first, into its progress.
+
+    ``complete`` is true when every current challenge of the quest has been
+    completed, whether or not the quest was marked completed yet.
+    """
+    status, start_date, completion_date = 'not_started', None, None
+    done = set()
+    for event in events:
+        if event.kind in (ProgressEvent.QUEST_STARTED, ProgressEvent.CHALLENGE_COMPLETED):
+            if status in ('not_started', 'abandoned'):
+                status = 'in_progress'
+                start_date = start_date or event.created_at
+        if event.kind == ProgressEvent.CHALLENGE_COMPLETED:
+            done.add(event.challenge_id)
+        elif event.kind == ProgressEvent.QUEST_ABANDONED and status == 'in_progress':
+            status = 'abandoned'
+        elif event.kind == ProgressEvent.QUEST_COMPLETED and status != 'completed':
+            status = 'completed'
+            completion_date = event.created_at
+
+    done &= challenge_ids
+    progress = int((len(done) / len(challenge_ids)) * 100) if challenge_ids else 0
+    complete = bool(challenge_ids) and len(done) == len(challenge_ids)
+    return Projection(status, start_date, completion_date, progress, complete)
+
+
+def _complete(user_id, quest, projection):
+    """Record a quest's completion, award its XP and notify the user"""
+    # Imported here because api.tasks imports this module
+    from .tasks import send_notification_email
+
+    event = append(ProgressEvent.QUEST_COMPLETED, quest.pk, user_id, projected=True)
+    xp.award_quest_xp(user_id, quest)
+    # Recorded on the shard, so the email is only sent if the completion commits
+    outbox.enqueue(
+        send_notification_email,
+        using=shard_for_user(user_id),
+        user_id=user_id,
+        subject_template='emails/quest_completed_subject.txt',
+        message_template='emails/quest_completed.txt',
+        context={
+            'quest_title': quest.title,
+            'experience_reward': quest.experience_reward,
+        }
+    )
+    return projection._replace(status='completed', completion_date=event.created_at)
+
+
+def _project(row, events, quest, challenge_ids):
+    """Write the projection of ``events`` to ``row`` and return the fields that changed"""
+    projection = fold(events, challenge_ids)
+    if projection.complete and projection.status != 'completed':
+        projection = _complete(row.user_id, quest, projection)
+
+    update_fields = [
+        field for field in PROJECTED_FIELDS
+        if getattr(row, field) != getattr(projection, field)
+    ]
+    if update_fields:
+        for field in update_fields:
+            setattr(row, field, getattr(projection, field))
+        # A regular save, so counters and caches see the status transition
+        row.save(update_fields=update_fields)
+    return update_fields
+
+
+def project_stream(user_id, quest_id):
+    """
+    Project one user's events for a quest into their progress row.
+
+    The row is locked before the events are read, so concurrent projections of
+    the same stream apply one after the other. Returns ``(row, changed_fields)``.
+    """
+    quest = Quest.objects.filter(pk=quest_id).first()
+    if quest is None:
+        return None, []
+    challenge_ids = set(Challenge.objects.filter(quest_id=quest_id).values_list('id', flat=True))
+
+    with transaction.atomic(using=shard_for_user(user_id)):
+        ensure_progress_rows([user_id], [quest_id])
+        row = UserQuestProgress.objects.for_user(user_id).select_for_update().get(quest_id=quest_id)
+        user_events = ProgressEvent.objects.for_user(user_id)
+        events = list(
+            user_events.filter(quest_id=quest_id)
+            .order_by('id').values_list(*EVENT_FIELDS, named=True)
+        )
+        changed = _project(row, events, quest, challenge_ids)
+        pending = [event.id for event in events if not event.projected]
+        if pending:
+            user_events.filter(pk__in=pending).update(projected=True)
+    return row, changed
+
+
+def _replay(events, chunk_size, using):
+    """
+    Project streams of ``events`` of shard ``using`` ordered by quest, user and id.
+
+    Streams are handled ``chunk_size`` at a time, with one query for the rows
+    of the chunk. Returns the number of progress rows changed.
+    """
+    streams = (
+        (key, list(group))
+        for key, group in itertools.groupby(events, key=lambda event: (event.quest_id, event.user_id))
+    )
+    quests = {}
+    challenge_sets = {}
+    changed = 0
+    while True:
+        chunk = list(itertools.islice(streams, chunk_size))
+        if not chunk:
+            break
+        new_quest_ids = {quest_id for (quest_id, _), _ in chunk} - set(quests)
+        quests.update(Quest.objects.in_bulk(new_quest_ids))
+        for quest_id, challenge_id in Challenge.objects.filter(
+            quest_id__in=new_quest_ids
+        ).values_list('quest_id', 'id'):
+            challenge_sets.setdefault(quest_id, set()).add(challenge_id)
+
+        progress = UserQuestProgress.objects.using(using)
+        with transaction.atomic(using=using):
+            progress.bulk_create([
+                UserQuestProgress(user_id=user_id, quest_id=quest_id, status='not_started')
+                for (quest_id, user_id), _ in chunk
+            ], ignore_conflicts=True)
+            rows = {
+                (row.quest_id, row.user_id): row
+                for row in progress.select_for_update().filter(
+                    quest_id__in={quest_id for (quest_id, _), _ in chunk},
+                    user_id__in={user_id for (_, user_id), _ in chunk},
+                )
+            }
+            for (quest_id, user_id), stream in chunk:
+                quest = quests.get(quest_id)
+                if quest is None:
+                    continue
+                row = rows[(quest_id, user_id)]
+                if _project(row, stream, quest, challenge_sets.get(quest_id, set())):
+                    changed += 1
+    return changed
+
+
+def _stream_events(events, chunk_size):
+    return events.filter(user__isnull=False).order_by(
+        'quest_id', 'user_id', 'id'
+    ).values_list(*EVENT_FIELDS, named=True).iterator(chunk_size=chunk_size)
+
+
+def replay_quest(quest_id, chunk_size=REPLAY_CHUNK_SIZE, using=None):
+    """
+    Re-project every user's progress on a quest, e.g. after its challenges changed.
+
+    Replays the shard ``using``, or every shard. Returns the number of progress
+    rows changed.
+    """
+    changed = 0
+    for alias in [using] if using else shard_aliases():
+        events = ProgressEvent.objects.using(alias).filter(quest_id=quest_id)
+        last_id = events.aggregate(last_id=Max('id'))['last_id']
+        if last_id is None:
+            continue
+        events = events.filter(id__lte=last_id)
+        changed += _replay(_stream_events(events, chunk_size), chunk_size, alias)
+        events.filter(projected=False).update(projected=True)
+    return changed
+
+
+def project_pending(batch_size=PROJECT_BATCH_SIZE, using=None):
+    """
+    Project events that have not been applied yet, oldest first.
+
+    Works through the shard ``using``, or every shard. Each affected stream is
+    folded once per batch however many of its events are pending. Returns the
+    number of events projected.
+    """
+    projected = 0
+    for alias in [using] if using else shard_aliases():
+        log = ProgressEvent.objects.using(alias)
+        while True:
+            batch = list(
+                log.filter(projected=False).order_by('id')
+                .values_list('id', 'user_id', 'quest_id', named=True)[:batch_size]
+            )
+            if not batch:
+                break
+            replayed = dict.fromkeys(event.quest_id for event in batch if event.user_id is None)
+            for quest_id in replayed:
+                replay_quest(quest_id, using=alias)
+            streams = dict.fromkeys(
+                (event.user_id, event.quest_id) for event in batch
+                if event.user_id is not None and event.quest_id not in replayed
+            )
+            for user_id, quest_id in streams:
+                project_stream(user_id, quest_id)
+            log.filter(pk__in=[event.id for event in batch]).update(projected=True)
+            projected += len(batch)
+            if len(batch) < batch_size:
+                break
+
+    if projected:
+        logger.info(f"Projected {projected} progress events.")
+    return projected
+
+
+def backfill_events():
+    """
+    Synthesize events for progress recorded before the log existed.
+
+    Only users and quests without any events are backfilled, so running it
+    again is harmless. Returns the number of events written.
+    """
+    has_events = ProgressEvent.objects.filter(
+        user_id=OuterRef('user_id'), quest_id=OuterRef('quest_id')
+    )
+    challenge_ids = {}
+    written = 0
+    for alias in shard_aliases():
+        rows = UserQuestProgress.objects.using(alias).filter(
+            ~Q(status='not_started') | Q(progress__gt=0)
+        ).exclude(Exists(has_events))
+        for row in rows.iterator():
+            if row.quest_id not in challenge_ids:
+                challenge_ids[row.quest_id] = list(
+                    Challenge.objects.filter(quest_id=row.quest_id).values_list('id', flat=True)
+                )
+            completions = list(
+                UserChallengeCompletion.objects.for_user(row.user_id).filter(
+                    challenge_id__in=challenge_ids[row.quest_id]
+                ).order_by('completed_at').values_list('challenge_id', 'completed_at')
+            )
+            started_at = row.start_date or (completions[0][1] if completions else timezone.now())
+            events = [ProgressEvent(
+                kind=ProgressEvent.QUEST_STARTED, user_id=row.user_id,
+                quest_id=row.quest_id, created_at=started_at,
+            )]
+            for challenge_id, completed_at in completions:
+                events.append(ProgressEvent(
+                    kind=ProgressEvent.CHALLENGE_COMPLETED, user_id=row.user_id,
+                    quest_id=row.quest_id, challenge_id=challenge_id, created_at=completed_at,
+                ))
+            if row.status == 'completed':
+                events.append(ProgressEvent(
+                    kind=ProgressEvent.QUEST_COMPLETED, user_id=row.user_id, quest_id=row.quest_id,
+                    created_at=row.completion_date or timezone.now(),
+                ))
+            elif row.status == 'abandoned':
+                events.append(ProgressEvent(
+                    kind=ProgressEvent.QUEST_ABANDONED, user_id=row.user_id, quest_id=row.quest_id,
+                ))
+            ProgressEvent.objects.using(alias).bulk_create(events)
+            written += len(events)
+    logger.info(f"Backfilled {written} progress events.")
+    return written
+
+
+def _award_missing_xp(using):
+    """Award XP for completed quests of shard ``using`` that have no ledger entry"""
+    awarded = ExperienceLedgerEntry.objects.filter(
+        user_id=OuterRef('user_id'), source_type='quest', source_id=OuterRef('quest_id')
+    )
+    missing = UserQuestProgress.objects.using(using).filter(status='completed').exclude(
+        Exists(awarded)
+    )
+    quests = {}
+    count = 0
+    for row in missing.iterator():
+        if row.quest_id not in quests:
+            quests[row.quest_id] = Quest.objects.get(pk=row.quest_id)
+        count += xp.award_quest_xp(row.user_id, quests[row.quest_id])
+    return count
+
+
+def _rebuild_quest_counters():
+    """Reset the started/completed counters of every quest to the projected totals"""
+    totals = {}
+    # Archived progress was started and finished, and still counts
+    for alias in shard_aliases():
+        for model in (UserQuestProgress, ArchivedQuestProgress):
+            for quest_id, started, completed in model.objects.using(alias).values('quest_id').annotate(
+                started=Count('id', filter=~Q(status='not_started')),
+                completed=Count('id', filter=Q(status='completed')),
+            ).values_list('quest_id', 'started', 'completed'):
+                names = counters.quest_counter_names(quest_id)
+                totals[names['started']] = totals.get(names['started'], 0) + started
+                totals[names['completed']] = totals.get(names['completed'], 0) + completed
+    counters.reset(totals)
+
+
+def rebuild_projections(chunk_size=REPLAY_CHUNK_SIZE):
+    """
+    Replay the whole log into progress rows and rebuild what derives from them.
+
+    Each shard's streams are folded in chunks straight from a server-side
+    cursor. Progress rows without events are left alone; run
+    ``backfill_events`` first on data that predates the log. Afterwards missing
+    quest XP is awarded, levels, quest counters and leaderboards are rebuilt.
+    Returns the number of progress rows changed.
+    """
+    changed = 0
+    awarded = 0
+    for alias in shard_aliases():
+        events = ProgressEvent.objects.using(alias)
+        last_id = events.aggregate(last_id=Max('id'))['last_id'] or 0
+        events = events.filter(id__lte=last_id)
+        changed += _replay(_stream_events(events, chunk_size), chunk_size, alias)
+        events.filter(projected=False).update(projected=True)
+        awarded += _award_missing_xp(alias)
+
+    xp.recompute_levels()
+    _rebuild_quest_counters()
+    leaderboards.rebuild_leaderboards()
+    logger.info(f"Rebuilt projections: {changed} progress rows changed, {awarded} XP awards added.")
+    return changed
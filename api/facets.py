@@ -0,0 +1,152 @@
+"""
+In-memory facet index over active quests.
+
+Every active quest gets a dense position in the index and every facet value
+(quest type, difficulty, category) is kept as a bitmap of positions stored in a
+plain Python ``int``. Filtering is a bitwise AND across facets and an OR within
+a facet, and counting is ``int.bit_count()``, so facet counts never touch the
+database once the index has been built.
+
+Each worker keeps its own copy of the index and rebuilds it lazily when the
+shared version key in the cache changes. ``api.signals`` bumps that key when
+quests or their category links change.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import Quest
+
+logger = logging.getLogger(__name__)
+
+FACET_VERSION_KEY = 'quest_facets:version'
+FACET_FIELDS = ('quest_type', 'difficulty', 'category')
+
+
+class QuestFacetIndex:
+    """Bitmap indexes over the active quest catalog"""
+
+    def __init__(self, quests, category_links, version=0):
+        self.version = version
+        self.quest_ids = []
+        self.bitmaps = {field: {} for field in FACET_FIELDS}
+
+        self.positions = positions = {}
+        for quest_id, quest_type, difficulty in quests:
+            bit = 1 << len(self.quest_ids)
+            positions[quest_id] = bit
+            self.quest_ids.append(quest_id)
+            self._add('quest_type', quest_type, bit)
+            self._add('difficulty', difficulty, bit)
+
+        for quest_id, category_id in category_links:
+            bit = positions.get(quest_id)
+            if bit is not None:
+                self._add('category', category_id, bit)
+
+        self.all_mask = (1 << len(self.quest_ids)) - 1
+
+    def _add(self, field, value, bit):
+        key = str(value)
+        self.bitmaps[field][key] = self.bitmaps[field].get(key, 0) | bit
+
+    def _facet_mask(self, field, values):
+        """Return the OR of the bitmaps for the selected values of one facet"""
+        if not values:
+            return self.all_mask
+        mask = 0
+        for value in values:
+            mask |= self.bitmaps[field].get(str(value), 0)
+        return mask
+
+    def _ids(self, mask):
+        """Translate a bitmap back into quest ids"""
+        ids = []
+        while mask:
+            low = mask & -mask
+            ids.append(self.quest_ids[low.bit_length() - 1])
+            mask ^= low
+        return ids
+
+    def _mask(self, quest_ids):
+        """Return the bitmap of the indexed quests among ``quest_ids``"""
+        mask = 0
+        for quest_id in quest_ids:
+            mask |= self.positions.get(quest_id, 0)
+        return mask
+
+    def query(self, selected, within=None):
+        """
+        Return the matching quest ids and the facet counts for a selection.
+
+        ``selected`` maps a facet field to a list of selected values. Counts
+        for a facet are computed with every other facet's selection applied
+        but not its own, so the client can show how many quests each
+        alternative value would match. ``within`` restricts both to those
+        quest ids, e.g. the quests left by other filters.
+        """
+        base = self.all_mask if within is None else self._mask(within)
+        masks = {
+            field: self._facet_mask(field, selected.get(field))
+            for field in FACET_FIELDS
+        }
+
+        matching = base
+        for mask in masks.values():
+            matching &= mask
+
+        counts = {}
+        for field in FACET_FIELDS:
+            others = base
+            for other, mask in masks.items():
+                if other != field:
+                    others &= mask
+            counts[field] = {
+                value: (bitmap & others).bit_count()
+                for value, bitmap in self.bitmaps[field].items()
+            }
+
+        return self._ids(matching), counts
+
+
+def build_facet_index(version=0):
+    """Load the active quest catalog and build a fresh index"""
+    quests = Quest.objects.filter(is_active=True).order_by('-created_at').values_list(
+        'id', 'quest_type', 'difficulty'
+    )
+    category_links = Quest.categories.through.objects.filter(
+        quest__is_active=True
+    ).values_list('quest_id', 'category_id')
+    index = QuestFacetIndex(list(quests), category_links.iterator(), version=version)
+    logger.debug(f"Built quest facet index with {len(index.quest_ids)} quests.")
+    return index
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_facet_index():
+    """Return this worker's facet index, rebuilding it if it is stale"""
+    global _index
+    version = cache.get(FACET_VERSION_KEY, 0)
+    index = _index
+    if index is None or index.version != version:
+        with _index_lock:
+            if _index is None or _index.version != version:
+                _index = build_facet_index(version)
+            index = _index
+    return index
+
+
+def invalidate_facet_index():
+    """Drop the local index and tell other workers to rebuild theirs"""
+    global _index
+    _index = None
+    try:
+        cache.incr(FACET_VERSION_KEY)
+    except ValueError:
+        # Evicted: a small seed could match the version some worker still holds
+        cache.set(FACET_VERSION_KEY, time.time_ns() // 1000, None)
@@ -0,0 +1,62 @@
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from .geo import filter_near
+from .models import Challenge
+
+DEFAULT_RADIUS_KM = 10
+MAX_RADIUS_KM = 500
+
+
+class NearFilter(filters.BaseFilterBackend):
+    """
+    Filter located objects by distance: ``?near=<lat>,<lng>&radius=<km>``.
+
+    Results are annotated with ``distance_km`` and, unless an explicit
+    ``ordering`` is requested, sorted nearest first. Views whose coordinates
+    live on a related model set ``near_field_prefix`` (e.g. ``'organization__'``).
+    """
+    def filter_queryset(self, request, queryset, view):
+        near = request.query_params.get('near')
+        if not near:
+            return queryset
+
+        try:
+            latitude, longitude = (float(value) for value in near.split(','))
+        except ValueError:
+            raise ValidationError({'near': ['Expected "<latitude>,<longitude>".']})
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValidationError({'near': ['Coordinates are out of range.']})
+
+        try:
+            radius = float(request.query_params.get('radius', DEFAULT_RADIUS_KM))
+        except ValueError:
+            raise ValidationError({'radius': ['A valid number is required.']})
+        if not 0 < radius <= MAX_RADIUS_KM:
+            raise ValidationError({'radius': [f'Must be between 0 and {MAX_RADIUS_KM} km.']})
+
+        prefix = getattr(view, 'near_field_prefix', '')
+        queryset = filter_near(queryset, latitude, longitude, radius, prefix=prefix)
+        if not request.query_params.get('ordering'):
+            queryset = queryset.order_by('distance_km')
+        return queryset
+
+
+class ChallengeQuestFilter(filters.BaseFilterBackend):
+    """
+    Filter challenge completions by quest: ``?challenge__quest=<id>``.
+
+    Completions live on the user's shard, so the quest's challenges are looked
+    up first instead of being joined.
+    """
+    def filter_queryset(self, request, queryset, view):
+        quest_id = request.query_params.get('challenge__quest')
+        if not quest_id:
+            return queryset
+
+        try:
+            quest_id = int(quest_id)
+        except ValueError:
+            raise ValidationError({'challenge__quest': ['A valid integer is required.']})
+        challenge_ids = Challenge.objects.filter(quest_id=quest_id).values_list('id', flat=True)
+        return queryset.filter(challenge_id__in=list(challenge_ids))
@@ -0,0 +1,152 @@
+"""
+Geohash grid index for "near me" queries without PostGIS.
+
+Located models store a geohash next to their coordinates. A proximity query
+first narrows candidates to the handful of geohash cells covering the search
+area's bounding box (an indexed prefix match), then to the bounding box itself,
+and finally refines with the exact haversine distance computed in the database.
+"""
+import math
+
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+GEOHASH_PRECISION = 9
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Upper bound on how many prefix lookups a single query may fan out to
+MAX_COVERING_CELLS = 12
+
+
+def normalize_longitude(longitude):
+    return ((longitude + 180) % 360) - 180
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode a coordinate as a base-32 geohash string"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    longitude = normalize_longitude(longitude)
+
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, bounds = (longitude, lng_range) if even else (latitude, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            bounds[0] = mid
+        else:
+            bounds[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Return the ``(height, width)`` of a geohash cell in degrees"""
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Return ``(south, north, west, east)`` in degrees around a point.
+
+    ``west``/``east`` may fall outside [-180, 180] when the box crosses the
+    antimeridian, and are ``None`` when it covers every longitude.
+    """
+    delta_lat = radius_km / KM_PER_DEGREE
+    south = max(latitude - delta_lat, -90.0)
+    north = min(latitude + delta_lat, 90.0)
+
+    cos_lat = math.cos(math.radians(latitude))
+    if south == -90.0 or north == 90.0 or cos_lat < 1e-6:
+        return south, north, None, None
+    delta_lng = radius_km / (KM_PER_DEGREE * cos_lat)
+    if delta_lng >= 180:
+        return south, north, None, None
+    return south, north, longitude - delta_lng, longitude + delta_lng
+
+
+def _steps(start, stop, step):
+    """Yield points from ``start`` to ``stop`` no further apart than ``step``"""
+    value = start
+    while value < stop:
+        yield value
+        value += step
+    yield stop
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """
+    Return the geohash prefixes of the cells covering the search area.
+
+    The precision is the finest one for which the bounding box spans at most
+    ``MAX_COVERING_CELLS`` cells, so the prefix filter stays a short ``OR`` of
+    index range scans.
+    """
+    south, north, west, east = bounding_box(latitude, longitude, radius_km)
+    if west is None:
+        west, east = -180.0, 180.0
+
+    precision = 1
+    for candidate in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(candidate)
+        rows = math.ceil((north - south) / height) + 1
+        columns = math.ceil((east - west) / width) + 1
+        if rows * columns <= MAX_COVERING_CELLS:
+            precision = candidate
+            break
+
+    height, width = cell_size(precision)
+    return sorted({
+        encode_geohash(lat, lng, precision)
+        for lat in _steps(south, north, height)
+        for lng in _steps(west, east, width)
+    })
+
+
+def haversine_expression(latitude, longitude, prefix=''):
+    """Database expression for the great-circle distance in km to a point"""
+    lat_field = F(f'{prefix}latitude')
+    lng_field = F(f'{prefix}longitude')
+    a = (
+        Power(Sin(Radians(lat_field - Value(latitude)) / 2), 2)
+        + Value(math.cos(math.radians(latitude)))
+        * Cos(Radians(lat_field))
+        * Power(Sin(Radians(lng_field - Value(longitude)) / 2), 2)
+    )
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(a, output_field=FloatField()))
+
+
+def filter_near(queryset, latitude, longitude, radius_km, prefix=''):
+    """
+    Restrict a queryset to rows within ``radius_km`` of a point.
+
+    ``prefix`` points at a related located model, e.g. ``'organization__'``.
+    The result is annotated with ``distance_km``.
+    """
+    cells = Q()
+    for cell in covering_cells(latitude, longitude, radius_km):
+        cells |= Q(**{f'{prefix}geohash__startswith': cell})
+
+    south, north, west, east = bounding_box(latitude, longitude, radius_km)
+    box = Q(**{f'{prefix}latitude__range': (south, north)})
+    if west is not None and west >= -180 and east <= 180:
+        box &= Q(**{f'{prefix}longitude__range': (west, east)})
+
+    return queryset.filter(cells, box).annotate(
+        distance_km=haversine_expression(latitude, longitude, prefix)
+    ).filter(distance_km__lte=radius_km)
@@ -0,0 +1,336 @@
+"""
+XP leaderboards served from sorted sets.
+
+Every board is a sorted set of ``user id -> XP`` so top pages, a user's rank
+and the users around them are O(log n) lookups instead of ``ORDER BY`` and
+``COUNT`` over the user table. Boards exist for all time, the current week and
+the current month, each overall and per category:
+
+    leaderboard:all
+    leaderboard:weekly:2026-W42
+    leaderboard:monthly:2026-10:category:3
+
+Boards are updated incrementally whenever XP is awarded and rebuilt from the
+database periodically so drift cannot accumulate.
+"""
+import bisect
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db.models import Case, IntegerField, Sum, Value, When
+from django.utils import timezone
+
+from . import stampede
+from .models import ArchivedQuestProgress, Category, Quest, User, UserQuestProgress
+from .sharding import shard_aliases
+from .stores import get_redis
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('all', 'weekly', 'monthly')
+PERIOD_TTLS = {
+    'all': None,
+    'weekly': 60 * 60 * 24 * 7 * 5,
+    'monthly': 60 * 60 * 24 * 100,
+}
+REBUILD_BATCH_SIZE = 1000  # Members per ZADD while rebuilding
+
+
+def period_key(period, when=None):
+    """Return the bucket name of ``period`` containing ``when``"""
+    if period == 'all':
+        return 'all'
+    when = timezone.localtime(when) if when else timezone.localtime()
+    if period == 'weekly':
+        year, week, _ = when.isocalendar()
+        return f'weekly:{year}-W{week:02d}'
+    if period == 'monthly':
+        return f'monthly:{when:%Y-%m}'
+    raise ValueError(f"Unknown leaderboard period: {period}")
+
+
+def period_start(period, when=None):
+    """Return the first moment of the bucket of ``period`` containing ``when``"""
+    when = timezone.localtime(when) if when else timezone.localtime()
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'weekly':
+        return midnight - timedelta(days=midnight.weekday())
+    if period == 'monthly':
+        return midnight.replace(day=1)
+    return None
+
+
+def board_key(period='all', category_id=None, when=None):
+    key = f'leaderboard:{period_key(period, when)}'
+    if category_id is not None:
+        key = f'{key}:category:{category_id}'
+    return key
+
+
+class LocalSortedSet:
+    """In-process sorted set ordered by descending score, then member"""
+
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def _entry(self, member):
+        return (-self.scores[member], member)
+
+    def set(self, member, score):
+        if member in self.scores:
+            del self.order[bisect.bisect_left(self.order, self._entry(member))]
+        self.scores[member] = score
+        bisect.insort(self.order, self._entry(member))
+
+    def rank(self, member):
+        if member not in self.scores:
+            return None
+        return bisect.bisect_left(self.order, self._entry(member))
+
+
+class LocalSortedSets:
+    """Fallback store used when Redis is not configured (single process only)"""
+
+    def __init__(self):
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def increment(self, increments):
+        with self._lock:
+            for key, member, amount, _ttl in increments:
+                board = self._sets.setdefault(key, LocalSortedSet())
+                board.set(member, board.scores.get(member, 0) + amount)
+
+    def replace(self, key, scores, ttl=None):
+        board = LocalSortedSet()
+        board.scores = dict(scores)
+        board.order = sorted((-score, member) for member, score in board.scores.items())
+        with self._lock:
+            if board.scores:
+                self._sets[key] = board
+            else:
+                self._sets.pop(key, None)
+
+    def rank(self, key, member):
+        board = self._sets.get(key)
+        if board is None:
+            return None, None
+        with self._lock:
+            rank = board.rank(member)
+            return rank, board.scores.get(member)
+
+    def range(self, key, start, stop):
+        board = self._sets.get(key)
+        if board is None:
+            return []
+        with self._lock:
+            # Like ZREVRANGE, a negative stop counts from the end
+            end = stop + 1 if stop >= 0 else len(board.order) + stop + 1
+            return [(member, -score) for score, member in board.order[start:end]]
+
+    def size(self, key):
+        board = self._sets.get(key)
+        return len(board.scores) if board else 0
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+
+
+class RedisSortedSets:
+    """Sorted sets stored in Redis"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def increment(self, increments):
+        pipe = self.client.pipeline(transaction=False)
+        for key, member, amount, ttl in increments:
+            pipe.zincrby(key, amount, member)
+            if ttl:
+                pipe.expire(key, ttl)
+        pipe.execute()
+
+    def replace(self, key, scores, ttl=None):
+        # Build the new board under a temporary key and swap it in atomically
+        temp_key = f'{key}:rebuild:{uuid.uuid4().hex}'
+        pipe = self.client.pipeline(transaction=False)
+        batch = {}
+        for member, score in scores.items():
+            batch[member] = score
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                pipe.zadd(temp_key, batch)
+                batch = {}
+        if batch:
+            pipe.zadd(temp_key, batch)
+        pipe.execute()
+
+        if scores:
+            pipe = self.client.pipeline()
+            pipe.rename(temp_key, key)
+            if ttl:
+                pipe.expire(key, ttl)
+            pipe.execute()
+        else:
+            self.client.delete(key)
+
+    def rank(self, key, member):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrevrank(key, member)
+        pipe.zscore(key, member)
+        rank, score = pipe.execute()
+        return rank, score
+
+    def range(self, key, start, stop):
+        return self.client.zrevrange(key, start, stop, withscores=True)
+
+    def size(self, key):
+        return self.client.zcard(key)
+
+
+_local_store = LocalSortedSets()
+
+
+def get_store():
+    client = get_redis()
+    if client is None:
+        return _local_store
+    return RedisSortedSets(client)
+
+
+def record_xp(user_id, amount, category_ids=(), when=None):
+    """Add an XP award to every board it counts towards"""
+    if not amount:
+        return
+    member = str(user_id)
+    increments = []
+    for period in PERIODS:
+        for category_id in (None, *category_ids):
+            key = board_key(period, category_id, when)
+            increments.append((key, member, amount, PERIOD_TTLS[period]))
+    get_store().increment(increments)
+
+
+def _entry(rank, member, score):
+    return {'rank': rank + 1, 'user_id': int(member), 'score': int(score)}
+
+
+def get_top(period='all', category_id=None, offset=0, limit=10):
+    """Return a page of the board, best first, and the board size"""
+    store = get_store()
+    key = board_key(period, category_id)
+    members = store.range(key, offset, offset + limit - 1)
+    entries = [
+        _entry(offset + position, member, score)
+        for position, (member, score) in enumerate(members)
+    ]
+    return entries, store.size(key)
+
+
+def get_rank(user_id, period='all', category_id=None):
+    """Return the user's entry on the board, or ``None`` if they are not on it"""
+    rank, score = get_store().rank(board_key(period, category_id), str(user_id))
+    if rank is None:
+        return None
+    return _entry(rank, user_id, score)
+
+
+def get_around(user_id, period='all', category_id=None, size=5):
+    """Return the user's entry together with ``size`` neighbours on each side"""
+    store = get_store()
+    key = board_key(period, category_id)
+    rank, _ = store.rank(key, str(user_id))
+    if rank is None:
+        return []
+    start = max(rank - size, 0)
+    members = store.range(key, start, rank + size)
+    return [
+        _entry(start + position, member, score)
+        for position, (member, score) in enumerate(members)
+    ]
+
+
+def _xp_sum(quest_xp):
+    """Sum the XP of completed quests in SQL, with rewards inlined by quest id"""
+    quests_by_reward = {}
+    for quest_id, reward in quest_xp.items():
+        quests_by_reward.setdefault(reward, []).append(quest_id)
+    return Sum(Case(
+        *(When(quest_id__in=quest_ids, then=Value(reward)) for reward, quest_ids in quests_by_reward.items()),
+        default=Value(0),
+        output_field=IntegerField(),
+    ))
+
+
+def _sum_per_user(quest_xp, since, totals, key=()):
+    """Add each user's XP from ``quest_xp`` to ``totals[(user_id, *key)]``"""
+    if not quest_xp:
+        return
+    for alias in shard_aliases():
+        # Quests completed long ago have been moved to the archive
+        for model in (UserQuestProgress, ArchivedQuestProgress):
+            completed = model.objects.using(alias).filter(status='completed', quest_id__in=quest_xp)
+            if since is not None:
+                completed = completed.filter(completion_date__gte=since)
+            for user_id, xp in completed.order_by().values('user_id').annotate(
+                xp=_xp_sum(quest_xp)
+            ).values_list('user_id', 'xp').iterator():
+                totals[(user_id, *key)] = totals.get((user_id, *key), 0) + xp
+
+
+def _completed_xp(since=None, by_category=False):
+    """Sum quest XP per user, or per (user, category), over completed quests"""
+    # Progress lives on the shards, so quest XP is inlined into the per-user
+    # sums instead of joined; the catalog is small next to the progress tables
+    quest_xp = dict(Quest.objects.values_list('id', 'experience_reward'))
+    totals = {}
+    if by_category:
+        category_quests = {}
+        for quest_id, category_id in Quest.categories.through.objects.values_list(
+            'quest_id', 'category_id'
+        ).iterator():
+            if quest_id in quest_xp:
+                category_quests.setdefault(category_id, {})[quest_id] = quest_xp[quest_id]
+        for category_id, category_xp in category_quests.items():
+            _sum_per_user(category_xp, since, totals, (category_id,))
+    else:
+        _sum_per_user(quest_xp, since, totals)
+    return [(*key, xp) for key, xp in totals.items()]
+
+
+def rebuild_leaderboards():
+    """Recompute every current board from the database"""
+    store = get_store()
+    category_ids = list(Category.objects.values_list('id', flat=True))
+
+    global_scores = {
+        str(user_id): xp
+        for user_id, xp in User.objects.filter(
+            is_active=True, experience_points__gt=0
+        ).values_list('id', 'experience_points').iterator()
+    }
+    store.replace(board_key('all'), global_scores, PERIOD_TTLS['all'])
+
+    for period in PERIODS:
+        since = period_start(period)
+        if period != 'all':
+            overall = {
+                str(user_id): xp
+                for user_id, xp in _completed_xp(since)
+            }
+            store.replace(board_key(period), overall, PERIOD_TTLS[period])
+
+        per_category = {category_id: {} for category_id in category_ids}
+        for user_id, category_id, xp in _completed_xp(since, by_category=True):
+            if category_id is not None:
+                per_category.setdefault(category_id, {})[str(user_id)] = xp
+        for category_id, scores in per_category.items():
+            store.replace(board_key(period, category_id), scores, PERIOD_TTLS[period])
+
+    # Cached leaderboard pages (see ``api.views``) would show the old boards
+    stampede.bump_version('leaderboard')
+    logger.info(f"Rebuilt leaderboards for {len(global_scores)} users.")
+    return len(global_scores)
@@ -0,0 +1,164 @@
+"""
+Live per-user updates.
+
+Progress and XP changes are published to the user's channel once they are
+committed, and every open live stream of that user (``users/me/live/``)
+pushes them to its client as server-sent events, so clients need not poll.
+
+With ``REDIS_URL`` configured the channels are Redis pub/sub channels and each
+server process holds a single subscriber connection for all of its streams.
+Without it messages are delivered within the process, which is enough for
+development and the test suite. Delivery is best effort: a client that
+reconnects should reload its state from the REST endpoints.
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .stores import get_redis
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'live:user:{user_id}'
+# Messages a slow stream may fall behind by before the oldest are dropped
+STREAM_BUFFER = 100
+# Comment sent on idle streams so proxies keep them open and dead ones are noticed
+KEEPALIVE_SECONDS = 20
+RECONNECT_MILLISECONDS = 5000
+
+
+def message(event, data):
+    """Return the server-sent event frame of ``event`` carrying ``data``"""
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+def publish(user_id, frame):
+    """Push ``frame`` to the open streams of ``user_id``"""
+    try:
+        client = get_redis()
+        if client is None:
+            hub.dispatch(user_id, frame)
+        else:
+            client.publish(CHANNEL.format(user_id=user_id), frame)
+    except Exception:
+        # Live updates must never fail the write that caused them
+        logger.warning(f"Could not publish a live update to user {user_id}.", exc_info=True)
+
+
+def _offer(queue, frame):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(frame)
+
+
+class Hub:
+    """The open streams of this process, by user"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, queue, loop):
+        with self._lock:
+            self._streams.setdefault(user_id, {})[queue] = loop
+
+    def remove(self, user_id, queue):
+        with self._lock:
+            streams = self._streams.get(user_id, {})
+            streams.pop(queue, None)
+            if not streams:
+                self._streams.pop(user_id, None)
+
+    def has_streams(self, user_id):
+        with self._lock:
+            return user_id in self._streams
+
+    def dispatch(self, user_id, frame):
+        """Queue ``frame`` on every stream of ``user_id``; safe to call from any thread"""
+        with self._lock:
+            streams = list(self._streams.get(user_id, {}).items())
+        for queue, loop in streams:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, frame)
+            except RuntimeError:
+                # The stream's event loop has been closed
+                self.remove(user_id, queue)
+
+
+hub = Hub()
+
+
+class RedisSubscriber:
+    """One pub/sub connection per process for the channels of its open streams"""
+
+    def __init__(self, url):
+        import redis.asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.pubsub = redis.asyncio.Redis.from_url(url, decode_responses=True).pubsub()
+        self.channels = set()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    async def update(self, user_id):
+        """Subscribe to or unsubscribe from the channel of ``user_id`` to match the hub"""
+        channel = CHANNEL.format(user_id=user_id)
+        async with self.lock:
+            if hub.has_streams(user_id) and channel not in self.channels:
+                await self.pubsub.subscribe(**{channel: self.on_message})
+                self.channels.add(channel)
+                if self.task is None or self.task.done():
+                    self.task = asyncio.create_task(self.pubsub.run(exception_handler=self.on_error))
+            elif not hub.has_streams(user_id) and channel in self.channels:
+                self.channels.discard(channel)
+                await self.pubsub.unsubscribe(channel)
+
+    async def on_message(self, message):
+        user_id = int(message['channel'].rsplit(':', 1)[1])
+        hub.dispatch(user_id, message['data'])
+
+    async def on_error(self, exc, pubsub):
+        # The connection is re-established, and the channels re-subscribed, on the next read
+        logger.warning(f"Live update subscriber failed: {exc}")
+        await asyncio.sleep(1)
+
+
+_subscriber = None
+
+
+def get_subscriber():
+    """Return this process's subscriber, or ``None`` when Redis is not configured"""
+    global _subscriber
+    from django.conf import settings
+
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url:
+        return None
+    # A subscriber belongs to the event loop it was created on
+    if _subscriber is None or _subscriber.loop is not asyncio.get_running_loop():
+        _subscriber = RedisSubscriber(url)
+    return _subscriber
+
+
+async def stream(user_id):
+    """Yield the server-sent events of ``user_id`` until the client goes away"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(STREAM_BUFFER)
+    subscriber = get_subscriber()
+    hub.add(user_id, queue, loop)
+    try:
+        if subscriber is not None:
+            await subscriber.update(user_id)
+        yield f'retry: {RECONNECT_MILLISECONDS}\n\n'
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+    finally:
+        hub.remove(user_id, queue)
+        if subscriber is not None:
+            await subscriber.update(user_id)
@@ -0,0 +1,82 @@
+"""
+Django command to compare the API renderers and parsers on quest pages.
+"""
+import io
+import math
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Quest
+from api.parsers import MessagePackParser, ORJSONParser
+from api.renderers import MessagePackRenderer, ORJSONRenderer
+from api.serializers import QuestSerializer
+
+# Name -> (renderer, parser of its output); the first is the baseline
+CODECS = {
+    'json (stdlib)': (JSONRenderer(), JSONParser()),
+    'json (orjson)': (ORJSONRenderer(), ORJSONParser()),
+    'msgpack': (MessagePackRenderer(), MessagePackParser()),
+}
+
+
+class Command(BaseCommand):
+    """
+    Serialize pages of quests, with their challenges and categories, as the
+    catalog does, then time rendering each page with every renderer and parsing
+    the result back. Pages larger than the quest table repeat its quests.
+    Serializing is done once up front, so only the renderers are compared.
+    """
+    help = 'Benchmarks the JSON and MessagePack renderers and parsers on quest pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[10, 100],
+            help='Number of quests per page'
+        )
+        parser.add_argument('--number', type=int, default=100, help='Calls per timing')
+        parser.add_argument('--repeat', type=int, default=5, help='Timings per measurement; the best is kept')
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        quests = list(
+            Quest.objects.prefetch_related('challenges', 'categories').order_by('id')[:max(options['sizes'])]
+        )
+        if not quests:
+            raise CommandError('There are no quests to render; run seed_data first')
+
+        self.stdout.write(
+            f"{'quests':>6}  {'codec':<14}{'render us':>11}{'speedup':>9}{'parse us':>10}{'speedup':>9}{'bytes':>9}"
+        )
+        for size in options['sizes']:
+            page = (quests * math.ceil(size / len(quests)))[:size]
+            data = {
+                'count': size, 'next': None, 'previous': None,
+                'results': QuestSerializer(page, many=True).data,
+            }
+            self.check_output(data)
+
+            baseline = None
+            for name, (renderer, parser) in CODECS.items():
+                body = renderer.render(data, renderer.media_type, {})
+                render_us = self.time(lambda: renderer.render(data, renderer.media_type, {}), options)
+                parse_us = self.time(lambda: parser.parse(io.BytesIO(body), parser.media_type, {}), options)
+                if baseline is None:
+                    baseline = (render_us, parse_us)
+                self.stdout.write(
+                    f"{size:>6}  {name:<14}{render_us:>11.1f}{baseline[0] / render_us:>8.1f}x"
+                    f"{parse_us:>10.1f}{baseline[1] / parse_us:>8.1f}x{len(body):>9}"
+                )
+
+    def time(self, func, options):
+        """Return the best time of ``func`` in microseconds"""
+        timings = timeit.repeat(func, number=options['number'], repeat=options['repeat'])
+        return min(timings) / options['number'] * 1e6
+
+    def check_output(self, data):
+        """Fail if the orjson renderer and the stdlib renderer disagree on ``data``"""
+        expected = JSONRenderer().render(data, 'application/json', {})
+        if ORJSONRenderer().render(data, 'application/json', {}) != expected:
+            raise CommandError('ORJSONRenderer output differs from JSONRenderer')
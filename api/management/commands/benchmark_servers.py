@@ -0,0 +1,152 @@
+"""
+Django command to compare the sync and async read paths under slow clients.
+"""
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+User = get_user_model()
+
+# Server -> (gunicorn arguments, ASYNC_READ_VIEWS)
+SERVERS = {
+    'wsgi': (['config.wsgi:application', '--worker-class', 'sync'], 'False'),
+    'asgi': (['config.asgi:application', '--worker-class', 'uvicorn_worker.UvicornWorker'], 'True'),
+}
+STARTUP_TIMEOUT = 30
+
+
+class Command(BaseCommand):
+    """
+    Run a read endpoint under gunicorn sync workers and under ASGI workers,
+    each with the same number of processes, and hit it with clients on a slow
+    network. Every client sends its request in two halves, as a phone on a
+    poor connection does, then reads the whole response and starts over. The
+    pause between the halves is random with a mean of ``--client-delay``
+    seconds and a long tail, so a sync worker reading one slow request keeps
+    the requests queued behind it waiting.
+    """
+    help = 'Benchmarks a read endpoint under gunicorn sync workers and ASGI workers with slow clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/quests/', help='Endpoint to request')
+        parser.add_argument(
+            '--username', default='testuser',
+            help='User the requests authenticate as (see seed_data)'
+        )
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes per server')
+        parser.add_argument('--clients', type=int, default=100, help='Concurrent clients')
+        parser.add_argument('--duration', type=float, default=20, help='Seconds to load each server')
+        parser.add_argument(
+            '--client-delay', type=float, default=0.5,
+            help='Mean seconds a client takes to send its request'
+        )
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f"User {options['username']} does not exist")
+        token = str(AccessToken.for_user(user))
+
+        results = {}
+        for name in options['servers']:
+            self.stdout.write(
+                f"Loading {name} with {options['clients']} clients for {options['duration']:.0f}s..."
+            )
+            with self.server(name, options['port'], options['workers']):
+                results[name] = asyncio.run(self.load(token, options))
+
+        self.stdout.write(
+            f"{'server':<8}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+        )
+        for name, (latencies, errors) in results.items():
+            if len(latencies) > 1:
+                percentiles = statistics.quantiles(latencies, n=100)
+                p50, p95, p99 = (percentiles[i] * 1000 for i in (49, 94, 98))
+            else:
+                p50 = p95 = p99 = float('nan')
+            self.stdout.write(
+                f"{name:<8}{len(latencies):>10}{len(latencies) / options['duration']:>10.1f}"
+                f"{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{errors:>8}"
+            )
+
+    @contextmanager
+    def server(self, name, port, workers):
+        """Run gunicorn serving ``name`` on ``port`` until the block exits"""
+        arguments, async_views = SERVERS[name]
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn', *arguments,
+                '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning',
+            ],
+            env={**os.environ, 'ASYNC_READ_VIEWS': async_views},
+        )
+        try:
+            deadline = time.monotonic() + STARTUP_TIMEOUT
+            while True:
+                if process.poll() is not None:
+                    raise CommandError(f'{name} server exited with status {process.returncode}')
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise CommandError(f'{name} server did not start within {STARTUP_TIMEOUT}s')
+                    time.sleep(0.2)
+            yield process
+        finally:
+            process.terminate()
+            process.wait()
+
+    async def load(self, token, options):
+        """Return (latencies of successful requests, error count)"""
+        request = (
+            f"GET {options['path']} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{options['port']}\r\n"
+            f"Authorization: Bearer {token}\r\n"
+            "Accept: application/json\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        latencies = []
+        errors = []
+        deadline = time.monotonic() + options['duration']
+        await asyncio.gather(*(
+            self.client(request, options, deadline, latencies, errors)
+            for _ in range(options['clients'])
+        ))
+        return latencies, len(errors)
+
+    async def client(self, request, options, deadline, latencies, errors):
+        half = len(request) // 2
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', options['port'])
+                writer.write(request[:half])
+                await writer.drain()
+                await asyncio.sleep(random.expovariate(1 / options['client_delay']))
+                writer.write(request[half:])
+                await writer.drain()
+                status_line = await reader.readline()
+                await reader.read()
+                writer.close()
+                await writer.wait_closed()
+            except OSError as e:
+                errors.append(e)
+                continue
+            if status_line.split(b' ')[1:2] == [b'200']:
+                latencies.append(time.monotonic() - started)
+            else:
+                errors.append(status_line)
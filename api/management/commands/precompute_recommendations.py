@@ -0,0 +1,38 @@
+"""
+Django command to precompute quest recommendations for all active users.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.recommendations import (
+    DEFAULT_CHUNK_SIZE, DEFAULT_TOP_N, precompute_recommendations
+)
+
+
+class Command(BaseCommand):
+    """Score every active quest for every active user and cache the top-N"""
+    help = 'Precomputes and caches quest recommendations for all active users'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+            help='Number of users scored per batch'
+        )
+        parser.add_argument(
+            '--top-n', type=int, default=DEFAULT_TOP_N,
+            help='Number of recommendations cached per user'
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        self.stdout.write('Precomputing recommendations...')
+        started = time.monotonic()
+        processed = precompute_recommendations(
+            chunk_size=options['chunk_size'],
+            top_n=options['top_n'],
+        )
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Precomputed recommendations for {processed} users in {elapsed:.1f}s'
+        ))
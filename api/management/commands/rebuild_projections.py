@@ -0,0 +1,32 @@
+"""
+Django command to rebuild quest progress and its summaries from the event log.
+"""
+from django.core.management.base import BaseCommand
+
+from api.events import REPLAY_CHUNK_SIZE, backfill_events, rebuild_projections
+
+
+class Command(BaseCommand):
+    """Replay the progress event log into progress rows, XP, counters and leaderboards"""
+    help = 'Rebuilds UserQuestProgress and derived summaries by replaying ProgressEvent'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=REPLAY_CHUNK_SIZE,
+            help='Number of user/quest streams projected per transaction'
+        )
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='First synthesize events for progress recorded before the log existed'
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        if options['backfill']:
+            self.stdout.write('Backfilling progress events...')
+            written = backfill_events()
+            self.stdout.write(f'Wrote {written} events')
+
+        self.stdout.write('Replaying progress events...')
+        changed = rebuild_projections(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt projections, {changed} progress rows changed'))
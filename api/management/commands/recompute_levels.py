@@ -0,0 +1,23 @@
+"""
+Django command to recompute user levels from their experience points.
+"""
+from django.core.management.base import BaseCommand
+
+from api.xp import recompute_levels
+
+
+class Command(BaseCommand):
+    """Re-derive every user's level from the XP threshold table"""
+    help = 'Recomputes User.level from experience_points for all users'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of users loaded and updated per batch'
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        self.stdout.write('Recomputing user levels...')
+        updated = recompute_levels(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated the level of {updated} users'))
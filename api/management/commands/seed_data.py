@@ -12,6 +12,7 @@ from api.models import (
     UserQuestProgress, UserChallengeCompletion,
     PartnerOrganization, Partnership
 )
+from api.sharding import SHARED_DATABASE, is_sharded, shard_aliases
 
 User = get_user_model()
 
@@ -59,7 +60,10 @@ class Command(BaseCommand):
         ]
         
         for model in models:
-            model.objects.all().delete()
+            # Per-user rows are spread over the shards
+            aliases = shard_aliases() if is_sharded(model) else [SHARED_DATABASE]
+            for alias in aliases:
+                model.objects.using(alias).all().delete()
         
         # Clear media directory
         media_path = Path('media')
@@ -5,7 +5,7 @@ import time
 from django.core.management.base import BaseCommand
 from django.db import connections
 from django.db.utils import OperationalError
-from psycopg2 import OperationalError as Psycopg2OpError
+from psycopg import OperationalError as PsycopgOpError
 
 
 class Command(BaseCommand):
@@ -20,7 +20,7 @@ class Command(BaseCommand):
                 # Try to connect to the database
                 db_conn = connections['default']
                 db_conn.ensure_connection()
-            except (OperationalError, Psycopg2OpError):
+            except (OperationalError, PsycopgOpError):
                 self.stdout.write('Database unavailable, waiting 1 second...')
                 time.sleep(1)
 
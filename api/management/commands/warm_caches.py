@@ -0,0 +1,57 @@
+"""
+Django command to warm the caches of a new deployment.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.warmup import DEFAULT_CATALOG_PAGES, DEFAULT_CONCURRENCY, warm
+
+
+class Command(BaseCommand):
+    """Precompute the cached reference data, indexes and list pages"""
+    help = 'Precomputes the cached catalog pages, reference lists, partnerships and leaderboards'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+            help='Number of caches warmed at once'
+        )
+        parser.add_argument(
+            '--catalog-pages', type=int, default=DEFAULT_CATALOG_PAGES,
+            help='Number of quest catalog pages warmed'
+        )
+        parser.add_argument(
+            '--base-url', default=None,
+            help='Scheme and host clients use to reach the API (default: SITE_URL)'
+        )
+        parser.add_argument(
+            '--fail-on-error', action='store_true',
+            help='Exit with an error if any cache could not be warmed'
+        )
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        self.stdout.write('Warming caches...')
+        started = time.monotonic()
+        results = warm(
+            concurrency=options['concurrency'],
+            catalog_pages=options['catalog_pages'],
+            base_url=options['base_url'],
+        )
+        elapsed = time.monotonic() - started
+
+        failed = 0
+        for name, seconds, error in results:
+            if error is None:
+                self.stdout.write(f'{name:<40}{seconds * 1000:>10.1f} ms')
+            else:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'{name:<40}{seconds * 1000:>10.1f} ms  failed: {error}'))
+
+        summary = f'Warmed {len(results) - failed} of {len(results)} caches in {elapsed:.1f}s'
+        if failed and options['fail_on_error']:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary) if not failed else self.style.WARNING(summary))
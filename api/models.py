@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, MaxValueValidator
 
+from .geo import encode_geohash
+from .sharding import UserShardedQuerySet
+
 class User(AbstractUser):
     """Custom user model for Napoleon API"""
     email = models.EmailField(_('email address'), unique=True)
@@ -19,6 +24,35 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+class LocatedModel(models.Model):
+    """Optional coordinates, indexed by geohash for proximity lookups"""
+    latitude = models.FloatField(
+        null=True, blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    longitude = models.FloatField(
+        null=True, blank=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)]
+    )
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False)
+    
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='%(app_label)s_%(class)s_latlng'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        # Keep the geohash in step with the coordinates
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+        else:
+            self.geohash = ''
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geohash'}
+        super().save(*args, **kwargs)
+
 class Category(models.Model):
     """Categories for quests and challenges"""
     name = models.CharField(max_length=100, unique=True)
@@ -31,7 +65,7 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-class Quest(models.Model):
+class Quest(LocatedModel):
     """Main quest model for outdoor adventures"""
     QUEST_TYPES = [
         ('outdoor', 'Outdoor Adventure'),
@@ -79,6 +113,34 @@ class Challenge(models.Model):
     def __str__(self):
         return f"{self.quest.title} - {self.title}"
 
+class QuestStateChange(models.Model):
+    """Background job applying a quest's activation or deactivation to user progress"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('superseded', 'Superseded'),
+        ('failed', 'Failed'),
+    ]
+    
+    quest = models.ForeignKey(Quest, on_delete=models.CASCADE, related_name='state_changes')
+    is_active = models.BooleanField(help_text="State the quest was switched to")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    cursor = models.PositiveBigIntegerField(default=0, help_text="Last primary key processed")
+    shard = models.CharField(max_length=100, blank=True, help_text="Database a deactivation is working through")
+    processed_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        action = 'activation' if self.is_active else 'deactivation'
+        return f"{self.quest} {action} ({self.status})"
+
 class UserQuestProgress(models.Model):
     """Tracks user progress through quests"""
     STATUS_CHOICES = [
@@ -88,13 +150,22 @@ class UserQuestProgress(models.Model):
         ('abandoned', 'Abandoned'),
     ]
     
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='quest_progress')
-    quest = models.ForeignKey(Quest, on_delete=models.CASCADE, related_name='user_progress')
+    # Per-user rows live on the user's shard, so references to shared tables are
+    # unconstrained and deletes are cascaded by api.signals.cascade_to_shards
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='quest_progress'
+    )
+    quest = models.ForeignKey(
+        Quest, on_delete=models.DO_NOTHING, db_constraint=False, related_name='user_progress'
+    )
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='not_started')
     start_date = models.DateTimeField(null=True, blank=True)
     completion_date = models.DateTimeField(null=True, blank=True)
     progress = models.PositiveSmallIntegerField(default=0, validators=[MaxValueValidator(100)])
     
+    objects = UserShardedQuerySet.as_manager()
+    
     class Meta:
         verbose_name_plural = 'User Quest Progress'
         unique_together = ('user', 'quest')
@@ -104,19 +175,224 @@ class UserQuestProgress(models.Model):
 
 class UserChallengeCompletion(models.Model):
     """Tracks user completion of individual challenges"""
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='challenge_completions')
-    challenge = models.ForeignKey(Challenge, on_delete=models.CASCADE, related_name='completions')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='challenge_completions'
+    )
+    challenge = models.ForeignKey(
+        Challenge, on_delete=models.DO_NOTHING, db_constraint=False, related_name='completions'
+    )
     completed_at = models.DateTimeField(auto_now_add=True)
     evidence = models.TextField(blank=True, help_text="User's description or proof of completion")
     evidence_photo = models.ImageField(upload_to='challenge_evidence/', null=True, blank=True)
     
+    objects = UserShardedQuerySet.as_manager()
+    
     class Meta:
         unique_together = ('user', 'challenge')
     
     def __str__(self):
         return f"{self.user.username} completed {self.challenge.title}"
 
-class PartnerOrganization(models.Model):
+class ArchivedQuestProgress(models.Model):
+    """Finished quest progress moved out of the hot table by the archival job"""
+    # Keeps the id of the original UserQuestProgress row
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='archived_quest_progress'
+    )
+    quest = models.ForeignKey(
+        Quest, on_delete=models.DO_NOTHING, db_constraint=False, related_name='archived_progress'
+    )
+    status = models.CharField(max_length=20, choices=UserQuestProgress.STATUS_CHOICES)
+    start_date = models.DateTimeField(null=True, blank=True)
+    completion_date = models.DateTimeField(null=True, blank=True)
+    progress = models.PositiveSmallIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = UserShardedQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name_plural = 'Archived Quest Progress'
+        indexes = [
+            models.Index(fields=['user', 'quest'], name='api_archivedprogress_user'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.quest.title} ({self.status}, archived)"
+
+class ArchivedChallengeCompletion(models.Model):
+    """
+    Challenge completion of archived progress.
+    
+    On PostgreSQL the table is range partitioned by month of ``completed_at``
+    (see ``api.archive``), so old months can be detached or dropped on their own.
+    """
+    # Keeps the id of the original UserChallengeCompletion row
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='archived_challenge_completions'
+    )
+    challenge = models.ForeignKey(
+        Challenge, on_delete=models.DO_NOTHING, db_constraint=False, related_name='archived_completions'
+    )
+    completed_at = models.DateTimeField()
+    evidence = models.TextField(blank=True)
+    evidence_photo = models.ImageField(upload_to='challenge_evidence/', null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = UserShardedQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'completed_at'], name='api_archivedcompletion_user'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} completed {self.challenge.title} (archived)"
+
+class ProgressEvent(models.Model):
+    """Append-only log of everything that changes quest progress"""
+    QUEST_STARTED = 1
+    CHALLENGE_COMPLETED = 2
+    QUEST_ABANDONED = 3
+    QUEST_COMPLETED = 4
+    CHALLENGE_ADDED = 5
+    CHALLENGE_REMOVED = 6
+    KINDS = [
+        (QUEST_STARTED, 'Quest started'),
+        (CHALLENGE_COMPLETED, 'Challenge completed'),
+        (QUEST_ABANDONED, 'Quest abandoned'),
+        (QUEST_COMPLETED, 'Quest completed'),
+        (CHALLENGE_ADDED, 'Challenge added'),
+        (CHALLENGE_REMOVED, 'Challenge removed'),
+    ]
+    
+    id = models.BigAutoField(primary_key=True)
+    # Empty for quest structure events, which concern every user of the quest
+    # and are written to every shard
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='progress_events'
+    )
+    quest = models.ForeignKey(
+        Quest, on_delete=models.DO_NOTHING, db_constraint=False, related_name='progress_events'
+    )
+    challenge_id = models.PositiveBigIntegerField(null=True, blank=True)
+    kind = models.PositiveSmallIntegerField(choices=KINDS)
+    # Not auto_now_add, so backfilled events can keep their historic times
+    created_at = models.DateTimeField(default=timezone.now)
+    projected = models.BooleanField(default=False)
+    
+    objects = UserShardedQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['quest', 'user', 'id'], name='api_progressevent_stream'),
+            models.Index(
+                fields=['id'], name='api_progressevent_pending',
+                condition=models.Q(projected=False)
+            ),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.get_kind_display()} (user {self.user_id}, quest {self.quest_id})"
+
+class ExperienceLedgerEntry(models.Model):
+    """Append-only record of every experience point award"""
+    SOURCE_TYPES = [
+        ('quest', 'Quest'),
+        ('challenge', 'Challenge'),
+    ]
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='experience_ledger'
+    )
+    source_type = models.CharField(max_length=20, choices=SOURCE_TYPES)
+    source_id = models.PositiveBigIntegerField()
+    amount = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = UserShardedQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name_plural = 'experience ledger entries'
+        # One award per source makes repeated award attempts no-ops
+        unique_together = ('user', 'source_type', 'source_id')
+    
+    def __str__(self):
+        return f"{self.user.username} +{self.amount} XP ({self.source_type} {self.source_id})"
+
+class ExperienceFlushBatch(models.Model):
+    """A write-behind XP batch that has been applied to user totals"""
+    batch_id = models.CharField(max_length=64, unique=True)
+    user_count = models.PositiveIntegerField(default=0)
+    total_amount = models.BigIntegerField(default=0)
+    flushed_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.batch_id} ({self.user_count} users, {self.total_amount} XP)"
+
+class CounterShard(models.Model):
+    """One slot of a sharded popularity counter, e.g. ``quest:12:started``"""
+    name = models.CharField(max_length=100)
+    shard = models.PositiveSmallIntegerField()
+    count = models.BigIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('name', 'shard')
+    
+    def __str__(self):
+        return f"{self.name}[{self.shard}] = {self.count}"
+
+class AccountErasure(models.Model):
+    """Background erasure of a deleted account's data, processed in chunks"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    STAGES = [
+        'completions', 'archived_completions', 'events', 'progress', 'archived_progress',
+        'ledger', 'account'
+    ]
+    
+    # Not a foreign key: the record outlives the user row it erased
+    user_id = models.PositiveBigIntegerField(db_index=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    stage = models.CharField(max_length=20, default='completions')
+    cursor = models.PositiveBigIntegerField(default=0, help_text="Last primary key erased in this stage")
+    report = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True, help_text="When the latest run started")
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-requested_at']
+    
+    def __str__(self):
+        return f"Erasure of user {self.user_id} ({self.status})"
+
+class OutboxMessage(models.Model):
+    """Celery task recorded in the transaction that caused it, published after commit"""
+    task_name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder)
+    kwargs = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.task_name} #{self.pk}"
+
+class PartnerOrganization(LocatedModel):
     """Partner organizations like game parks and eco-organizations"""
     name = models.CharField(max_length=200)
     description = models.TextField()
@@ -0,0 +1,114 @@
+"""
+Transactional outbox for Celery tasks.
+
+Signal handlers record tasks with ``enqueue`` instead of calling ``.delay()``.
+The message is a row written in the same transaction as the change that caused
+it, so a rolled back request leaves no task behind and the request never waits
+on the broker. ``relay_outbox`` (run every few seconds by beat) publishes
+pending messages in batches over a single broker connection and deletes them.
+
+Delivery is at least once: a relay that dies between publishing and deleting a
+batch publishes it again, so tasks sent through the outbox must tolerate
+duplicates.
+
+Work done in a shard's transaction records its messages on that shard with
+``enqueue(..., using=alias)``, since a row on the shared database would
+commit independently of it. Every shard has its own outbox table, and the
+relay drains the shared one and each shard's in turn.
+"""
+import logging
+
+from celery import current_app
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+
+from .models import OutboxMessage
+from .sharding import SHARED_DATABASE, shard_aliases
+
+logger = logging.getLogger(__name__)
+
+RELAY_BATCH_SIZE = 100
+MAX_RELAY_ATTEMPTS = 10
+
+
+def enqueue(task, *args, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Record ``task(*args, **kwargs)`` to be published after the current transaction commits.
+
+    ``using`` names the database whose transaction the message belongs to.
+    """
+    return OutboxMessage.objects.using(using).create(task_name=task.name, args=list(args), kwargs=kwargs)
+
+
+def outbox_aliases():
+    """Databases with an outbox table: the shared database and every shard"""
+    return tuple(dict.fromkeys((SHARED_DATABASE, *shard_aliases())))
+
+
+def _publish(message, producer):
+    task = current_app.tasks.get(message.task_name)
+    if task is None:
+        current_app.send_task(
+            message.task_name, args=message.args, kwargs=message.kwargs, producer=producer
+        )
+    else:
+        task.apply_async(message.args, message.kwargs, producer=producer)
+
+
+def relay_outbox(batch_size=RELAY_BATCH_SIZE):
+    """
+    Publish pending outbox messages of every outbox table and delete them.
+
+    Messages are published in id order within each table.
+
+    Rows are locked with ``SKIP LOCKED`` so concurrent relays split the work.
+    A message that fails to publish has its attempt count bumped and the relay
+    stops, re-raising the error; messages that failed ``MAX_RELAY_ATTEMPTS`` times are left in the
+    table for inspection. Returns the number of messages published.
+    """
+    relayed = 0
+    for alias in outbox_aliases():
+        relayed += _relay(alias, batch_size)
+    if relayed:
+        logger.info(f"Relayed {relayed} outbox messages.")
+    return relayed
+
+
+def _relay(using, batch_size):
+    """Publish and delete the pending messages of the outbox on ``using``"""
+    messages = OutboxMessage.objects.using(using)
+    relayed = 0
+    while True:
+        error = None
+        with transaction.atomic(using=using):
+            batch = list(
+                messages.select_for_update(skip_locked=True)
+                .filter(attempts__lt=MAX_RELAY_ATTEMPTS)[:batch_size]
+            )
+            if not batch:
+                break
+            published = []
+            failed = None
+            try:
+                with current_app.producer_or_acquire() as producer:
+                    for message in batch:
+                        failed = message
+                        _publish(message, producer)
+                        published.append(message.pk)
+                        failed = None
+            except Exception as e:
+                error = e
+                if failed is not None:
+                    messages.filter(pk=failed.pk).update(attempts=F('attempts') + 1)
+                    logger.error(f"Error relaying outbox message {failed}: {e}", exc_info=True)
+                else:
+                    # No message is to blame, e.g. the broker cannot be reached
+                    logger.error(f"Error relaying the outbox: {e}", exc_info=True)
+            messages.filter(pk__in=published).delete()
+
+        relayed += len(published)
+        if error is not None:
+            raise error
+        if len(batch) < batch_size:
+            break
+    return relayed
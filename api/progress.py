@@ -0,0 +1,32 @@
+"""
+Progress row helpers.
+
+Progress itself is derived from the event log in ``api.events``; this module
+only makes sure every user has a row for every quest they can start.
+"""
+from .models import UserQuestProgress
+from .sharding import group_by_shard
+
+ENSURE_BATCH_SIZE = 1000
+
+
+def ensure_progress_rows(user_ids, quest_ids):
+    """
+    Create missing ``not_started`` rows for every user/quest pair.
+
+    Rows are inserted on each user's shard in batches with ``ON CONFLICT DO
+    NOTHING``, so existing progress is never touched and concurrent calls
+    cannot collide.
+    """
+    quest_ids = list(quest_ids)
+    for alias, shard_user_ids in group_by_shard(user_ids).items():
+        rows = UserQuestProgress.objects.using(alias)
+        batch = []
+        for user_id in shard_user_ids:
+            for quest_id in quest_ids:
+                batch.append(UserQuestProgress(user_id=user_id, quest_id=quest_id, status='not_started'))
+                if len(batch) >= ENSURE_BATCH_SIZE:
+                    rows.bulk_create(batch, ignore_conflicts=True)
+                    batch = []
+        if batch:
+            rows.bulk_create(batch, ignore_conflicts=True)
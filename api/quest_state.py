@@ -0,0 +1,137 @@
+"""
+Quest activation and deactivation cascades.
+
+Switching a quest on or off no longer touches user progress inside the save.
+The save records a ``QuestStateChange`` and a Celery job applies it in
+bounded chunks, each committed on its own, so no transaction holds row locks
+on every progress row of a popular quest:
+
+* activation creates ``not_started`` progress rows for all active users
+* deactivation logs ``QUEST_ABANDONED`` events and marks ``in_progress`` rows
+  of the quest as ``abandoned``, sending ``post_save`` for each of them
+
+The job keeps a primary key cursor, and deactivations work through the shards
+one after the other, so a retried or restarted job resumes where it stopped. A change that is overtaken by a newer change of the same
+quest stops as ``superseded``.
+"""
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .models import ProgressEvent, QuestStateChange, UserQuestProgress
+from .progress import ensure_progress_rows
+from .sharding import shard_aliases
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+STATE_CHANGE_CHUNK_SIZE = 1000
+
+
+def _next_chunk(change, chunk_size):
+    """Return the next primary keys to process after the change's cursor"""
+    if change.is_active:
+        rows = User.objects.filter(is_active=True)
+    else:
+        rows = UserQuestProgress.objects.using(change.shard).filter(
+            quest_id=change.quest_id, status='in_progress'
+        )
+    return list(
+        rows.filter(pk__gt=change.cursor).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+    )
+
+
+def _next_shard(change):
+    """Return the shard a deactivation continues with once its current one is done"""
+    if change.is_active:
+        return None
+    aliases = shard_aliases()
+    position = aliases.index(change.shard) if change.shard in aliases else len(aliases)
+    return aliases[position + 1] if position + 1 < len(aliases) else None
+
+
+def _apply_chunk(change, pks):
+    if change.is_active:
+        ensure_progress_rows(pks, [change.quest_id])
+        return len(pks)
+    # Rows may have moved on since the chunk was read
+    progress = UserQuestProgress.objects.using(change.shard)
+    rows = list(progress.select_for_update().filter(pk__in=pks, status='in_progress'))
+    # Logged as already projected: the update below is their projection
+    ProgressEvent.objects.using(change.shard).bulk_create([
+        ProgressEvent(
+            kind=ProgressEvent.QUEST_ABANDONED, user_id=row.user_id,
+            quest_id=change.quest_id, projected=True,
+        )
+        for row in rows
+    ])
+    count = progress.filter(pk__in=[row.pk for row in rows]).update(status='abandoned')
+    # The update bypasses save(); counters, live streams and cached
+    # recommendations still need to see the transition
+    for row in rows:
+        row.status = 'abandoned'
+        post_save.send(
+            UserQuestProgress, instance=row, created=False, update_fields={'status'},
+            raw=False, using=change.shard,
+        )
+    return count
+
+
+def process_state_change(change_id, chunk_size=STATE_CHANGE_CHUNK_SIZE):
+    """
+    Apply a recorded quest state change chunk by chunk.
+
+    Returns the number of progress rows created or abandoned by this run.
+    """
+    try:
+        change = QuestStateChange.objects.get(pk=change_id)
+    except QuestStateChange.DoesNotExist:
+        logger.warning(f"Quest state change {change_id} no longer exists.")
+        return 0
+    if change.status in ('completed', 'superseded'):
+        return 0
+
+    change.status = 'running'
+    change.started_at = change.started_at or timezone.now()
+    change.error = ''
+    if not change.is_active and not change.shard:
+        change.shard = shard_aliases()[0]
+    change.save(update_fields=['status', 'started_at', 'error', 'shard'])
+
+    processed = 0
+    while True:
+        newer = QuestStateChange.objects.filter(
+            quest_id=change.quest_id, pk__gt=change.pk
+        ).exists()
+        if newer:
+            change.status = 'superseded'
+            break
+        pks = _next_chunk(change, chunk_size)
+        if not pks:
+            next_shard = _next_shard(change)
+            if next_shard is None:
+                change.status = 'completed'
+                break
+            change.shard = next_shard
+            change.cursor = 0
+            change.save(update_fields=['shard', 'cursor'])
+            continue
+        # The shard's changes commit before the cursor that records them
+        with transaction.atomic(), transaction.atomic(using=change.shard or None):
+            count = _apply_chunk(change, pks)
+            change.cursor = pks[-1]
+            change.processed_count += count
+            change.save(update_fields=['cursor', 'processed_count'])
+        processed += count
+
+    change.finished_at = timezone.now()
+    change.save(update_fields=['status', 'finished_at'])
+    logger.info(f"Quest state change {change.pk} {change.status}, {change.processed_count} rows.")
+    return processed
+
+
+def mark_failed(change_id, error):
+    QuestStateChange.objects.filter(pk=change_id).update(status='failed', error=str(error))
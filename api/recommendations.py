@@ -0,0 +1,324 @@
+"""
+Quest recommendations scored with NumPy.
+
+The active catalog is encoded once per worker as a quest-feature matrix
+(quest type, difficulty and category one-hot columns plus normalised duration
+and popularity). A user's profile is the weighted sum of the rows of the quests
+in their history, so scoring every active quest for a whole batch of users is a
+single matrix product. Top-N lists are cached per user, dropped when the user's
+progress changes and keyed on the catalog version so catalog edits retire them.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import ArchivedQuestProgress, Challenge, Quest, UserChallengeCompletion, UserQuestProgress
+from .sharding import group_by_shard, shard_aliases
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+FEATURES_VERSION_KEY = 'quest_features:version'
+RECOMMENDATIONS_KEY = 'recommendations:{version}:{user_id}'
+RECOMMENDATIONS_TIMEOUT = 60 * 60 * 24
+MATRIX_MAX_AGE = 60 * 60  # Rebuild at least hourly to pick up popularity drift
+DEFAULT_TOP_N = 20
+DEFAULT_CHUNK_SIZE = 500
+
+# How much each kind of history contributes to the user's profile
+HISTORY_WEIGHTS = {
+    'completed': 1.0,
+    'in_progress': 0.6,
+    'abandoned': -0.3,
+}
+CHALLENGE_WEIGHT = 0.1
+POPULARITY_WEIGHT = 0.2
+
+# Quests in these states, or with completed challenges, are never recommended
+EXCLUDED_STATUSES = ('in_progress', 'completed')
+
+
+class QuestFeatureMatrix:
+    """Feature rows for every active quest, L2-normalised"""
+
+    def __init__(self, quest_ids, features, popularity, version=0):
+        self.quest_ids = np.asarray(quest_ids, dtype=np.int64)
+        self.positions = {quest_id: pos for pos, quest_id in enumerate(quest_ids)}
+        self.features = features
+        self.popularity = popularity
+        self.version = version
+        self.built_at = time.monotonic()
+
+    @property
+    def is_expired(self):
+        return time.monotonic() - self.built_at > MATRIX_MAX_AGE
+
+    def _index_arrays(self, histories):
+        """Flatten ``{row: {quest_id: value}}`` into index and value arrays"""
+        rows, cols, values = [], [], []
+        for row, history in enumerate(histories):
+            for quest_id, value in history.items():
+                pos = self.positions.get(quest_id)
+                if pos is not None:
+                    rows.append(row)
+                    cols.append(pos)
+                    values.append(value)
+        return (
+            np.asarray(rows, dtype=np.int64),
+            np.asarray(cols, dtype=np.int64),
+            np.asarray(values, dtype=np.float32),
+        )
+
+    def score(self, histories, exclusions):
+        """
+        Score every active quest for a batch of users.
+
+        ``histories`` is a list of ``{quest_id: weight}`` dicts, one per user,
+        and ``exclusions`` a matching list of quest id sets that must not be
+        recommended. Returns an ``(n_users, n_quests)`` score matrix.
+        """
+        n_users, n_quests = len(histories), len(self.quest_ids)
+
+        weights = np.zeros((n_users, n_quests), dtype=np.float32)
+        rows, cols, values = self._index_arrays(histories)
+        np.add.at(weights, (rows, cols), values)
+
+        profiles = weights @ self.features
+        norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+        profiles /= np.where(norms > 0, norms, 1)
+
+        scores = profiles @ self.features.T
+        scores += POPULARITY_WEIGHT * self.popularity
+
+        rows, cols, _ = self._index_arrays(
+            [dict.fromkeys(excluded, 0) for excluded in exclusions]
+        )
+        scores[rows, cols] = -np.inf
+        return scores
+
+    def top_n(self, scores, n):
+        """Return the quest ids of the ``n`` best scores in each row"""
+        n = min(n, scores.shape[1])
+        if n == 0:
+            return [[] for _ in range(scores.shape[0])]
+
+        candidates = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        best = np.take_along_axis(candidates, order, axis=1)
+
+        results = []
+        for row, positions in enumerate(best):
+            valid = positions[np.isfinite(scores[row, positions])]
+            results.append(self.quest_ids[valid].tolist())
+        return results
+
+
+def build_feature_matrix(version=0):
+    """Encode the active catalog as a quest-feature matrix"""
+    # Progress lives on the shards, so popularity is counted on each of them
+    started = {}
+    for alias in shard_aliases():
+        for quest_id, count in UserQuestProgress.objects.using(alias).filter(
+            status__in=EXCLUDED_STATUSES
+        ).values('quest_id').annotate(count=Count('id')).values_list('quest_id', 'count'):
+            started[quest_id] = started.get(quest_id, 0) + count
+    quests = [
+        (*row, started.get(row[0], 0))
+        for row in Quest.objects.filter(is_active=True)
+        .order_by('id')
+        .values_list('id', 'quest_type', 'difficulty', 'duration_minutes')
+    ]
+    category_links = list(
+        Quest.categories.through.objects.filter(quest__is_active=True)
+        .values_list('quest_id', 'category_id')
+    )
+
+    quest_types = [value for value, _ in Quest.QUEST_TYPES]
+    difficulties = [value for value, _ in Quest.DIFFICULTY_LEVELS]
+    category_ids = sorted({category_id for _, category_id in category_links})
+
+    columns = {}
+    for key in [('type', value) for value in quest_types] \
+            + [('difficulty', value) for value in difficulties] \
+            + [('category', value) for value in category_ids] \
+            + [('duration', None), ('popularity', None)]:
+        columns[key] = len(columns)
+
+    quest_ids = [row[0] for row in quests]
+    positions = {quest_id: pos for pos, quest_id in enumerate(quest_ids)}
+    features = np.zeros((len(quests), len(columns)), dtype=np.float32)
+
+    if quests:
+        _, types, levels, durations, popularity = zip(*quests)
+        rows = np.arange(len(quests))
+        features[rows, [columns[('type', value)] for value in types]] = 1
+        features[rows, [columns[('difficulty', value)] for value in levels]] = 1
+
+        durations = np.log1p(np.asarray(durations, dtype=np.float32))
+        features[:, columns[('duration', None)]] = durations / max(durations.max(), 1)
+
+        popularity = np.log1p(np.asarray(popularity, dtype=np.float32))
+        popularity /= max(popularity.max(), 1)
+        features[:, columns[('popularity', None)]] = popularity
+    else:
+        popularity = np.zeros(0, dtype=np.float32)
+
+    for quest_id, category_id in category_links:
+        pos = positions.get(quest_id)
+        if pos is not None:
+            features[pos, columns[('category', category_id)]] = 1
+
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    features /= np.where(norms > 0, norms, 1)
+
+    logger.debug(
+        f"Built quest feature matrix with {features.shape[0]} quests "
+        f"and {features.shape[1]} features."
+    )
+    return QuestFeatureMatrix(quest_ids, features, popularity, version=version)
+
+
+_matrix = None
+_matrix_lock = threading.Lock()
+
+
+def _current_version():
+    return cache.get(FEATURES_VERSION_KEY, 0)
+
+
+def get_feature_matrix(version=None):
+    """Return this worker's feature matrix, rebuilding it if it is stale"""
+    global _matrix
+    if version is None:
+        version = _current_version()
+    matrix = _matrix
+    if matrix is None or matrix.version != version or matrix.is_expired:
+        with _matrix_lock:
+            if _matrix is None or _matrix.version != version or _matrix.is_expired:
+                _matrix = build_feature_matrix(version)
+            matrix = _matrix
+    return matrix
+
+
+def invalidate_feature_matrix():
+    """Drop the local matrix and retire every cached recommendation list"""
+    global _matrix
+    _matrix = None
+    try:
+        cache.incr(FEATURES_VERSION_KEY)
+    except ValueError:
+        # Evicted: a small seed could match the version some worker still holds
+        cache.set(FEATURES_VERSION_KEY, time.time_ns() // 1000, None)
+
+
+def load_histories(user_ids):
+    """
+    Load the progress history for a batch of users.
+
+    Takes three queries per shard holding some of the users, plus one for the
+    quests of their completed challenges. Returns ``(histories, exclusions)``
+    as lists aligned with ``user_ids``.
+    """
+    rows = {user_id: pos for pos, user_id in enumerate(user_ids)}
+    histories = [{} for _ in user_ids]
+    exclusions = [set() for _ in user_ids]
+
+    completions = []
+    for alias, shard_user_ids in group_by_shard(user_ids).items():
+        # Archived attempts first, so the current attempt of a quest wins
+        for model in (ArchivedQuestProgress, UserQuestProgress):
+            progress = model.objects.using(alias).filter(
+                user_id__in=shard_user_ids
+            ).exclude(status='not_started').values_list('user_id', 'quest_id', 'status')
+            for user_id, quest_id, status in progress:
+                row = rows[user_id]
+                histories[row][quest_id] = HISTORY_WEIGHTS.get(status, 0)
+                if status in EXCLUDED_STATUSES:
+                    exclusions[row].add(quest_id)
+
+        completions.extend(UserChallengeCompletion.objects.using(alias).filter(
+            user_id__in=shard_user_ids
+        ).values_list('user_id', 'challenge_id'))
+
+    challenge_quests = dict(
+        Challenge.objects.filter(
+            id__in={challenge_id for _, challenge_id in completions}
+        ).values_list('id', 'quest_id')
+    )
+    for user_id, challenge_id in completions:
+        quest_id = challenge_quests.get(challenge_id)
+        if quest_id is None:
+            continue
+        row = rows[user_id]
+        histories[row][quest_id] = histories[row].get(quest_id, 0) + CHALLENGE_WEIGHT
+        # A quest the user has already worked on is not a recommendation
+        exclusions[row].add(quest_id)
+
+    return histories, exclusions
+
+
+def recommend_for_users(user_ids, top_n=DEFAULT_TOP_N, matrix=None):
+    """Compute top-N quest ids for a batch of users in one vectorized pass"""
+    matrix = matrix or get_feature_matrix()
+    histories, exclusions = load_histories(user_ids)
+    scores = matrix.score(histories, exclusions)
+    return dict(zip(user_ids, matrix.top_n(scores, top_n)))
+
+
+def get_recommendations(user, top_n=DEFAULT_TOP_N):
+    """Return the cached top-N quest ids for a user, computing them on a miss"""
+    version = _current_version()
+    key = RECOMMENDATIONS_KEY.format(version=version, user_id=user.pk)
+    cached = cache.get(key)
+    if cached is None or cached['top_n'] < top_n:
+        computed_n = max(top_n, DEFAULT_TOP_N)
+        matrix = get_feature_matrix(version)
+        quest_ids = recommend_for_users([user.pk], computed_n, matrix)[user.pk]
+        cached = {'top_n': computed_n, 'quest_ids': quest_ids}
+        cache.set(key, cached, RECOMMENDATIONS_TIMEOUT)
+    return cached['quest_ids'][:top_n]
+
+
+def invalidate_recommendations(user_id):
+    """Forget a user's cached recommendations"""
+    cache.delete(RECOMMENDATIONS_KEY.format(version=_current_version(), user_id=user_id))
+
+
+def precompute_recommendations(chunk_size=DEFAULT_CHUNK_SIZE, top_n=DEFAULT_TOP_N):
+    """
+    Precompute and cache recommendations for every active user.
+
+    Users are walked in primary key order in chunks of ``chunk_size`` so memory
+    stays bounded by ``chunk_size * active quests`` scores.
+    """
+    version = _current_version()
+    matrix = get_feature_matrix(version)
+    users = User.objects.filter(is_active=True).order_by('pk').values_list('pk', flat=True)
+
+    processed = 0
+    last_pk = 0
+    while True:
+        user_ids = list(users.filter(pk__gt=last_pk)[:chunk_size])
+        if not user_ids:
+            break
+        recommendations = recommend_for_users(user_ids, top_n, matrix)
+        cache.set_many(
+            {
+                RECOMMENDATIONS_KEY.format(version=version, user_id=user_id): {
+                    'top_n': top_n, 'quest_ids': quest_ids,
+                }
+                for user_id, quest_ids in recommendations.items()
+            },
+            RECOMMENDATIONS_TIMEOUT,
+        )
+        processed += len(user_ids)
+        last_pk = user_ids[-1]
+
+    logger.info(f"Precomputed recommendations for {processed} users.")
+    return processed
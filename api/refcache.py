@@ -0,0 +1,249 @@
+"""
+Two-tier read-through cache for reference data.
+
+Categories, active partner organizations and current partnerships are tiny,
+change rarely and are read on nearly every request path. Each of these
+reference sets is cached as a list of model instances, first in a bounded
+in-process LRU (L1) and then in the ``CACHES`` backend (L2), and is loaded from
+the database only when both miss, by one worker at a time (see
+``api.stampede``). The cached instances are shared between
+requests and must not be modified.
+
+Keys embed a version number per set that is kept in L2. Saving or deleting a
+row bumps the version once the change commits (see ``api.signals``), so nothing
+cached under the old version is read again. The saving process drops its own
+L1 entries right away. Other processes re-read the versions at most every
+``REFERENCE_CACHE_VERSION_CHECK_SECONDS``, which bounds how long they serve
+the old data.
+
+Hits per tier, misses and L1 evictions are counted per set and exported through
+the Prometheus ``/metrics`` endpoint by ``ReferenceCacheCollector``.
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Category, PartnerOrganization, Partnership, Quest
+from . import stampede
+from .replicas import replica_reads
+
+VERSION_KEY = 'refcache:{name}:version'
+ENTRY_KEY = 'refcache:{name}:v{version}:{variant}'
+ENTRY_TIMEOUT = 60 * 60
+
+
+def load_categories():
+    return list(Category.objects.all())
+
+
+def load_partner_organizations():
+    return list(PartnerOrganization.objects.filter(is_active=True).order_by('name'))
+
+
+def load_current_partnerships(today):
+    return list(
+        Partnership.objects.filter(
+            Q(end_date__isnull=True) | Q(end_date__gte=today),
+            organization__is_active=True,
+            start_date__lte=today,
+        ).select_related('organization', 'quest').order_by('-start_date')
+    )
+
+
+# Reference set -> loader. Loaders take the set's variant, if it has one.
+REFERENCE_SETS = {
+    'categories': load_categories,
+    'partner_organizations': load_partner_organizations,
+    'current_partnerships': load_current_partnerships,
+}
+
+# Model -> reference sets that include its rows
+DEPENDENT_SETS = {
+    Category: ['categories'],
+    PartnerOrganization: ['partner_organizations', 'current_partnerships'],
+    Partnership: ['current_partnerships'],
+    # Cached partnerships carry their quest
+    Quest: ['current_partnerships'],
+}
+
+
+class LocalLRU:
+    """Bounded in-process ``{key: value}`` dropping the least recently used entries"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return ``(found, value)``"""
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, self._entries[key]
+
+    def set(self, key, value):
+        """Store ``value`` and return the keys evicted to make room"""
+        evicted = []
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[0])
+        return evicted
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ReferenceCache:
+    """The L1 of this process, the versions it has seen and its statistics"""
+
+    def __init__(self):
+        self.local = LocalLRU(getattr(settings, 'REFERENCE_CACHE_L1_SIZE', 256))
+        self._versions = {}
+        self._versions_checked = 0
+        self._lock = threading.Lock()
+        self.stats = defaultdict(lambda: {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'evictions': 0})
+
+    def _count(self, name, stat):
+        with self._lock:
+            self.stats[name][stat] += 1
+
+    def versions(self):
+        """Return ``{name: version}``, re-read from L2 when the check interval has passed"""
+        interval = getattr(settings, 'REFERENCE_CACHE_VERSION_CHECK_SECONDS', 5)
+        now = time.monotonic()
+        if now - self._versions_checked < interval:
+            return self._versions
+        keys = {VERSION_KEY.format(name=name): name for name in REFERENCE_SETS}
+        found = cache.get_many(list(keys))
+        for key in keys.keys() - found.keys():
+            # Start at an unused version: entries of an evicted version may remain in L2
+            cache.add(key, time.time_ns() // 1000, None)
+            found[key] = cache.get(key, 0)
+        with self._lock:
+            self._versions = {name: found[key] for key, name in keys.items()}
+            self._versions_checked = now
+        return self._versions
+
+    def get(self, name, variant=''):
+        """Return the reference set ``name``, loading it on a miss"""
+        version = self.versions()[name]
+        key = ENTRY_KEY.format(name=name, version=version, variant=variant)
+        found, value = self.local.get(key)
+        if found:
+            self._count(name, 'l1_hits')
+            return value
+
+        loaded = []
+
+        def load():
+            loader = REFERENCE_SETS[name]
+            # A lagging replica would cache old rows under the new version
+            with replica_reads(False):
+                loaded.append(loader(variant) if variant else loader())
+            return loaded[0]
+
+        # After a version bump every worker misses at once; one of them loads
+        value = stampede.fetch(key, load, ENTRY_TIMEOUT)
+        self._count(name, 'misses' if loaded else 'l2_hits')
+        for evicted in self.local.set(key, value):
+            self._count(evicted.split(':')[1], 'evictions')
+        return value
+
+    def invalidate(self, name):
+        """Retire every cached copy of ``name``"""
+        key = VERSION_KEY.format(name=name)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            version = time.time_ns() // 1000
+            cache.set(key, version, None)
+        self.local.discard_prefix(f'refcache:{name}:')
+        with self._lock:
+            self._versions = {**self._versions, name: version}
+
+
+reference_cache = ReferenceCache()
+
+
+def categories():
+    return reference_cache.get('categories')
+
+
+def categories_by_id():
+    return {category.pk: category for category in categories()}
+
+
+def partner_organizations():
+    """Active partner organizations by name"""
+    return reference_cache.get('partner_organizations')
+
+
+def current_partnerships():
+    """Partnerships running today with active organizations, latest first"""
+    today = timezone.now().date()
+    return reference_cache.get('current_partnerships', today.isoformat())
+
+
+def invalidate_for(model):
+    """Retire the reference sets holding rows of ``model``"""
+    for name in DEPENDENT_SETS.get(model, ()):
+        reference_cache.invalidate(name)
+
+
+class ReferenceCacheCollector:
+    """Prometheus collector reading the reference cache statistics at scrape time"""
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        hits = CounterMetricFamily(
+            'reference_cache_hits', 'Reference set reads served from cache', labels=['set', 'tier']
+        )
+        misses = CounterMetricFamily(
+            'reference_cache_misses', 'Reference set reads loaded from the database', labels=['set']
+        )
+        evictions = CounterMetricFamily(
+            'reference_cache_evictions', 'Reference set entries evicted from the local cache', labels=['set']
+        )
+        size = GaugeMetricFamily('reference_cache_local_entries', 'Entries in the local cache')
+        for name, stats in list(reference_cache.stats.items()):
+            hits.add_metric([name, 'l1'], stats['l1_hits'])
+            hits.add_metric([name, 'l2'], stats['l2_hits'])
+            misses.add_metric([name], stats['misses'])
+            evictions.add_metric([name], stats['evictions'])
+        size.add_metric([], len(reference_cache.local))
+        return [hits, misses, evictions, size]
+
+
+_registered = False
+
+
+def register_metrics():
+    """Export reference cache metrics through prometheus_client, when it is installed"""
+    global _registered
+    try:
+        from prometheus_client import REGISTRY
+    except ImportError:
+        return False
+    if not _registered:
+        REGISTRY.register(ReferenceCacheCollector())
+        _registered = True
+    return True
@@ -0,0 +1,61 @@
+"""
+Response renderers.
+
+``ORJSONRenderer`` renders the same JSON as DRF's ``JSONRenderer`` with
+orjson, which encodes several times faster and writes the response bytes
+directly, where the stdlib encoder builds a ``str`` that is then encoded
+again. Values orjson does not know, such as ``Decimal``, lazy translations,
+and datetimes the views pass as they are, go through DRF's ``JSONEncoder``,
+so they come out as before. One difference remains: NaN and infinite floats
+render as ``null`` instead of failing the request.
+
+``MessagePackRenderer`` serves ``application/msgpack`` to clients that ask
+for it in ``Accept`` (or with ``?format=msgpack``). It carries the same
+values as the JSON, and is smaller and cheaper to decode on phones.
+
+``python manage.py benchmark_renderers`` compares them on quest pages.
+"""
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+_encoder = JSONEncoder()
+
+
+def encode_default(obj):
+    """Encode what orjson and msgpack cannot, as DRF's ``JSONEncoder`` would"""
+    return _encoder.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` encoding with orjson"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        # orjson only writes compact, UTF-8, NaN-less JSON; leave the rest to the stdlib
+        if indent is not None or self.ensure_ascii or not self.compact or not self.strict:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=encode_default, option=ORJSON_OPTIONS)
+        # Escape U+2028 and U+2029 like JSONRenderer, so the output stays valid JavaScript
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Renders MessagePack"""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default, use_bin_type=True)
@@ -0,0 +1,123 @@
+"""
+Read replica routing.
+
+``DATABASE_REPLICAS`` maps a primary alias to the aliases of its read
+replicas, e.g. ``{'default': ['default_replica1']}``. Reads only go to a
+replica inside a replica read context:
+
+* API views enable it for safe requests (see ``views.ReplicaReadMixin``), and
+* read-only jobs wrap themselves in ``with replica_reads():``.
+
+Everything else, including every write and every read in a request that
+writes, uses the primary. Replicas lag behind, so a user who has just written
+is pinned to the primary for ``REPLICA_PIN_SECONDS`` and reads their own
+writes. Pins are kept in the cache so they hold across processes.
+
+``ReplicaRouter`` goes after ``ShardRouter`` in ``DATABASE_ROUTERS``: the
+shard router picks the primary of per-user rows and this module swaps in one of
+its replicas, while everything else is read from a replica of ``default``.
+Rows loaded from a replica are written back to its primary.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, router
+
+PIN_KEY = 'db:primary_pin:{user_id}'
+DEFAULT_PIN_SECONDS = 5
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+def replicas_of(alias):
+    return getattr(settings, 'DATABASE_REPLICAS', {}).get(alias, ())
+
+
+def primary_for(alias):
+    """Return the primary of ``alias``, or ``alias`` itself if it is not a replica"""
+    for primary, replicas in getattr(settings, 'DATABASE_REPLICAS', {}).items():
+        if alias in replicas:
+            return primary
+    return alias
+
+
+def read_alias(alias):
+    """Return the database to read data stored on ``alias`` from"""
+    primary = primary_for(alias)
+    replicas = replicas_of(primary)
+    if replicas and _replica_reads.get():
+        return random.choice(replicas)
+    return primary
+
+
+def reads_from_replica():
+    return _replica_reads.get()
+
+
+def start_replica_reads(enabled=True):
+    """Enable (or disable) replica reads in the current context; returns a reset token"""
+    return _replica_reads.set(enabled)
+
+
+def end_replica_reads(token):
+    _replica_reads.reset(token)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Read from replicas inside the block, for jobs that never write"""
+    token = start_replica_reads(enabled)
+    try:
+        yield
+    finally:
+        end_replica_reads(token)
+
+
+def pin_to_primary(user):
+    """Send the reads of ``user`` to the primary until replicas have caught up"""
+    if getattr(settings, 'DATABASE_REPLICAS', None):
+        timeout = getattr(settings, 'REPLICA_PIN_SECONDS', DEFAULT_PIN_SECONDS)
+        cache.set(PIN_KEY.format(user_id=user.pk), True, timeout)
+
+
+def is_pinned(user):
+    if not getattr(settings, 'DATABASE_REPLICAS', None) or not user.is_authenticated:
+        return False
+    return bool(cache.get(PIN_KEY.format(user_id=user.pk)))
+
+
+async def ais_pinned(user):
+    if not getattr(settings, 'DATABASE_REPLICAS', None) or not user.is_authenticated:
+        return False
+    return bool(await cache.aget(PIN_KEY.format(user_id=user.pk)))
+
+
+class ReplicaRouter:
+    """Read from replicas in a replica read context and write to primaries"""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return read_alias(instance._state.db)
+        return read_alias(DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return primary_for(instance._state.db)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if primary_for(obj1._state.db) == primary_for(obj2._state.db):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        primary = primary_for(db)
+        if primary == db:
+            return None
+        # Replicas hold whatever their primary holds
+        return router.allow_migrate(primary, app_label, model_name=model_name, **hints)
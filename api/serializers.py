@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db import models
+from . import counters, refcache
 from .models import (
     Category, Quest, Challenge, 
     UserQuestProgress, UserChallengeCompletion,
@@ -34,11 +36,52 @@ class UserSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         """Update a user, setting the password correctly if provided"""
         password = validated_data.pop('password', None)
-        user = super().update(instance, validated_data)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
         if password:
-            user.set_password(password)
-            user.save()
-        return user
+            instance.set_password(password)
+        # Only write the submitted fields so concurrent XP awards are not overwritten
+        update_fields = list(validated_data) + (['password'] if password else [])
+        if update_fields:
+            instance.save(update_fields=update_fields)
+        return instance
+
+class CounterListSerializer(serializers.ListSerializer):
+    """List serializer that loads the counters for a whole page at once"""
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        names = [
+            name
+            for item in items
+            for name in self.child.get_counter_names(item).values()
+        ]
+        self.context.setdefault('counters', {}).update(counters.get_counts(names))
+        return super().to_representation(items)
+
+class CounterFieldsMixin:
+    """
+    Fill read-only count fields from sharded popularity counters.
+    
+    ``counter_names`` returns the counters of an object's pk by kind, and
+    ``counter_fields`` maps a field name to one of those kinds. Together with
+    ``CounterListSerializer`` a whole page is loaded in a single cache round trip.
+    """
+    counter_names = None
+    counter_fields = {}
+    
+    def get_counter_names(self, obj):
+        return self.counter_names(obj.pk)
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        names = self.get_counter_names(instance)
+        loaded = self.context.setdefault('counters', {})
+        missing = [name for name in names.values() if name not in loaded]
+        if missing:
+            loaded.update(counters.get_counts(missing))
+        for field_name, kind in self.counter_fields.items():
+            data[field_name] = loaded.get(names[kind], 0)
+        return data
 
 class CategorySerializer(serializers.ModelSerializer):
     """Serializer for the Category model"""
@@ -46,6 +89,21 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = '__all__'
 
+class CachedCategoryField(serializers.PrimaryKeyRelatedField):
+    """Category id field validated against the cached categories, without a query per id"""
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        category = refcache.categories_by_id().get(pk)
+        if category is None:
+            self.fail('does_not_exist', pk_value=data)
+        return category
+
 class ChallengeSerializer(serializers.ModelSerializer):
     """Serializer for the Challenge model"""
     class Meta:
@@ -53,25 +111,33 @@ class ChallengeSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('quest',)
 
-class QuestSerializer(serializers.ModelSerializer):
+class QuestSerializer(CounterFieldsMixin, serializers.ModelSerializer):
     """Serializer for the Quest model"""
     challenges = ChallengeSerializer(many=True, read_only=True)
     categories = CategorySerializer(many=True, read_only=True)
-    category_ids = serializers.PrimaryKeyRelatedField(
+    category_ids = CachedCategoryField(
         many=True,
         write_only=True,
         queryset=Category.objects.all(),
         source='categories'
     )
+    distance_km = serializers.FloatField(read_only=True)
+    started_count = serializers.IntegerField(read_only=True)
+    completed_count = serializers.IntegerField(read_only=True)
+    counter_names = staticmethod(counters.quest_counter_names)
+    counter_fields = {'started_count': 'started', 'completed_count': 'completed'}
     
     class Meta:
         model = Quest
         fields = [
             'id', 'title', 'description', 'quest_type', 'difficulty',
             'duration_minutes', 'experience_reward', 'is_active',
+            'latitude', 'longitude', 'distance_km',
+            'started_count', 'completed_count',
             'created_at', 'updated_at', 'challenges', 'categories', 'category_ids'
         ]
         read_only_fields = ('id', 'created_at', 'updated_at', 'challenges')
+        list_serializer_class = CounterListSerializer
 
 class UserChallengeCompletionSerializer(serializers.ModelSerializer):
     """Serializer for UserChallengeCompletion model"""
@@ -105,15 +171,29 @@ class PartnerOrganizationSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('id', 'created_at')
 
-class PartnershipSerializer(serializers.ModelSerializer):
+class PartnershipSerializer(CounterFieldsMixin, serializers.ModelSerializer):
     """Serializer for Partnership model"""
     organization_name = serializers.CharField(source='organization.name', read_only=True)
     quest_title = serializers.CharField(source='quest.title', read_only=True)
+    distance_km = serializers.FloatField(read_only=True)
+    redemption_count = serializers.IntegerField(read_only=True)
+    counter_names = staticmethod(counters.partnership_counter_names)
+    counter_fields = {'redemption_count': 'redemptions'}
     
     class Meta:
         model = Partnership
         fields = [
             'id', 'organization', 'organization_name', 'quest', 'quest_title',
-            'benefits', 'is_featured', 'start_date', 'end_date'
+            'benefits', 'is_featured', 'start_date', 'end_date', 'distance_km',
+            'redemption_count'
         ]
         read_only_fields = ('id', 'organization_name', 'quest_title')
+        list_serializer_class = CounterListSerializer
+
+class LeaderboardEntrySerializer(serializers.Serializer):
+    """Serializer for a single leaderboard position"""
+    rank = serializers.IntegerField()
+    user_id = serializers.IntegerField()
+    username = serializers.CharField()
+    level = serializers.IntegerField()
+    score = serializers.IntegerField()
@@ -0,0 +1,131 @@
+"""
+User-id sharding of per-user data.
+
+Per-user tables (quest progress, challenge completions, the progress event
+log, the XP ledger and their archives) are spread over the databases listed in
+``DATABASE_SHARDS``. Users, the catalog (quests, challenges, categories,
+partners) and every other table stay on the shared ``default`` database.
+
+All rows of a user live on one shard. User ids are hashed into a fixed number
+of buckets and the buckets are split evenly over the shards, in order:
+
+    bucket = user_id % SHARD_BUCKETS
+    shard  = DATABASE_SHARDS[bucket * len(DATABASE_SHARDS) // SHARD_BUCKETS]
+
+Adding a shard therefore moves whole bucket ranges, which can be copied
+bucket by bucket before the new list is deployed.
+
+``ShardRouter`` sends saves and related lookups of per-user rows to the
+owner's shard. Querysets do not know their user, so per-user reads use
+``Model.objects.for_user(user)`` and jobs loop over ``shard_aliases()``.
+Per-user rows reference users and catalog rows without database constraints,
+and queries on them never join the shared tables. Keeping ``default`` in the
+shard list lets a single database serve everything, which is the default.
+Row ids are only unique within a shard. Each shard also has its own outbox
+table, so work done in a shard's transaction can record tasks atomically with
+it (see ``api.outbox``).
+
+Each shard can have read replicas; see ``api.replicas``.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, models
+
+from .replicas import primary_for, read_alias
+
+SHARED_DATABASE = DEFAULT_DB_ALIAS
+SHARD_BUCKETS = 1024
+
+SHARDED_MODELS = frozenset({
+    'userquestprogress', 'userchallengecompletion', 'progressevent', 'experienceledgerentry',
+    'archivedquestprogress', 'archivedchallengecompletion',
+})
+# Tables every shard has its own copy of, written with an explicit alias
+SHARD_LOCAL_MODELS = frozenset({'outboxmessage'})
+
+
+def shard_aliases():
+    """Database aliases holding per-user data, in bucket order"""
+    return tuple(getattr(settings, 'DATABASE_SHARDS', None) or (SHARED_DATABASE,))
+
+
+def shard_for_user(user_id):
+    """Return the alias of the shard holding the rows of ``user_id``"""
+    aliases = shard_aliases()
+    bucket = int(user_id) % SHARD_BUCKETS
+    return aliases[bucket * len(aliases) // SHARD_BUCKETS]
+
+
+def group_by_shard(user_ids):
+    """Split ``user_ids`` into ``{alias: [user_id, ...]}``"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for_user(user_id), []).append(user_id)
+    return groups
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'api' and model._meta.model_name in SHARDED_MODELS
+
+
+class UserShardedQuerySet(models.QuerySet):
+    """QuerySet of a per-user model"""
+
+    def for_user(self, user):
+        """The rows of ``user`` (a user or a user id), read from their shard"""
+        user_id = getattr(user, 'pk', user)
+        return self.using(read_alias(shard_for_user(user_id))).filter(user_id=user_id)
+
+    def create(self, **kwargs):
+        # Serializers and other callers create rows without naming a database
+        user = kwargs.get('user', kwargs.get('user_id'))
+        if self._db is None and user is not None:
+            return self.using(shard_for_user(getattr(user, 'pk', user))).create(**kwargs)
+        return super().create(**kwargs)
+
+
+class ShardRouter:
+    """Route per-user models to the shard of the user they belong to"""
+
+    def _route(self, model, **hints):
+        instance = hints.get('instance')
+        if not is_sharded(model):
+            # Django would otherwise look up quest or user of a per-user row
+            # on the row's shard
+            if instance is not None and is_sharded(type(instance)):
+                return SHARED_DATABASE
+            return None
+        if instance is None:
+            return None
+        if is_sharded(type(instance)):
+            # Loaded rows stay on the shard (or its replica) they came from
+            if instance._state.db:
+                return instance._state.db
+            user_id = instance.user_id
+        elif isinstance(instance, get_user_model()):
+            # Related lookups such as user.quest_progress
+            user_id = instance.pk
+        else:
+            return None
+        return shard_for_user(user_id) if user_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        alias = self._route(model, **hints)
+        return read_alias(alias) if alias else None
+
+    def db_for_write(self, model, **hints):
+        alias = self._route(model, **hints)
+        return primary_for(alias) if alias else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        sharded = app_label == 'api' and model_name in SHARDED_MODELS
+        if db == SHARED_DATABASE:
+            return not sharded or db in shard_aliases()
+        if db in shard_aliases():
+            return sharded or (app_label == 'api' and model_name in SHARD_LOCAL_MODELS)
+        return None
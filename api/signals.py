@@ -2,7 +2,7 @@ import logging
 from datetime import timedelta
 
 from django.db.models.signals import (
-    post_save, pre_save, pre_delete, m2m_changed
+    post_init, post_save, post_delete, m2m_changed
 )
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
@@ -10,10 +10,17 @@ from django.db import transaction
 from django.utils import timezone
 
 from .models import (
-    UserQuestProgress, Quest, Challenge, 
-    UserChallengeCompletion, PartnerOrganization, Partnership
+    UserQuestProgress, Quest, QuestStateChange, Challenge, Category,
+    UserChallengeCompletion, PartnerOrganization, Partnership, ProgressEvent,
+    ArchivedQuestProgress, ArchivedChallengeCompletion, ExperienceLedgerEntry
 )
-from .tasks import send_notification_email
+from . import authentication, counters, events, live, outbox, refcache, stampede
+from .facets import invalidate_facet_index
+from .deferred import defer
+from .progress import ensure_progress_rows
+from .sharding import shard_aliases, shard_for_user
+from .recommendations import invalidate_feature_matrix, invalidate_recommendations
+from .tasks import process_quest_state_change, send_notification_email, update_quest_status
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -25,17 +32,13 @@ def create_user_profile(sender, instance, created, **kwargs):
     """
     if created and not instance.is_superuser:
         # Create quest progress for all active quests
-        active_quests = Quest.objects.filter(is_active=True)
-        for quest in active_quests:
-            UserQuestProgress.objects.get_or_create(
-                user=instance,
-                quest=quest,
-                defaults={'status': 'not_started'}
-            )
+        active_quests = Quest.objects.filter(is_active=True).values_list('id', flat=True)
+        ensure_progress_rows([instance.id], active_quests)
         
         # Send welcome email
         if instance.email:
-            send_notification_email.delay(
+            outbox.enqueue(
+                send_notification_email,
                 user_id=instance.id,
                 subject_template='emails/welcome_email_subject.txt',
                 message_template='emails/welcome_email.txt',
@@ -44,19 +47,12 @@ def create_user_profile(sender, instance, created, **kwargs):
                 }
             )
 
-@receiver(post_save, sender=Quest)
-def create_quest_progress_for_all_users(sender, instance, created, **kwargs):
+@receiver([post_save, post_delete], sender=User)
+def forget_auth_state(sender, instance, **kwargs):
     """
-    Signal to create quest progress for all users when a new quest is created
+    Re-read a changed user's active flag and password when they next authenticate
     """
-    if created and instance.is_active:
-        # Create quest progress for all active users
-        for user in User.objects.filter(is_active=True):
-            UserQuestProgress.objects.get_or_create(
-                user=user,
-                quest=instance,
-                defaults={'status': 'not_started'}
-            )
+    defer(authentication.forget_user, instance.pk, using=kwargs['using'])
 
 @receiver(post_save, sender=UserChallengeCompletion)
 def update_quest_progress_on_challenge_completion(sender, instance, created, **kwargs):
@@ -64,87 +60,139 @@ def update_quest_progress_on_challenge_completion(sender, instance, created, **k
     Update the quest progress when a challenge is completed
     """
     if created:
-        # Get the quest for this challenge
-        quest = instance.challenge.quest
+        quest_id = instance.challenge.quest_id
         
-        # Get or create the quest progress
-        progress, _ = UserQuestProgress.objects.get_or_create(
-            user=instance.user,
-            quest=quest,
-            defaults={'status': 'in_progress'}
+        # Append to the progress log; the user's progress is projected after commit
+        events.append(
+            ProgressEvent.CHALLENGE_COMPLETED, quest_id,
+            user_id=instance.user_id, challenge_id=instance.challenge_id
         )
-        
-        # Update progress percentage
-        total_challenges = quest.challenges.count()
-        completed_challenges = UserChallengeCompletion.objects.filter(
-            user=instance.user,
-            challenge__quest=quest
-        ).values('challenge').distinct().count()
-        
-        new_progress = int((completed_challenges / total_challenges) * 100) if total_challenges > 0 else 0
-        
-        # Update progress
-        progress.progress = new_progress
-        
-        # Check if quest is completed
-        if new_progress >= 100 and progress.status != 'completed':
-            progress.status = 'completed'
-            progress.completion_date = timezone.now()
-            
-            # Award experience points
-            instance.user.experience_points += quest.experience_reward
-            instance.user.save(update_fields=['experience_points'])
-            
-            # Send notification
-            send_notification_email.delay(
-                user_id=instance.user.id,
-                subject_template='emails/quest_completed_subject.txt',
-                message_template='emails/quest_completed.txt',
-                context={
-                    'quest_title': quest.title,
-                    'experience_reward': quest.experience_reward,
-                }
-            )
-        
-        progress.save()
+        defer(events.project_stream, instance.user_id, quest_id, using=kwargs['using'])
 
-@receiver(pre_save, sender=Quest)
-def handle_quest_activation(sender, instance, **kwargs):
+def touch_quests(*quest_ids):
+    """
+    Bump the updated_at of quests without sending their save signals
+    """
+    Quest.objects.filter(pk__in=quest_ids).update(updated_at=timezone.now())
+
+# Quest fields the facet index and the feature matrix are built from; categories
+# are handled by update_quest_categories
+INDEXED_QUEST_FIELDS = ('quest_type', 'difficulty', 'duration_minutes', 'is_active')
+
+def indexed_quest_fields(quest):
+    # Read from __dict__ so deferred loading never triggers a query
+    return {field: quest.__dict__.get(field) for field in INDEXED_QUEST_FIELDS}
+
+@receiver(post_init, sender=Quest)
+def remember_quest_state(sender, instance, **kwargs):
+    """
+    Remember the loaded is_active flag and indexed fields so changes need no extra query
+    """
+    instance._loaded_is_active = instance.__dict__.get('is_active')
+    instance._loaded_indexed = indexed_quest_fields(instance)
+
+@receiver(post_save, sender=Quest)
+def handle_quest_activation(sender, instance, created, raw=False, **kwargs):
     """
     Handle quest activation/deactivation
     """
-    if instance.pk:
-        try:
-            old_instance = Quest.objects.get(pk=instance.pk)
-            
-            # If quest is being activated
-            if instance.is_active and not old_instance.is_active:
-                # Create quest progress for all active users
-                for user in User.objects.filter(is_active=True):
-                    UserQuestProgress.objects.get_or_create(
-                        user=user,
-                        quest=instance,
-                        defaults={'status': 'not_started'}
-                    )
-            # If quest is being deactivated
-            elif not instance.is_active and old_instance.is_active:
-                # Update all in-progress quests to abandoned
-                UserQuestProgress.objects.filter(
-                    quest=instance,
-                    status='in_progress'
-                ).update(status='abandoned')
-                
-        except Quest.DoesNotExist:
-            pass
+    was_active = None if created else instance._loaded_is_active
+    instance._loaded_is_active = instance.is_active
+    if raw or (created and not instance.is_active):
+        return
+    # Unknown when is_active was deferred on load; only a real change is recorded
+    if not created and (was_active is None or was_active == instance.is_active):
+        return
+    
+    # Progress rows are created or abandoned in chunks by a background job
+    change = QuestStateChange.objects.create(quest=instance, is_active=instance.is_active)
+    outbox.enqueue(process_quest_state_change, change.id)
 
 @receiver(m2m_changed, sender=Quest.categories.through)
-def update_quest_categories(sender, instance, action, **kwargs):
+def update_quest_categories(sender, instance, action, reverse, pk_set, **kwargs):
     """
-    Handle changes to quest categories
+    Handle changes to quest categories, made from either side
     """
+    if reverse and action == 'pre_clear':
+        # Which quests lose the category is unknown once it has been cleared
+        instance._cleared_quest_ids = set(
+            sender.objects.using(kwargs['using']).filter(category_id=instance.pk)
+            .values_list('quest_id', flat=True)
+        )
     if action in ['post_add', 'post_remove', 'post_clear']:
-        # Update quest search index or clear cache if needed
-        instance.save(update_fields=['updated_at'])
+        if not reverse:
+            quest_ids = {instance.pk}
+        elif action == 'post_clear':
+            quest_ids = instance.__dict__.pop('_cleared_quest_ids', set())
+        else:
+            quest_ids = pk_set
+        # Touch the quests once without re-running their save signals
+        if quest_ids:
+            defer(touch_quests, *sorted(quest_ids))
+        defer(invalidate_facet_index)
+        defer(invalidate_feature_matrix)
+        defer(stampede.bump_version, 'catalog')
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=PartnerOrganization)
+@receiver([post_save, post_delete], sender=Partnership)
+@receiver([post_save, post_delete], sender=Quest)
+def invalidate_reference_data(sender, **kwargs):
+    """
+    Retire the cached reference sets holding the changed rows once the change is committed
+    """
+    defer(refcache.invalidate_for, sender, using=kwargs['using'])
+
+@receiver([post_save, post_delete], sender=Quest)
+@receiver(post_delete, sender=Category)
+def invalidate_quest_indexes(sender, instance, created=False, **kwargs):
+    """
+    Rebuild the quest facet index and feature matrix once a change to what they
+    index is committed
+    """
+    if sender is Quest and kwargs['signal'] is post_save and not created:
+        loaded, instance._loaded_indexed = instance._loaded_indexed, indexed_quest_fields(instance)
+        # Edits to titles, rewards or locations leave both untouched
+        if loaded == instance._loaded_indexed:
+            return
+    defer(invalidate_facet_index)
+    defer(invalidate_feature_matrix)
+
+@receiver([post_save, post_delete], sender=Quest)
+@receiver([post_save, post_delete], sender=Challenge)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog_pages(sender, **kwargs):
+    """
+    Retire the cached quest catalog pages once the change is committed
+    """
+    defer(stampede.bump_version, 'catalog', using=kwargs['using'])
+
+@receiver(post_save, sender=UserChallengeCompletion)
+@receiver(post_save, sender=UserQuestProgress)
+def invalidate_user_recommendations(sender, instance, **kwargs):
+    """
+    Drop a user's cached recommendations when their history changes
+    """
+    if sender is UserQuestProgress and instance.status == 'not_started':
+        return
+    defer(invalidate_recommendations, instance.user_id, using=kwargs['using'])
+
+@receiver(post_save, sender=UserQuestProgress)
+def publish_progress(sender, instance, created, **kwargs):
+    """
+    Push progress changes to the user's live streams once they are committed
+    """
+    if created and instance.status == 'not_started':
+        return
+    frame = live.message('progress', {
+        'id': instance.pk,
+        'quest': instance.quest_id,
+        'status': instance.status,
+        'progress': instance.progress,
+        'start_date': instance.start_date,
+        'completion_date': instance.completion_date,
+    })
+    defer(live.publish, instance.user_id, frame, using=kwargs['using'])
 
 @receiver(post_save, sender=Partnership)
 def notify_partnership_created(sender, instance, created, **kwargs):
@@ -152,9 +200,11 @@ def notify_partnership_created(sender, instance, created, **kwargs):
     Send notifications when a new partnership is created
     """
     if created:
-        # Notify organization contact
-        send_notification_email.delay(
-            user_id=instance.organization.contact_user.id if instance.organization.contact_user else None,
+        # Notify organization contact (organizations have an address, not a user)
+        outbox.enqueue(
+            send_notification_email,
+            user_id=None,
+            email=instance.organization.contact_email,
             subject_template='emails/partnership_created_subject.txt',
             message_template='emails/partnership_created.txt',
             context={
@@ -165,51 +215,78 @@ def notify_partnership_created(sender, instance, created, **kwargs):
             }
         )
 
-@receiver(pre_delete, sender=User)
-def handle_user_deletion(sender, instance, **kwargs):
+@receiver([post_save, post_delete], sender=Challenge)
+def update_quest_on_challenge_change(sender, instance, created=False, origin=None, **kwargs):
     """
-    Handle cleanup when a user is deleted
+    Update quest progress when a challenge is added or removed
     """
-    # Anonymize user data instead of deleting
-    instance.email = f'deleted_{instance.id}@example.com'
-    instance.username = f'deleted_{instance.id}'
-    instance.first_name = ''
-    instance.last_name = ''
-    instance.is_active = False
-    instance.save(update_fields=[
-        'email', 'username', 'first_name', 'last_name', 'is_active'
-    ])
+    if kwargs['signal'] is post_save:
+        if not created:
+            return
+        kind = ProgressEvent.CHALLENGE_ADDED
+    else:
+        # The quest itself is being deleted, together with its event log
+        if isinstance(origin, Quest) or getattr(origin, 'model', None) is Quest:
+            return
+        kind = ProgressEvent.CHALLENGE_REMOVED
     
-    # Cancel any scheduled tasks for this user
-    # (implementation depends on your task queue)
+    events.append(kind, instance.quest_id, challenge_id=instance.pk)
+    # A worker replays the quest's streams; later messages find nothing left to project
+    outbox.enqueue(update_quest_status)
+
+# Per-user rows referencing shared rows; their foreign keys do not cascade across databases
+SHARDED_REFERENCES = {
+    User: [
+        (UserChallengeCompletion, 'user_id'), (ArchivedChallengeCompletion, 'user_id'),
+        (ProgressEvent, 'user_id'), (UserQuestProgress, 'user_id'),
+        (ArchivedQuestProgress, 'user_id'), (ExperienceLedgerEntry, 'user_id'),
+    ],
+    Quest: [(UserQuestProgress, 'quest_id'), (ArchivedQuestProgress, 'quest_id'), (ProgressEvent, 'quest_id')],
+    Challenge: [(UserChallengeCompletion, 'challenge_id'), (ArchivedChallengeCompletion, 'challenge_id')],
+}
+
+def delete_shard_rows(sender, pk):
+    aliases = [shard_for_user(pk)] if sender is User else shard_aliases()
+    for alias in aliases:
+        for model, field in SHARDED_REFERENCES[sender]:
+            model.objects.using(alias).filter(**{field: pk}).delete()
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Quest)
+@receiver(post_delete, sender=Challenge)
+def cascade_to_shards(sender, instance, using, **kwargs):
+    """
+    Delete the per-user rows of a deleted user, quest or challenge from the shards
+    """
+    defer(delete_shard_rows, sender, instance.pk, using=using)
+
+@receiver(post_init, sender=UserQuestProgress)
+def remember_progress_status(sender, instance, **kwargs):
+    """
+    Remember the loaded status so transitions can be detected on save
+    """
+    # Read from __dict__ so deferred loading never triggers a query
+    instance._loaded_status = instance.__dict__.get('status')
 
-@receiver(post_save, sender=Challenge)
-def update_quest_on_challenge_change(sender, instance, created, **kwargs):
+@receiver(post_save, sender=UserQuestProgress)
+def count_progress_transitions(sender, instance, created, **kwargs):
     """
-    Update quest progress when a challenge is added, updated, or removed
+    Bump the sharded started/completed/redemption counters on status transitions
     """
-    quest = instance.quest
+    old_status = None if created else instance._loaded_status
+    new_status = instance.status
+    instance._loaded_status = new_status
+    if old_status == new_status:
+        return
     
-    # Get all users who have progress on this quest
-    user_progress = UserQuestProgress.objects.filter(quest=quest)
+    names = counters.quest_counter_names(instance.quest_id)
+    if old_status in (None, 'not_started') and new_status in ('in_progress', 'completed'):
+        counters.increment(names['started'])
     
-    for progress in user_progress:
-        # Recalculate progress
-        total_challenges = quest.challenges.count()
-        if total_challenges == 0:
-            progress.progress = 0
-        else:
-            completed_challenges = UserChallengeCompletion.objects.filter(
-                user=progress.user,
-                challenge__quest=quest
-            ).values('challenge').distinct().count()
-            progress.progress = int((completed_challenges / total_challenges) * 100)
-        
-        # Update status if needed
-        if progress.progress >= 100 and progress.status != 'completed':
-            progress.status = 'completed'
-            progress.completion_date = timezone.now()
-        elif progress.progress > 0 and progress.status == 'not_started':
-            progress.status = 'in_progress'
+    if new_status == 'completed':
+        counters.increment(names['completed'])
         
-        progress.save()
+        # Completing a quest redeems the benefits of its current partnerships
+        for partnership in refcache.current_partnerships():
+            if partnership.quest_id == instance.quest_id:
+                counters.increment(counters.partnership_counter_names(partnership.pk)['redemptions'])
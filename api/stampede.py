@@ -0,0 +1,241 @@
+"""
+Stampede-safe cache reads for expensive aggregates.
+
+``fetch(key, compute, timeout)`` reads ``key`` from the cache and calls
+``compute`` to refill it, like ``cache.get_or_set``, without letting every
+worker recompute the same value at once when it expires:
+
+* Entries are kept for ``timeout`` plus a grace period, and each records when
+  it goes stale and how long it took to compute. Readers refresh an entry
+  early, with a probability that rises as it approaches staleness and with
+  its compute time, so a hot key is usually refreshed before it goes stale.
+* Refreshing takes a lock key with ``cache.add``. Whoever holds it recomputes.
+  Everyone else serves the stale value, or waits up to ``LOCK_WAIT`` seconds
+  for the new one when there is nothing to serve.
+* Threads of one process asking for the same key while it is being fetched
+  share that fetch instead of each going to the cache (see ``coalesce``).
+
+Hits, refreshes, stale serves, lock waits and coalesced calls are counted per
+key prefix (the part before the first ``:``) and exported through the
+Prometheus ``/metrics`` endpoint by ``StampedeCollector``.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = '{key}:refresh-lock'
+VERSION_KEY = 'stampede:{name}:version'
+# Longest a refresh may hold its lock
+LOCK_TIMEOUT = 30
+# Longest a reader without a stale value waits for someone else's refresh
+LOCK_WAIT = 2.0
+LOCK_POLL_INTERVAL = 0.05
+# Higher values refresh earlier
+EARLY_REFRESH_BETA = 1.0
+
+STATS = (
+    'hits', 'misses', 'early_refreshes', 'stale_serves',
+    'lock_waits', 'lock_wait_seconds', 'lock_timeouts', 'coalesced',
+)
+
+_stats = defaultdict(lambda: dict.fromkeys(STATS, 0))
+_stats_lock = threading.Lock()
+
+
+def _count(key, stat, amount=1):
+    with _stats_lock:
+        _stats[key.split(':', 1)[0]][stat] += amount
+
+
+def stats():
+    """Return ``{key prefix: {stat: value}}`` for this process"""
+    with _stats_lock:
+        return {prefix: dict(values) for prefix, values in _stats.items()}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run one call per key at a time in this process and share its outcome"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            _count(key, 'coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+_flights = SingleFlight()
+
+
+def coalesce(key, func):
+    """Return ``func()``, sharing one call among the threads asking for ``key`` at once"""
+    return _flights.run(key, func)
+
+
+def _should_refresh(stale_at, compute_seconds):
+    """Refresh early with a probability rising towards ``stale_at``"""
+    jitter = -math.log(1.0 - random.random())
+    return time.time() + compute_seconds * EARLY_REFRESH_BETA * jitter >= stale_at
+
+
+def _refill(key, compute, timeout, grace):
+    started = time.time()
+    value = compute()
+    now = time.time()
+    cache.set(key, (value, now + timeout, now - started), timeout + grace)
+    return value
+
+
+def _fetch(key, compute, timeout, grace):
+    entry = cache.get(key)
+    if entry is not None:
+        value, stale_at, compute_seconds = entry
+        if not _should_refresh(stale_at, compute_seconds):
+            _count(key, 'hits')
+            return value
+
+    lock_key = LOCK_KEY.format(key=key)
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            if entry is None:
+                _count(key, 'misses')
+            elif time.time() < entry[1]:
+                _count(key, 'early_refreshes')
+            return _refill(key, compute, timeout, grace)
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        # Someone else is refreshing it
+        if time.time() >= entry[1]:
+            _count(key, 'stale_serves')
+        else:
+            _count(key, 'hits')
+        return entry[0]
+
+    _count(key, 'lock_waits')
+    started = time.monotonic()
+    try:
+        while time.monotonic() - started < LOCK_WAIT:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+            if not cache.get(lock_key):
+                break
+    finally:
+        _count(key, 'lock_wait_seconds', time.monotonic() - started)
+
+    # The refresh failed or is taking too long; do not wait for it any longer
+    _count(key, 'lock_timeouts')
+    logger.debug(f"Gave up waiting for the refresh of {key}.")
+    return _refill(key, compute, timeout, grace)
+
+
+def fetch(key, compute, timeout, grace=None):
+    """
+    Return the cached value of ``key``, refilling it with ``compute()``.
+
+    The value is fresh for ``timeout`` seconds and may be served stale while
+    it is being refreshed for ``grace`` more seconds (``timeout`` by default).
+    """
+    if grace is None:
+        grace = timeout
+    return coalesce(key, lambda: _fetch(key, compute, timeout, grace))
+
+
+def version(name):
+    """Return the current version of the keys in namespace ``name``, to embed in them"""
+    key = VERSION_KEY.format(name=name)
+    current = cache.get(key)
+    if current is None:
+        # Start at an unused version: entries of an evicted version may remain cached
+        cache.add(key, time.time_ns() // 1000, None)
+        current = cache.get(key, 0)
+    return current
+
+
+def bump_version(name):
+    """Retire every key built with the current version of ``name``"""
+    key = VERSION_KEY.format(name=name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns() // 1000, None)
+
+
+class StampedeCollector:
+    """Prometheus collector reading the stampede statistics at scrape time"""
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily
+
+        help_texts = {
+            'hits': 'Reads served from a fresh cache entry',
+            'misses': 'Reads that found nothing cached and computed the value',
+            'early_refreshes': 'Entries refreshed before they went stale',
+            'stale_serves': 'Reads served a stale entry while another worker refreshed it',
+            'lock_waits': 'Reads that waited for another worker to refill an empty entry',
+            'lock_wait_seconds': 'Time spent waiting for other workers to refill entries',
+            'lock_timeouts': 'Reads that stopped waiting for a refill and computed the value',
+            'coalesced': 'Reads that shared a fetch already running in the process',
+        }
+        families = {
+            stat: CounterMetricFamily(f'cache_stampede_{stat}', text, labels=['prefix'])
+            for stat, text in help_texts.items()
+        }
+        for prefix, values in stats().items():
+            for stat, family in families.items():
+                family.add_metric([prefix], values[stat])
+        return list(families.values())
+
+
+_registered = False
+
+
+def register_metrics():
+    """Export stampede metrics through prometheus_client, when it is installed"""
+    global _registered
+    try:
+        from prometheus_client import REGISTRY
+    except ImportError:
+        return False
+    if not _registered:
+        REGISTRY.register(StampedeCollector())
+        _registered = True
+    return True
@@ -0,0 +1,27 @@
+"""
+Shared fast stores.
+
+Redis is used when ``REDIS_URL`` is configured. Without it the modules built
+on top of this one fall back to in-process structures so development and the
+test suite run without a Redis server.
+"""
+import threading
+
+from django.conf import settings
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    """Return the shared Redis client, or ``None`` when Redis is not configured"""
+    global _client
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import redis
+                _client = redis.Redis.from_url(url, decode_responses=True)
+    return _client
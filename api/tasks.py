@@ -9,66 +9,39 @@ from django.template.loader import render_to_string
 from django.utils import timezone
 
 from .models import UserQuestProgress, Quest, User
+from . import archive, counters, erasure, events, leaderboards, outbox, quest_state, recommendations, xp
+from .replicas import replica_reads
+from .sharding import shard_aliases
 
 logger = logging.getLogger(__name__)
 
 
+def _fan_out(task):
+    """Queue ``task`` once per shard if there are several; returns whether it did."""
+    aliases = shard_aliases()
+    if len(aliases) < 2:
+        return False
+    for alias in aliases:
+        task.delay(shard=alias)
+    return True
+
+
 @shared_task(bind=True, max_retries=3)
-def update_quest_status(self):
-    """Update the status of all in-progress quests."""
+def update_quest_status(self, shard=None):
+    """Project progress events that have not been applied yet."""
     try:
-        # Get all in-progress quests
-        in_progress_quests = UserQuestProgress.objects.filter(
-            status='in_progress'
-        ).select_related('quest', 'user')
-        
-        updated_count = 0
-        now = timezone.now()
-        
-        for progress in in_progress_quests:
-            # Check if quest has expired
-            if progress.quest.expires_at and progress.quest.expires_at < now:
-                progress.status = 'expired'
-                progress.save(update_fields=['status', 'updated_at'])
-                updated_count += 1
-                continue
-                
-            # Check if all challenges are completed
-            total_challenges = progress.quest.challenges.count()
-            completed_challenges = progress.user.challenge_completions.filter(
-                challenge__quest=progress.quest
-            ).count()
-            
-            # Update progress percentage
-            if total_challenges > 0:
-                new_progress = int((completed_challenges / total_challenges) * 100)
-                if new_progress != progress.progress:
-                    progress.progress = new_progress
-                    
-                    # Mark as completed if all challenges are done
-                    if new_progress >= 100:
-                        progress.status = 'completed'
-                        progress.completion_date = now
-                        
-                        # Award experience points to the user
-                        progress.user.experience_points += progress.quest.experience_reward
-                        progress.user.save(update_fields=['experience_points'])
-                    
-                    progress.save(
-                        update_fields=['progress', 'status', 'completion_date', 'updated_at']
-                    )
-                    updated_count += 1
-        
-        logger.info(f"Updated status for {updated_count} quests.")
-        return f"Updated {updated_count} quests."
+        if shard is None and _fan_out(update_quest_status):
+            return "Queued projection on every shard."
+        projected = events.project_pending(using=shard)
+        return f"Projected {projected} progress events."
         
     except Exception as e:
-        logger.error(f"Error updating quest status: {e}", exc_info=True)
-        # Retry the task with exponential backoff
-        raise self.retry(exc=e, countdown=60 * 5)  # Retry after 5 minutes
+        logger.error(f"Error projecting progress events: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60)
 
 
 @shared_task(bind=True, max_retries=3)
+@replica_reads()  # Read-only job
 def send_daily_digest(self):
     """Send a daily digest email to users with their quest progress."""
     try:
@@ -78,25 +51,29 @@ def send_daily_digest(self):
             notification_preferences__daily_digest=True
         )
         
+        # The week's new quests are the same for everyone; exclude per user below
+        new_active_quests = list(Quest.objects.filter(
+            is_active=True,
+            created_at__gte=timezone.now() - timedelta(days=7)
+        ))
+        
         sent_count = 0
         for user in users:
             # Get user's in-progress quests
-            in_progress_quests = UserQuestProgress.objects.filter(
-                user=user,
+            # Quests are fetched from the shared database, not joined
+            in_progress_quests = UserQuestProgress.objects.for_user(user).filter(
                 status='in_progress'
-            ).select_related('quest')
+            ).prefetch_related('quest')
             
             # Skip if user has no in-progress quests
             if not in_progress_quests.exists():
                 continue
             
             # Get new quests available
-            new_quests = Quest.objects.filter(
-                is_active=True,
-                created_at__gte=timezone.now() - timedelta(days=7)
-            ).exclude(
-                id__in=in_progress_quests.values_list('quest_id', flat=True)
-            )[:3]  # Limit to 3 new quests
+            started = set(in_progress_quests.values_list('quest_id', flat=True))
+            new_quests = [
+                quest for quest in new_active_quests if quest.id not in started
+            ][:3]  # Limit to 3 new quests
             
             # Render email content
             context = {
@@ -132,17 +109,137 @@ def send_daily_digest(self):
 
 
 @shared_task(bind=True, max_retries=3)
-def send_notification_email(self, user_id, subject_template, message_template, context=None):
+@replica_reads()  # Read-only job
+def precompute_recommendations(self, chunk_size=recommendations.DEFAULT_CHUNK_SIZE):
+    """Precompute quest recommendations for all active users in chunks."""
+    try:
+        processed = recommendations.precompute_recommendations(chunk_size=chunk_size)
+        return f"Precomputed recommendations for {processed} users."
+
+    except Exception as e:
+        logger.error(f"Error precomputing recommendations: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60 * 5)  # Retry after 5 minutes
+
+
+@shared_task(bind=True, max_retries=3)
+@replica_reads()  # Read-only job
+def rebuild_leaderboards(self):
+    """Rebuild all current leaderboards from the database."""
+    try:
+        ranked = leaderboards.rebuild_leaderboards()
+        return f"Rebuilt leaderboards for {ranked} users."
+
+    except Exception as e:
+        logger.error(f"Error rebuilding leaderboards: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60 * 5)  # Retry after 5 minutes
+
+
+@shared_task(bind=True, max_retries=3)
+def flush_pending_xp(self):
+    """Apply write-behind XP awards to user totals in batches."""
+    try:
+        flushed = xp.flush_pending_xp()
+        return f"Flushed pending XP for {flushed} users."
+
+    except Exception as e:
+        logger.error(f"Error flushing pending XP: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=30)
+
+
+@shared_task(bind=True, max_retries=3)
+def compact_counters(self):
+    """Merge the shards of every popularity counter into one row."""
+    try:
+        removed = counters.compact_counters()
+        return f"Removed {removed} counter shards."
+
+    except Exception as e:
+        logger.error(f"Error compacting counters: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60 * 5)  # Retry after 5 minutes
+
+
+@shared_task(bind=True, max_retries=3)
+def archive_finished_progress(self, shard=None):
+    """Move long finished quest progress to the archive tables."""
+    try:
+        if shard is None and _fan_out(archive_finished_progress):
+            return "Queued archival on every shard."
+        archived = archive.archive_finished_progress(using=shard)
+        return f"Archived {archived} progress rows."
+
+    except Exception as e:
+        logger.error(f"Error archiving finished progress: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60 * 5)  # Committed chunks stay archived
+
+
+@shared_task(bind=True, max_retries=3)
+def process_quest_state_change(self, change_id):
+    """Apply a quest activation or deactivation to user progress in chunks."""
+    try:
+        processed = quest_state.process_state_change(change_id)
+        return f"Processed {processed} progress rows."
+
+    except Exception as e:
+        logger.error(f"Error processing quest state change {change_id}: {e}", exc_info=True)
+        quest_state.mark_failed(change_id, e)
+        raise self.retry(exc=e, countdown=60)  # Resumes from the saved cursor
+
+
+@shared_task(bind=True, max_retries=3)
+def erase_account(self, erasure_id):
+    """Erase a deleted account's data in chunks."""
+    try:
+        report = erasure.erase(erasure_id)
+        return f"Erasure {erasure_id} completed: {report}"
+
+    except Exception as e:
+        logger.error(f"Error erasing account data ({erasure_id}): {e}", exc_info=True)
+        erasure.mark_failed(erasure_id, e)
+        raise self.retry(exc=e, countdown=60 * 5)  # Resumes from the saved stage and cursor
+
+
+@shared_task(bind=True, max_retries=3)
+def resume_stalled_erasures(self):
+    """Queue again account erasures whose worker died mid-run."""
+    try:
+        resumed = erasure.resume_stalled_erasures()
+        return f"Resumed {resumed} stalled erasures."
+
+    except Exception as e:
+        logger.error(f"Error resuming stalled erasures: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=60)
+
+
+@shared_task(bind=True, max_retries=3)
+def relay_outbox(self):
+    """Publish tasks recorded in the transactional outbox."""
+    try:
+        relayed = outbox.relay_outbox()
+        return f"Relayed {relayed} outbox messages."
+
+    except Exception as e:
+        logger.error(f"Error relaying outbox: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=30)
+
+
+@shared_task(bind=True, max_retries=3)
+def send_notification_email(self, user_id, subject_template, message_template, context=None, email=None):
     """Send a notification email to a user.
     
     Args:
-        user_id: ID of the user to send the email to
+        user_id: ID of the user to send the email to, or None when ``email`` is given
         subject_template: Path to the subject template
         message_template: Path to the message template
         context: Dictionary of context variables for the templates
+        email: Address to send to instead of the user's own
     """
+    # A call without a recipient would fail the same way on every retry
+    if user_id is None and not email:
+        raise ValueError("send_notification_email needs a user_id or an email")
+
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.get(id=user_id) if user_id is not None else None
+        recipient = email or user.email
         
         if context is None:
             context = {}
@@ -161,11 +258,11 @@ def send_notification_email(self, user_id, subject_template, message_template, c
             subject=subject,
             message=message,
             from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[user.email],
+            recipient_list=[recipient],
             fail_silently=False,
         )
         
-        return f"Notification email sent to {user.email}"
+        return f"Notification email sent to {recipient}"
         
     except User.DoesNotExist:
         logger.error(f"User with ID {user_id} does not exist.")
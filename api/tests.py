@@ -1,3 +1,1718 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import math
+import os
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import msgpack
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework import exceptions, permissions, viewsets
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+from config import db_pool
+
+from . import (
+    async_views, authentication, compression, counters, erasure, events, facets, geo, leaderboards, live,
+    outbox, quest_state, recommendations, refcache, replicas, sharding, stampede, tasks, warmup, xp
+)
+from .models import (
+    AccountErasure, Category, Challenge, CounterShard, ExperienceLedgerEntry, OutboxMessage,
+    PartnerOrganization, Partnership, ProgressEvent, Quest, QuestStateChange, UserQuestProgress
+)
+from .deferred import defer
+from .parsers import MessagePackParser, ORJSONParser
+from .renderers import MessagePackRenderer, ORJSONRenderer
+from .serializers import CachedCategoryField
+from .sharding import shard_aliases
+from .views import CachedListMixin, QuestViewSet, ReplicaReadMixin
+
+User = get_user_model()
+
+# Serves the async read views, as with ASYNC_READ_VIEWS enabled
+urlpatterns = [path('api/', include(async_views.urlpatterns)), path('', include('config.urls'))]
+
+# For tests that need a working cache; the test settings use a dummy one
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class ReplicaProbeViewSet(ReplicaReadMixin, viewsets.ViewSet):
+    permission_classes = [permissions.AllowAny]
+
+    def list(self, request):
+        return Response({'replica': replicas.reads_from_replica()})
+
+    def retrieve(self, request, pk=None):
+        raise RuntimeError('unhandled')
+
+
+class CachedReplicaProbeViewSet(CachedListMixin, ReplicaProbeViewSet):
+    def list_cache_key(self, request):
+        return 'replica-probe'
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DATABASE_REPLICAS={'default': ['default_replica1']})
+class ReplicaReadMixinTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = APIRequestFactory()
+        self.user = User(pk=1, username='reader')
+
+    def get(self, actions, viewset=ReplicaProbeViewSet, **kwargs):
+        request = self.factory.get('/')
+        force_authenticate(request, user=self.user)
+        return viewset.as_view(actions)(request, **kwargs)
+
+    def test_safe_requests_read_from_replicas(self):
+        response = self.get({'get': 'list'})
+        self.assertTrue(response.data['replica'])
+        self.assertFalse(replicas.reads_from_replica())
+
+    def test_pinned_users_read_from_the_primary(self):
+        replicas.pin_to_primary(self.user)
+        self.assertFalse(self.get({'get': 'list'}).data['replica'])
+
+    def test_pins_without_a_configured_duration(self):
+        with self.settings():
+            del settings.REPLICA_PIN_SECONDS
+            replicas.pin_to_primary(self.user)
+        self.assertTrue(replicas.is_pinned(self.user))
+
+    def test_shared_pages_are_built_from_the_primary(self):
+        response = self.get({'get': 'list'}, viewset=CachedReplicaProbeViewSet)
+        self.assertFalse(response.data['replica'])
+
+    def test_unhandled_errors_end_replica_reads(self):
+        with self.assertRaises(RuntimeError):
+            self.get({'get': 'retrieve'}, pk=1)
+        self.assertFalse(replicas.reads_from_replica())
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DATABASE_REPLICAS={'default': ['default_replica1']})
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'default_replica1'}
+    replica = 'default_replica1'
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(User.objects.create_user('writer', 'writer@example.com', 'pass'))
+        # The replica lags: it never sees the primary's writes
+        Category.objects.create(name='Primary only')
+        Category.objects.using(self.replica).create(name='Replicated')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def names(self, client):
+        # Searching skips the reference cache, which always loads from the primary
+        response = client.get('/api/categories/', {'search': ''})
+        return sorted(category['name'] for category in response.data['results'])
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.names(self.client), ['Replicated'])
+        # Outside requests, reads use the primary
+        self.assertEqual(Category.objects.get().name, 'Primary only')
+
+    def test_writers_read_their_own_writes(self):
+        response = self.client.post('/api/categories/', {'name': 'New'})
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(Category.objects.using(self.replica).filter(name='New').exists())
+        self.assertEqual(self.names(self.client), ['New', 'Primary only'])
+
+        # Other users still read the replica
+        other = self.client_for(User.objects.create_user('reader', 'reader@example.com', 'pass'))
+        self.assertEqual(self.names(other), ['Replicated'])
+
+    def test_jobs_write_loaded_rows_to_the_primary(self):
+        with replicas.replica_reads():
+            category = Category.objects.get()
+            self.assertEqual(category._state.db, self.replica)
+            self.assertEqual(router.db_for_write(Category, instance=category), 'default')
+
+
+class QuestCategoryTouchTests(TestCase):
+    def setUp(self):
+        # A quest sharing the category's pk must not be mistaken for the changed one
+        self.category = Category.objects.create(pk=50, name='Nature')
+        self.bystander = self.create_quest(50)
+        self.quest = self.create_quest(51)
+        self.long_ago = timezone.now() - timedelta(days=1)
+        Quest.objects.update(updated_at=self.long_ago)
+
+    def create_quest(self, pk):
+        return Quest.objects.create(
+            pk=pk, title=f'Quest {pk}', description='d', quest_type='outdoor',
+            difficulty=1, duration_minutes=30, experience_reward=10,
+        )
+
+    def assertTouched(self, *quests):
+        for quest in [self.quest, self.bystander]:
+            quest.refresh_from_db()
+            if quest in quests:
+                self.assertGreater(quest.updated_at, self.long_ago, quest)
+            else:
+                self.assertEqual(quest.updated_at, self.long_ago, quest)
+
+    def test_forward_add(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quest.categories.add(self.category)
+        self.assertTouched(self.quest)
+
+    def test_reverse_add_and_remove(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.quests.add(self.quest)
+        self.assertTouched(self.quest)
+        Quest.objects.update(updated_at=self.long_ago)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.quests.remove(self.quest)
+        self.assertTouched(self.quest)
+
+    def test_reverse_clear(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.quests.add(self.quest)
+        Quest.objects.update(updated_at=self.long_ago)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.quests.clear()
+        self.assertTouched(self.quest)
+
+
+class RelayOutboxTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.messages = [
+            OutboxMessage.objects.create(task_name='api.tasks.example', args=[number])
+            for number in range(3)
+        ]
+        patcher = mock.patch.object(outbox, 'current_app')
+        self.app = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_publishes_and_deletes(self):
+        with mock.patch.object(outbox, '_publish') as publish:
+            self.assertEqual(outbox.relay_outbox(), 3)
+        self.assertEqual(publish.call_count, 3)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_empty_outbox_does_not_touch_the_broker(self):
+        OutboxMessage.objects.all().delete()
+        self.assertEqual(outbox.relay_outbox(), 0)
+        self.app.producer_or_acquire.assert_not_called()
+
+    def test_unreachable_broker(self):
+        self.app.producer_or_acquire.side_effect = ConnectionError('broker down')
+        with self.assertRaises(ConnectionError):
+            outbox.relay_outbox()
+        # No message is to blame
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list('attempts', flat=True)), [0, 0, 0]
+        )
+
+    def test_failed_message_stops_the_relay(self):
+        second = self.messages[1]
+
+        def publish(message, producer):
+            if message.pk == second.pk:
+                raise ConnectionError('lost the broker')
+
+        with mock.patch.object(outbox, '_publish', side_effect=publish):
+            with self.assertRaises(ConnectionError):
+                outbox.relay_outbox()
+        self.assertEqual(
+            dict(OutboxMessage.objects.values_list('pk', 'attempts')),
+            {second.pk: 1, self.messages[2].pk: 0},
+        )
+
+
+
+@override_settings(DATABASE_SHARDS=['shard1', 'shard2'])
+class ShardOutboxTests(TestCase):
+    databases = '__all__'
+
+    def messages(self, alias):
+        return list(OutboxMessage.objects.using(alias).values_list('task_name', flat=True))
+
+    def test_message_rolls_back_with_the_shard_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic(using='shard2'):
+                outbox.enqueue(tasks.update_quest_status, using='shard2')
+                raise RuntimeError('rolled back')
+        self.assertEqual(self.messages('shard2'), [])
+
+    def test_relay_drains_every_outbox(self):
+        for alias in ('default', 'shard1', 'shard2'):
+            outbox.enqueue(tasks.update_quest_status, using=alias)
+        with mock.patch.object(outbox, 'current_app'), mock.patch.object(outbox, '_publish') as publish:
+            self.assertEqual(outbox.relay_outbox(), 3)
+        self.assertEqual(publish.call_count, 3)
+        for alias in ('default', 'shard1', 'shard2'):
+            self.assertEqual(self.messages(alias), [])
+
+    def test_completion_email_is_recorded_on_the_users_shard(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.create_user('finisher', password='pass', id=600)
+            quest = Quest.objects.create(
+                title='Summit', description='d', quest_type='outdoor',
+                difficulty=1, duration_minutes=30, experience_reward=10,
+            )
+            challenge = Challenge.objects.create(
+                quest=quest, title='Top', description='d', order=1, experience_reward=5,
+            )
+        OutboxMessage.objects.all().delete()
+        events.append(ProgressEvent.QUEST_STARTED, quest.pk, user.pk)
+        events.append(ProgressEvent.CHALLENGE_COMPLETED, quest.pk, user.pk, challenge.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            events.project_stream(user.pk, quest.pk)
+        self.assertEqual(
+            self.messages(sharding.shard_for_user(user.pk)), ['api.tasks.send_notification_email']
+        )
+        self.assertEqual(self.messages('default'), [])
+
+class FoldTests(SimpleTestCase):
+    start = timezone.now()
+
+    def fold(self, *kinds_and_challenges, challenge_ids=frozenset({1, 2})):
+        log = [
+            mock.Mock(kind=kind, challenge_id=challenge_id, created_at=self.start + timedelta(minutes=minute))
+            for minute, (kind, challenge_id) in enumerate(kinds_and_challenges)
+        ]
+        return events.fold(log, set(challenge_ids))
+
+    def test_nothing_started(self):
+        self.assertEqual(self.fold().status, 'not_started')
+
+    def test_partial_progress(self):
+        projection = self.fold(
+            (ProgressEvent.QUEST_STARTED, None), (ProgressEvent.CHALLENGE_COMPLETED, 1),
+        )
+        self.assertEqual((projection.status, projection.progress, projection.complete), ('in_progress', 50, False))
+
+    def test_every_challenge_done_is_complete(self):
+        projection = self.fold(
+            (ProgressEvent.CHALLENGE_COMPLETED, 1), (ProgressEvent.CHALLENGE_COMPLETED, 2),
+        )
+        # Completing is the projector's call; the fold only reports it
+        self.assertEqual((projection.status, projection.progress, projection.complete), ('in_progress', 100, True))
+
+    def test_abandon_and_restart(self):
+        abandoned = self.fold((ProgressEvent.QUEST_STARTED, None), (ProgressEvent.QUEST_ABANDONED, None))
+        self.assertEqual(abandoned.status, 'abandoned')
+        restarted = self.fold(
+            (ProgressEvent.QUEST_STARTED, None), (ProgressEvent.QUEST_ABANDONED, None),
+            (ProgressEvent.QUEST_STARTED, None),
+        )
+        self.assertEqual(restarted.status, 'in_progress')
+        self.assertEqual(restarted.start_date, abandoned.start_date)
+
+    def test_removed_challenges_do_not_count(self):
+        projection = self.fold(
+            (ProgressEvent.CHALLENGE_COMPLETED, 1), (ProgressEvent.CHALLENGE_COMPLETED, 3),
+            challenge_ids={1},
+        )
+        self.assertEqual((projection.progress, projection.complete), (100, True))
+
+
+class ProjectorTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(username='hiker', password='pass')
+            self.quest = Quest.objects.create(
+                title='Trail', description='d', quest_type='outdoor',
+                difficulty=1, duration_minutes=30, experience_reward=40,
+            )
+            self.challenges = [
+                Challenge.objects.create(
+                    quest=self.quest, title=f'Step {order}', description='d',
+                    order=order, experience_reward=5,
+                )
+                for order in (1, 2)
+            ]
+        # Structure events of the setup are not under test
+        for alias in shard_aliases():
+            ProgressEvent.objects.using(alias).update(projected=True)
+        OutboxMessage.objects.all().delete()
+
+    def append(self, kind, challenge=None):
+        events.append(kind, self.quest.pk, self.user.pk, getattr(challenge, 'pk', None))
+
+    def progress(self):
+        return UserQuestProgress.objects.for_user(self.user).get(quest=self.quest)
+
+    def completions(self):
+        return ProgressEvent.objects.for_user(self.user).filter(kind=ProgressEvent.QUEST_COMPLETED).count()
+
+    def test_project_stream_completes_the_quest_once(self):
+        self.append(ProgressEvent.QUEST_STARTED)
+        for challenge in self.challenges:
+            self.append(ProgressEvent.CHALLENGE_COMPLETED, challenge)
+        with self.captureOnCommitCallbacks(execute=True):
+            row, changed = events.project_stream(self.user.pk, self.quest.pk)
+        self.assertEqual((row.status, row.progress), ('completed', 100))
+        self.assertIn('completion_date', changed)
+        self.assertEqual(self.completions(), 1)
+        self.assertFalse(ProgressEvent.objects.for_user(self.user).filter(projected=False).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            row, changed = events.project_stream(self.user.pk, self.quest.pk)
+        self.assertEqual(changed, [])
+        self.assertEqual(self.completions(), 1)
+        self.assertEqual(ExperienceLedgerEntry.objects.for_user(self.user).filter(source_type='quest').count(), 1)
+
+    def test_pending_user_events_are_caught_up(self):
+        # The request appended its events, then died before projecting them
+        self.append(ProgressEvent.QUEST_STARTED)
+        for challenge in self.challenges:
+            self.append(ProgressEvent.CHALLENGE_COMPLETED, challenge)
+        self.assertFalse(UserQuestProgress.objects.for_user(self.user).filter(quest=self.quest).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(events.project_pending(), 3)
+        self.assertEqual((self.progress().status, self.progress().progress), ('completed', 100))
+        self.assertEqual(self.completions(), 1)
+        self.assertEqual(events.project_pending(), 0)
+
+    def test_removing_a_challenge_is_projected_by_a_worker(self):
+        self.append(ProgressEvent.QUEST_STARTED)
+        self.append(ProgressEvent.CHALLENGE_COMPLETED, self.challenges[0])
+        events.project_stream(self.user.pk, self.quest.pk)
+        self.assertEqual(self.progress().progress, 50)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.challenges[1].delete()
+        # The request only appends and queues the replay
+        self.assertEqual(self.progress().progress, 50)
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list('task_name', flat=True)),
+            ['api.tasks.update_quest_status'],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            # The removal is logged on every shard
+            self.assertEqual(events.project_pending(), len(shard_aliases()))
+        self.assertEqual((self.progress().status, self.progress().progress), ('completed', 100))
+        self.assertEqual(self.completions(), 1)
+        # Nothing is left for the next run
+        self.assertEqual(events.project_pending(), 0)
+
+
+class LevelTests(SimpleTestCase):
+    def test_thresholds(self):
+        self.assertEqual(xp.LEVEL_THRESHOLDS[:4], (0, 100, 300, 600))
+        for points, level in [(0, 1), (99, 1), (100, 2), (299, 2), (300, 3), (600, 4)]:
+            with self.subTest(points=points):
+                self.assertEqual(xp.level_for_xp(points), level)
+
+    def test_level_is_capped(self):
+        self.assertEqual(xp.level_for_xp(xp.LEVEL_THRESHOLDS[-1]), xp.MAX_LEVEL)
+        self.assertEqual(xp.level_for_xp(10 ** 9), xp.MAX_LEVEL)
+
+
+class AwardXPTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(username='earner', password='pass')
+
+    def award(self, amount, source_id):
+        # The total is bumped once the ledger entry commits on the user's shard
+        with self.captureOnCommitCallbacks(using=sharding.shard_for_user(self.user.pk), execute=True):
+            return xp.award_xp(self.user.pk, amount, 'quest', source_id)
+
+    def test_award_raises_total_and_level(self):
+        self.assertTrue(self.award(120, 1))
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.experience_points, self.user.level), (120, 2))
+
+    def test_source_is_awarded_once(self):
+        self.assertTrue(self.award(120, 1))
+        self.assertFalse(self.award(120, 1))
+        self.assertTrue(self.award(30, 2))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.experience_points, 150)
+        self.assertEqual(ExperienceLedgerEntry.objects.for_user(self.user).count(), 2)
+
+
+@override_settings(XP_WRITE_BEHIND=True, REDIS_URL=None)
+class WriteBehindXPTests(TestCase):
+    def setUp(self):
+        xp.get_xp_buffer().clear()
+        self.addCleanup(xp.get_xp_buffer().clear)
+        self.user = User.objects.create_user(username='climber', password='pass')
+        xp.get_xp_buffer().add(self.user.pk, 30)
+
+    def experience_points(self):
+        self.user.refresh_from_db()
+        return self.user.experience_points
+
+    def test_flush_applies_pending_xp(self):
+        self.assertEqual(xp.pending_xp(self.user.pk), 30)
+        self.assertEqual(xp.flush_pending_xp(), 1)
+        self.assertEqual((self.experience_points(), xp.pending_xp(self.user.pk)), (30, 0))
+
+    def test_applied_batches_are_not_pending(self):
+        # The flush dies between applying the batch and acknowledging it
+        with mock.patch.object(xp.LocalXPBuffer, 'ack'):
+            xp.flush_pending_xp()
+        xp.get_xp_buffer().add(self.user.pk, 5)
+        self.assertEqual((self.experience_points(), xp.pending_xp(self.user.pk)), (30, 5))
+
+        # The next flush acknowledges the batch without applying it again
+        xp.flush_pending_xp()
+        self.assertEqual((self.experience_points(), xp.pending_xp(self.user.pk)), (35, 0))
+
+    def test_flush_does_nothing_without_write_behind(self):
+        with self.settings(XP_WRITE_BEHIND=False):
+            self.assertEqual(xp.flush_pending_xp(), 0)
+        self.assertEqual((self.experience_points(), xp.pending_xp(self.user.pk)), (0, 30))
+
+
+
+@skipUnless(fakeredis, 'fakeredis is not installed')
+class RedisXPBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = xp.RedisXPBuffer(fakeredis.FakeRedis(decode_responses=True))
+
+    def test_drain_moves_pending_xp_into_a_batch(self):
+        self.buffer.add(1, 30)
+        self.buffer.add(1, 5)
+        [(batch_id, deltas)] = self.buffer.drain()
+        self.assertEqual(deltas, {1: 35})
+        # Awards made while the batch is applied collect in a fresh hash
+        self.buffer.add(1, 10)
+        self.assertEqual(self.buffer.pending(1), {batch_id: 35, None: 10})
+        self.buffer.ack(batch_id)
+        self.assertEqual(self.buffer.pending(1), {None: 10})
+
+    def test_concurrent_drain_loses_the_race_quietly(self):
+        self.buffer.add(1, 30)
+        [(batch_id, _)] = self.buffer.drain()
+        # Another drain saw the pending hash before the first one renamed it
+        with mock.patch.object(self.buffer.client, 'exists', return_value=1):
+            batches = self.buffer.drain()
+        self.assertEqual(batches, [(batch_id, {1: 30})])
+
+
+class QuestStateChangeTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quest = Quest.objects.create(
+                title='Lake', description='d', quest_type='outdoor',
+                difficulty=1, duration_minutes=30, experience_reward=10, is_active=False,
+            )
+            self.users = [
+                User.objects.create_user(f'swimmer{number}', f'swimmer{number}@example.com', 'pass')
+                for number in range(5)
+            ]
+
+    def switch(self, is_active):
+        self.quest.is_active = is_active
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quest.save()
+        return QuestStateChange.objects.filter(quest=self.quest).latest('id')
+
+    def statuses(self):
+        return sorted(
+            status for alias in shard_aliases()
+            for status in UserQuestProgress.objects.using(alias)
+            .filter(quest=self.quest).values_list('status', flat=True)
+        )
+
+    def test_activation_creates_missing_progress_rows(self):
+        change = self.switch(True)
+        self.assertEqual(quest_state.process_state_change(change.pk, chunk_size=2), 5)
+        self.assertEqual(self.statuses(), ['not_started'] * 5)
+        change.refresh_from_db()
+        self.assertEqual((change.status, change.processed_count), ('completed', 5))
+
+    def test_deactivation_abandons_started_quests_and_notifies(self):
+        quest_state.process_state_change(self.switch(True).pk)
+        for user in self.users[:3]:
+            UserQuestProgress.objects.for_user(user).filter(quest=self.quest).update(status='in_progress')
+        change = self.switch(False)
+
+        with ExitStack() as stack:
+            publish = stack.enter_context(mock.patch.object(live, 'publish'))
+            for alias in shard_aliases():
+                stack.enter_context(self.captureOnCommitCallbacks(using=alias, execute=True))
+            self.assertEqual(quest_state.process_state_change(change.pk, chunk_size=2), 3)
+
+        self.assertEqual(self.statuses(), ['abandoned'] * 3 + ['not_started'] * 2)
+        # The bulk update still reaches the users' live streams
+        self.assertEqual(
+            sorted(call.args[0] for call in publish.call_args_list),
+            sorted(user.pk for user in self.users[:3]),
+        )
+        self.assertEqual(
+            sum(
+                ProgressEvent.objects.for_user(user).filter(kind=ProgressEvent.QUEST_ABANDONED).count()
+                for user in self.users
+            ),
+            3,
+        )
+
+    def test_failed_job_resumes_from_its_cursor(self):
+        change = self.switch(True)
+        apply_chunk = quest_state._apply_chunk
+        applied = []
+
+        def apply_one_chunk(change, pks):
+            if applied:
+                raise RuntimeError('worker lost')
+            applied.append(pks)
+            return apply_chunk(change, pks)
+
+        with mock.patch.object(quest_state, '_apply_chunk', side_effect=apply_one_chunk):
+            with self.assertRaises(RuntimeError):
+                quest_state.process_state_change(change.pk, chunk_size=2)
+        change.refresh_from_db()
+        self.assertEqual(change.processed_count, 2)
+        self.assertEqual(change.cursor, self.users[1].pk)
+
+        # Only the rest is applied by the next run
+        self.assertEqual(quest_state.process_state_change(change.pk, chunk_size=2), 3)
+        self.assertEqual(self.statuses(), ['not_started'] * 5)
+
+
+class RendererTests(TestCase):
+    databases = '__all__'
+    data = {
+        'id': uuid.UUID(int=1),
+        'reward': Decimal('1.50'),
+        'at': datetime(2024, 5, 1, 12, 30, tzinfo=dt_timezone.utc),
+        'on': date(2024, 5, 1),
+        'label': gettext_lazy('Quest'),
+        'text': 'caf\u00e9 \u2028',
+        'counts': {1: 2},
+        'tags': ('a', 'b'),
+    }
+
+    def test_json_matches_drf(self):
+        self.assertEqual(ORJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        # Indented output is left to the stdlib encoder
+        media_type = 'application/json; indent=2'
+        self.assertEqual(
+            ORJSONRenderer().render(self.data, media_type), JSONRenderer().render(self.data, media_type)
+        )
+
+    def test_nan_renders_as_null(self):
+        self.assertEqual(ORJSONRenderer().render({'ratio': math.nan}), b'{"ratio":null}')
+
+    def test_msgpack_carries_the_json_values(self):
+        # The parser only takes string keys, as JSON would
+        data = {key: value for key, value in self.data.items() if key != 'counts'}
+        parsed = MessagePackParser().parse(BytesIO(MessagePackRenderer().render(data)))
+        self.assertEqual(parsed, json.loads(JSONRenderer().render(data)))
+
+    def test_json_parser(self):
+        parser = ORJSONParser()
+        self.assertEqual(
+            parser.parse(BytesIO(ORJSONRenderer().render(self.data))), json.loads(JSONRenderer().render(self.data))
+        )
+        self.assertEqual(
+            parser.parse(BytesIO('{"text": "caf\u00e9"}'.encode('latin-1')), parser_context={'encoding': 'latin-1'}),
+            {'text': 'caf\u00e9'},
+        )
+        for body in (b'{"ratio": NaN}', b'{'):
+            with self.assertRaises(ParseError):
+                parser.parse(BytesIO(body))
+
+    def test_msgpack_parser_rejects_bad_bodies(self):
+        with self.assertRaises(ParseError):
+            MessagePackParser().parse(BytesIO(b'\xc1'))
+
+    def test_clients_can_ask_for_msgpack(self):
+        Quest.objects.create(
+            title='Forest walk', description='d', quest_type='outdoor',
+            difficulty=1, duration_minutes=30, experience_reward=10,
+        )
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('packer', 'packer@example.com', 'pw'))
+
+        response = client.get('/api/quests/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), client.get('/api/quests/').json())
+
+        body = {'name': 'Walkers', 'description': 'd'}
+        response = client.post(
+            '/api/categories/', msgpack.packb(body), content_type='application/msgpack'
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertTrue(Category.objects.filter(name='Walkers').exists())
+
+    def test_benchmark_command(self):
+        with self.assertRaisesMessage(CommandError, 'There are no quests to render'):
+            call_command('benchmark_renderers', stdout=StringIO())
+        Quest.objects.create(
+            title='Forest walk', description='d', quest_type='outdoor',
+            difficulty=1, duration_minutes=30, experience_reward=10,
+        )
+        out = StringIO()
+        call_command('benchmark_renderers', '--sizes', '3', '--number', '1', '--repeat', '1', stdout=out)
+        self.assertEqual(
+            [line.split()[1] for line in out.getvalue().splitlines()[1:]], ['json', 'json', 'msgpack']
+        )
+
+
+class AsyncReadViewTests(TestCase):
+    """The async read views answer like the viewsets they stand in for"""
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'pw')
+        self.quests = [
+            Quest.objects.create(
+                title=title, description='d', quest_type=quest_type,
+                difficulty=1, duration_minutes=30, experience_reward=10,
+            )
+            for title, quest_type in [('Forest walk', 'outdoor'), ('Trivia night', 'indoor')]
+        ]
+        Challenge.objects.create(
+            quest=self.quests[0], title='Find the oak', description='d', order=1, experience_reward=5
+        )
+        UserQuestProgress.objects.create(user=self.user, quest=self.quests[0], status='in_progress')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def assertMatchesViewset(self, path, **params):
+        # ``format`` sends the request to the viewset
+        expected = self.client.get(path, {**params, 'format': 'json'})
+        with override_settings(ROOT_URLCONF=__name__):
+            response = self.client.get(path, params)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.json(), expected.json())
+        return response.json()
+
+    def test_lists_match_the_viewsets(self):
+        data = self.assertMatchesViewset('/api/quests/')
+        self.assertEqual(data['count'], 2)
+        data = self.assertMatchesViewset('/api/quests/', user_status='in_progress')
+        self.assertEqual([quest['title'] for quest in data['results']], ['Forest walk'])
+        self.assertMatchesViewset('/api/quests/', quest_type='indoor', ordering='title')
+        self.assertMatchesViewset('/api/quests/', difficulty='x')
+        self.assertMatchesViewset('/api/challenges/', quest=self.quests[0].pk)
+        self.assertMatchesViewset('/api/quest-progress/', status='in_progress')
+
+    def test_details_match_the_viewsets(self):
+        self.assertMatchesViewset(f'/api/quests/{self.quests[0].pk}/')
+        self.assertMatchesViewset('/api/quests/99999/')
+        self.assertMatchesViewset(f'/api/challenges/{self.quests[0].challenges.get().pk}/')
+
+    def test_me_includes_pending_xp(self):
+        with mock.patch('api.async_views.pending_xp', return_value=150), \
+                override_settings(ROOT_URLCONF=__name__):
+            data = self.client.get('/api/users/me/').json()
+        self.assertEqual(data['experience_points'], 150)
+        self.assertEqual(data['level'], xp.level_for_xp(150))
+
+    def test_anonymous_requests_are_rejected(self):
+        self.client.credentials()
+        with override_settings(ROOT_URLCONF=__name__):
+            response = self.client.get('/api/quest-progress/')
+        self.assertEqual(response.status_code, 401)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        authentication.auth_states.clear()
+        # Run the creation's hooks, or the save's would be deduplicated against them
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user('auth', 'auth@example.com', 'pw')
+        self.token = AccessToken.for_user(self.user)
+
+    def test_auth_state_is_cached(self):
+        with self.assertNumQueries(1):
+            authentication.get_user(self.token)
+        with self.assertNumQueries(0):
+            user = authentication.get_user(self.token)
+        self.assertEqual((user.pk, user.username, user.is_active), (self.user.pk, 'auth', True))
+        # The profile is only loaded on request
+        self.assertIn('bio', user.get_deferred_fields())
+        self.assertEqual(authentication.full_user(user).email, 'auth@example.com')
+
+    async def test_async_views_share_the_cache(self):
+        await authentication.aget_user(self.token)
+        self.assertIsNotNone(authentication.auth_states.get(self.user.pk))
+        user = await authentication.aget_user(self.token)
+        self.assertEqual(user.username, 'auth')
+
+    def test_saving_a_user_forgets_their_state(self):
+        authentication.get_user(self.token)
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        with self.assertRaises(exceptions.AuthenticationFailed) as raised:
+            authentication.get_user(self.token)
+        self.assertEqual(raised.exception.get_codes(), 'user_inactive')
+
+    def test_deleted_users_no_longer_authenticate(self):
+        authentication.get_user(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+
+        with self.assertRaises(exceptions.AuthenticationFailed) as raised:
+            authentication.get_user(self.token)
+        self.assertEqual(raised.exception.get_codes(), 'user_not_found')
+
+    def test_state_loaded_before_a_forget_is_not_cached(self):
+        generation = authentication.auth_states.generation
+        authentication.forget_user(self.user.pk)
+        authentication._remember(self.user.pk, self.user, generation)
+        self.assertIsNone(authentication.auth_states.get(self.user.pk))
+
+
+class LiveStreamTests(TestCase):
+    async def open(self, user_id):
+        stream = live.stream(user_id)
+        self.assertEqual(await anext(stream), f'retry: {live.RECONNECT_MILLISECONDS}\n\n')
+        return stream
+
+    async def test_frames_reach_every_stream_of_the_user(self):
+        first, second, other = await self.open(1), await self.open(1), await self.open(2)
+        frame = live.message('xp', {'experience_points': 10})
+        live.publish(1, frame)
+
+        self.assertEqual(await anext(first), frame)
+        self.assertEqual(await anext(second), frame)
+        # Streams of other users only get the keepalive comment
+        with mock.patch.object(live, 'KEEPALIVE_SECONDS', 0.01):
+            self.assertEqual(await anext(other), ': keepalive\n\n')
+        for stream in (first, second, other):
+            await stream.aclose()
+
+    async def test_slow_streams_drop_the_oldest_frames(self):
+        with mock.patch.object(live, 'STREAM_BUFFER', 2):
+            stream = await self.open(1)
+        for number in range(3):
+            live.publish(1, f'data: {number}\n\n')
+        # Let the loop queue the frames
+        await asyncio.sleep(0)
+
+        self.assertEqual([await anext(stream), await anext(stream)], ['data: 1\n\n', 'data: 2\n\n'])
+        await stream.aclose()
+
+    async def test_closed_streams_leave_the_hub(self):
+        first, second = await self.open(1), await self.open(1)
+        await first.aclose()
+        self.assertTrue(live.hub.has_streams(1))
+        await second.aclose()
+        self.assertFalse(live.hub.has_streams(1))
+        # Publishing to a user without streams is a no-op
+        live.publish(1, live.message('xp', {}))
+
+    def test_publish_failures_are_logged(self):
+        client = mock.Mock(**{'publish.side_effect': ConnectionError})
+        with mock.patch.object(live, 'get_redis', return_value=client), \
+                self.assertLogs('api.live', 'WARNING'):
+            live.publish(1, live.message('xp', {}))
+        client.publish.assert_called_once()
+
+
+class LiveStreamHandlerTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The test runner has already set Django up; doing it again would reset logging
+        with mock.patch('django.setup'):
+            from config import asgi
+        cls.application = asgi.LiveStreamASGIHandler()
+
+    async def test_stream_is_served_until_the_client_disconnects(self):
+        user = await User.objects.acreate(username='live', email='live@example.com')
+        token = str(AccessToken.for_user(user))
+        path = reverse('live-stream')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())],
+            'client': ('127.0.0.1', 1), 'server': ('testserver', 80),
+        }
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        await received.put({'type': 'http.request', 'body': b'', 'more_body': False})
+        request = asyncio.create_task(self.application(scope, received.get, sent.put))
+
+        start = await asyncio.wait_for(sent.get(), 5)
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), start['headers'])
+        self.assertEqual((await sent.get())['body'], f'retry: {live.RECONNECT_MILLISECONDS}\n\n'.encode())
+
+        frame = live.message('progress', {'id': 1, 'status': 'completed'})
+        live.publish(user.pk, frame)
+        self.assertEqual((await asyncio.wait_for(sent.get(), 5))['body'], frame.encode())
+
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(request, 5)
+        self.assertFalse(live.hub.has_streams(user.pk))
+
+
+class LocalSortedSetsTests(SimpleTestCase):
+    def setUp(self):
+        self.store = leaderboards.LocalSortedSets()
+        self.store.replace('board', {'1': 50, '2': 80, '3': 50, '4': 10})
+
+    def test_ranks_by_score_then_member(self):
+        self.assertEqual(self.store.range('board', 0, -1), [('2', 80), ('1', 50), ('3', 50), ('4', 10)])
+        self.assertEqual(self.store.rank('board', '3'), (2, 50))
+        self.assertEqual(self.store.rank('board', '5'), (None, None))
+        self.assertEqual(self.store.rank('missing', '1'), (None, None))
+
+    def test_increment_moves_members(self):
+        self.store.increment([('board', '4', 100, None), ('board', '5', 5, None)])
+        self.assertEqual(self.store.rank('board', '4'), (0, 110))
+        self.assertEqual(self.store.rank('board', '5'), (4, 5))
+        self.assertEqual(self.store.size('board'), 5)
+
+    def test_empty_replacement_drops_the_board(self):
+        self.store.replace('board', {})
+        self.assertEqual((self.store.size('board'), self.store.range('board', 0, 9)), (0, []))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, REDIS_URL=None)
+class LeaderboardTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        leaderboards.get_store().clear()
+        self.addCleanup(leaderboards.get_store().clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users = [
+                User.objects.create_user(
+                    f'racer{number}', f'racer{number}@example.com', 'pass',
+                    experience_points=100 * (7 - number),
+                )
+                for number in range(7)
+            ]
+            self.category = Category.objects.create(name='Water', description='d')
+            self.quest = Quest.objects.create(
+                title='Rapids', description='d', quest_type='outdoor',
+                difficulty=2, duration_minutes=30, experience_reward=40, is_active=False,
+            )
+            self.quest.categories.add(self.category)
+            self.other = Quest.objects.create(
+                title='Hill', description='d', quest_type='outdoor',
+                difficulty=1, duration_minutes=30, experience_reward=15, is_active=False,
+            )
+
+    def complete(self, user, quest, days_ago=0):
+        with self.captureOnCommitCallbacks(using=sharding.shard_for_user(user.pk), execute=True):
+            UserQuestProgress.objects.create(
+                user=user, quest=quest, status='completed',
+                completion_date=timezone.now() - timedelta(days=days_ago),
+            )
+
+    def test_rank_and_around_me(self):
+        leaderboards.rebuild_leaderboards()
+        self.assertEqual(
+            leaderboards.get_rank(self.users[3].pk), {'rank': 4, 'user_id': self.users[3].pk, 'score': 400}
+        )
+        around = leaderboards.get_around(self.users[3].pk, size=2)
+        self.assertEqual([entry['rank'] for entry in around], [2, 3, 4, 5, 6])
+        self.assertEqual([entry['user_id'] for entry in around], [user.pk for user in self.users[1:6]])
+        # At the top of the board there is nobody above
+        self.assertEqual(len(leaderboards.get_around(self.users[0].pk, size=2)), 3)
+        self.assertEqual(leaderboards.get_around(self.users[0].pk + 1000), [])
+
+    def test_period_boards_count_recent_completions_only(self):
+        self.complete(self.users[0], self.quest)
+        self.complete(self.users[0], self.other)
+        self.complete(self.users[1], self.quest, days_ago=40)
+        self.complete(self.users[2], self.other)
+        leaderboards.rebuild_leaderboards()
+
+        for period in ('weekly', 'monthly'):
+            entries, size = leaderboards.get_top(period)
+            self.assertEqual(
+                [(entry['user_id'], entry['score']) for entry in entries],
+                [(self.users[0].pk, 55), (self.users[2].pk, 15)],
+            )
+            entries, _ = leaderboards.get_top(period, self.category.pk)
+            self.assertEqual([(entry['user_id'], entry['score']) for entry in entries], [(self.users[0].pk, 40)])
+        # The all-time category board also counts the old completion
+        entries, _ = leaderboards.get_top('all', self.category.pk)
+        self.assertEqual(
+            [(entry['user_id'], entry['score']) for entry in entries],
+            [(self.users[0].pk, 40), (self.users[1].pk, 40)],
+        )
+
+
+class GeohashTests(SimpleTestCase):
+    def test_encode(self):
+        self.assertEqual(geo.encode_geohash(57.64911, 10.40744), 'u4pruydqq')
+        self.assertEqual(geo.encode_geohash(10, 190, 5), geo.encode_geohash(10, -170, 5))
+
+    def test_bounding_box_edges(self):
+        # Across the antimeridian the box extends past 180 degrees
+        south, north, west, east = geo.bounding_box(0, 179.95, 20)
+        self.assertLess(west, 180)
+        self.assertGreater(east, 180)
+        # At the poles the box covers every longitude
+        self.assertEqual(geo.bounding_box(89.95, 0, 20)[1:], (90.0, None, None))
+        self.assertEqual(geo.bounding_box(-90, 0, 1)[0], -90.0)
+
+    def test_cells_cover_the_bounding_box(self):
+        for latitude, longitude, radius in [
+            (52.52, 13.40, 10), (0, 179.95, 20), (-16.5, -179.99, 30),
+            (89.95, 0, 20), (-89.99, 100, 5), (0, 0, 500),
+        ]:
+            with self.subTest(latitude=latitude, longitude=longitude, radius=radius):
+                cells = geo.covering_cells(latitude, longitude, radius)
+                self.assertLessEqual(len(cells), geo.MAX_COVERING_CELLS)
+                south, north, west, east = geo.bounding_box(latitude, longitude, radius)
+                if west is None:
+                    west, east = -180, 180
+                for point in [
+                    (south, west), (south, east), (north, west), (north, east),
+                    (latitude, west), (latitude, east), (south, longitude), (north, longitude),
+                ]:
+                    geohash = geo.encode_geohash(*point)
+                    self.assertTrue(
+                        any(geohash.startswith(cell) for cell in cells), f'{point} is not covered'
+                    )
+
+
+class NearFilterTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='scout', password='pass'))
+
+    def quest(self, title, latitude, longitude):
+        return Quest.objects.create(
+            title=title, description='d', quest_type='outdoor', difficulty=1,
+            duration_minutes=30, experience_reward=10, latitude=latitude, longitude=longitude,
+        )
+
+    def near(self, path, latitude, longitude, radius):
+        response = self.client.get(path, {'near': f'{latitude},{longitude}', 'radius': radius})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['results']
+
+    def test_radius_edge(self):
+        km_per_degree = math.pi * geo.EARTH_RADIUS_KM / 180
+        inside = self.quest('Inside', 48 + 9.9 / km_per_degree, 11)
+        self.quest('Outside', 48 + 10.1 / km_per_degree, 11)
+        [result] = self.near('/api/quests/', 48, 11, 10)
+        self.assertEqual(result['id'], inside.pk)
+        self.assertAlmostEqual(result['distance_km'], 9.9, places=3)
+
+    def test_across_the_antimeridian(self):
+        east = self.quest('East', -17, 179.95)
+        west = self.quest('West', -17, -179.95)
+        self.quest('Far', -17, 178)
+        results = self.near('/api/quests/', -17, 179.99, 20)
+        # Nearest first
+        self.assertEqual([result['id'] for result in results], [east.pk, west.pk])
+
+    def test_across_the_pole(self):
+        other_side = self.quest('Other side', 89.95, 170)
+        results = self.near('/api/quests/', 89.95, -10, 15)
+        self.assertEqual([result['id'] for result in results], [other_side.pk])
+        self.assertAlmostEqual(results[0]['distance_km'], 11.1, places=1)
+
+    def test_partnerships_are_located_by_their_organization(self):
+        quest = self.quest('Unlocated', None, None)
+        partnerships = [
+            Partnership.objects.create(
+                organization=PartnerOrganization.objects.create(
+                    name=name, description='d', contact_email=f'{name}@example.com',
+                    latitude=latitude, longitude=11,
+                ),
+                quest=quest, benefits='b', start_date=timezone.now().date(),
+            )
+            for name, latitude in [('near', 48.01), ('far', 49)]
+        ]
+        results = self.near('/api/partnerships/', 48, 11, 5)
+        self.assertEqual([result['id'] for result in results], [partnerships[0].pk])
+
+    def test_rejects_invalid_parameters(self):
+        for params in [
+            {'near': 'north'}, {'near': '91,0'}, {'near': '0,181'},
+            {'near': '0,0', 'radius': 0}, {'near': '0,0', 'radius': 501}, {'near': '0,0', 'radius': 'far'},
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get('/api/quests/', params).status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def increment(self, name, shards, amount=1):
+        with mock.patch.object(counters.random, 'randrange', side_effect=shards):
+            for _ in shards:
+                counters.increment(name, amount)
+
+    def rows(self, name):
+        return dict(CounterShard.objects.filter(name=name).values_list('shard', 'count'))
+
+    def test_increments_spread_over_shards(self):
+        self.increment('quest:1:started', [0, 3, 3, 15])
+        self.assertEqual(self.rows('quest:1:started'), {0: 1, 3: 2, 15: 1})
+        self.assertEqual(counters.get_counts(['quest:1:started']), {'quest:1:started': 4})
+
+    def test_page_counts_take_one_query_and_are_cached(self):
+        self.increment('quest:1:started', [1, 2])
+        self.increment('quest:2:started', [1], amount=5)
+        names = ['quest:1:started', 'quest:2:started', 'quest:3:started', 'quest:1:started']
+        expected = {'quest:1:started': 2, 'quest:2:started': 5, 'quest:3:started': 0}
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_counts(names), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_counts(names), expected)
+        self.assertEqual(counters.get_counts([]), {})
+
+    def test_compaction_keeps_concurrent_increments(self):
+        self.increment('quest:1:started', [0, 1, 2, 3])
+        self.increment('quest:2:started', [0, 1, 2, 3])
+        save = CounterShard.save
+
+        def save_and_increment(row, *args, **kwargs):
+            save(row, *args, **kwargs)
+            # Another request bumps a counter the compaction has not reached yet
+            if row.name == 'quest:1:started':
+                self.increment('quest:2:started', [7], amount=5)
+
+        with mock.patch.object(CounterShard, 'save', save_and_increment):
+            self.assertEqual(counters.compact_counters(batch_size=1), 7)
+        self.assertEqual(self.rows('quest:1:started'), {0: 4})
+        self.assertEqual(self.rows('quest:2:started'), {0: 9})
+
+        # Increments after compaction land on shards that were folded away
+        self.increment('quest:1:started', [3])
+        cache.clear()
+        self.assertEqual(counters.get_counts(['quest:1:started'])['quest:1:started'], 5)
+        self.assertEqual(counters.compact_counters(), 1)
+
+
+class DeferTests(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def record(self, *args):
+        self.calls.append(args)
+
+    def test_duplicates_run_once_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for quest_id in (1, 2, 1, 1):
+                    defer(self.record, quest_id)
+                defer(self.record, 1, 'other')
+                self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, [(1,), (2,), (1, 'other')])
+
+    def test_work_is_dropped_with_a_rolled_back_savepoint(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            defer(self.record, 1)
+            try:
+                with transaction.atomic():
+                    defer(self.record, 1)
+                    defer(self.record, 2)
+                    raise RuntimeError('rolled back')
+            except RuntimeError:
+                pass
+        # Registered before the savepoint, so it still runs, once
+        self.assertEqual(self.calls, [(1,)])
+
+    def test_failures_do_not_stop_later_work(self):
+        def fail():
+            raise RuntimeError('cache down')
+
+        with self.assertLogs('api.deferred', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                defer(fail)
+                defer(self.record, 1)
+        self.assertEqual(self.calls, [(1,)])
+
+    def test_next_transaction_runs_the_work_again(self):
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                defer(self.record, 1)
+        self.assertEqual(self.calls, [(1,), (1,)])
+
+
+class AutocommitDeferTests(TransactionTestCase):
+    def test_runs_immediately_outside_a_transaction(self):
+        calls = []
+        defer(calls.append, 1)
+        defer(calls.append, 1)
+        self.assertEqual(calls, [1, 1])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, REFERENCE_CACHE_VERSION_CHECK_SECONDS=60)
+class ReferenceCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(refcache, 'reference_cache', refcache.ReferenceCache())
+        self.local = patcher.start()
+        self.addCleanup(patcher.stop)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category = Category.objects.create(name='Forest')
+
+    def names(self, reference_cache=None):
+        return [category.name for category in (reference_cache or self.local).get('categories')]
+
+    def test_reads_fall_through_l1_and_l2(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.names(), ['Forest'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(), ['Forest'])
+        # Another process finds the set in the shared cache
+        other = refcache.ReferenceCache()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(other), ['Forest'])
+        self.assertEqual(
+            (self.local.stats['categories'], other.stats['categories']),
+            (
+                {'l1_hits': 1, 'l2_hits': 0, 'misses': 1, 'evictions': 0},
+                {'l1_hits': 0, 'l2_hits': 1, 'misses': 0, 'evictions': 0},
+            ),
+        )
+
+    def test_invalidate_for_retires_both_tiers(self):
+        other = refcache.ReferenceCache()
+        self.names()
+        self.names(other)
+        Category.objects.filter(pk=self.category.pk).update(name='Woods')
+
+        refcache.invalidate_for(Category)
+        self.assertEqual(self.names(), ['Woods'])
+        # Other processes keep their L1 until they check the versions again
+        self.assertEqual(self.names(other), ['Forest'])
+        with self.settings(REFERENCE_CACHE_VERSION_CHECK_SECONDS=0):
+            self.assertEqual(self.names(other), ['Woods'])
+
+    def test_saving_a_category_invalidates_once_committed(self):
+        self.names()
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Lake')
+            self.assertEqual(self.names(), ['Forest'])
+        self.assertEqual(sorted(self.names()), ['Forest', 'Lake'])
+
+    def test_local_cache_evicts_least_recently_used(self):
+        lru = refcache.LocalLRU(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        self.assertEqual(lru.set('c', 3), ['b'])
+        self.assertEqual((lru.get('a'), lru.get('b')), ((True, 1), (False, None)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedCategoryFieldTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(refcache, 'reference_cache', refcache.ReferenceCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.category = Category.objects.create(name='Desert')
+        self.field = CachedCategoryField(queryset=Category.objects.all())
+
+    def test_known_ids_are_resolved_from_the_cache(self):
+        self.assertEqual(self.field.to_internal_value(self.category.pk), self.category)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.field.to_internal_value(str(self.category.pk)), self.category)
+
+    def test_rejects_unknown_and_malformed_ids(self):
+        for value, code in [
+            (self.category.pk + 1, 'does_not_exist'), (True, 'incorrect_type'),
+            ('desert', 'incorrect_type'), (None, 'incorrect_type'),
+        ]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValidationError) as raised:
+                    self.field.to_internal_value(value)
+                self.assertEqual(raised.exception.get_codes(), [code])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WarmupTests(TransactionTestCase):
+    # The tasks run in worker threads, which only see committed rows
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        # Keep what the tasks load out of the other tests' process state
+        for patcher in [
+            mock.patch.object(refcache, 'reference_cache', refcache.ReferenceCache()),
+            mock.patch.object(warmup, 'get_facet_index'),
+            mock.patch.object(warmup, 'get_feature_matrix'),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        Category.objects.create(name='Forest')
+        Quest.objects.create(
+            title='Forest walk', description='d', quest_type='outdoor',
+            difficulty=1, duration_minutes=30, experience_reward=10,
+        )
+
+    def test_failed_tasks_do_not_stop_the_others(self):
+        def fail():
+            raise RuntimeError('no cache')
+
+        with self.assertLogs('api.warmup', 'WARNING'):
+            results = warmup.run_tasks({'ok': lambda: None, 'broken': fail, 'also ok': lambda: None}, 2)
+        self.assertEqual([(name, error) for name, _, error in results], [
+            ('ok', None), ('broken', 'no cache'), ('also ok', None),
+        ])
+
+    def test_pages_are_only_warmed_with_a_user(self):
+        names = [name for name, _, _ in warmup.warm(concurrency=2)]
+        self.assertEqual(names, list(warmup.process_tasks()))
+
+        User.objects.create_user('warmer', 'warmer@example.com', 'pw')
+        names = [name for name, _, _ in warmup.warm(concurrency=2)]
+        self.assertIn('catalog page 1', names)
+        # There are not enough quests for a second page
+        self.assertNotIn('catalog page 2', names)
+        self.assertIn(f'leaderboard {leaderboards.PERIODS[0]} category {Category.objects.get().pk}', names)
+
+    def test_command_warms_every_cache(self):
+        User.objects.create_user('warmer', 'warmer@example.com', 'pw')
+        out = StringIO()
+        call_command('warm_caches', '--concurrency', '2', '--fail-on-error', stdout=out)
+
+        self.assertRegex(out.getvalue(), r'Warmed (\d+) of \1 caches')
+        # The reference sets are served from memory now
+        with self.assertNumQueries(0):
+            self.assertEqual([category.name for category in refcache.categories()], ['Forest'])
+
+    def test_command_fails_on_errors_when_asked(self):
+        with mock.patch.object(warmup, 'get_feature_matrix', side_effect=RuntimeError('no numpy')), \
+                self.assertLogs('api.warmup', 'WARNING'):
+            with self.assertRaisesMessage(CommandError, 'Warmed 4 of 5 caches'):
+                call_command('warm_caches', '--fail-on-error', stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, '--concurrency must be at least 1'):
+            call_command('warm_caches', '--concurrency', '0', stdout=StringIO())
+
+
+class DatabasePoolTests(SimpleTestCase):
+    stats = {
+        'default': {
+            'pool_size': 4, 'pool_available': 1, 'pool_max': 4, 'requests_waiting': 2,
+            'requests_num': 10, 'requests_wait_ms': 1500, 'requests_errors': 1,
+        },
+    }
+
+    def test_pools_are_sized_by_role(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(
+                (db_pool.pool_options('web')['max_size'], db_pool.pool_options('worker')['max_size']), (4, 2)
+            )
+        with mock.patch.dict(os.environ, {'DB_POOL_MIN_SIZE': '3', 'DB_POOL_MAX_SIZE': '2'}):
+            options = db_pool.pool_options('worker')
+        # The maximum never drops below the minimum
+        self.assertEqual((options['min_size'], options['max_size']), (3, 3))
+
+    def test_configure_sizes_pooled_databases_only(self):
+        databases = {'pooled': {'OPTIONS': {'pool': {'max_size': 99}}}, 'plain': {'OPTIONS': {}}}
+        with mock.patch.dict(settings.DATABASES, databases), mock.patch.dict(os.environ, {}, clear=True):
+            db_pool.configure('worker')
+        self.assertEqual(databases['pooled']['OPTIONS']['pool']['max_size'], 2)
+        self.assertEqual(databases['plain'], {'OPTIONS': {}})
+
+    @skipUnless(prometheus_client, 'prometheus_client is not installed')
+    def test_collector_reports_utilisation_and_waits(self):
+        with mock.patch.object(db_pool, 'pool_stats', return_value=self.stats):
+            samples = {
+                sample.name: sample.value
+                for family in db_pool.PoolCollector().collect() for sample in family.samples
+            }
+        self.assertEqual(samples['db_pool_utilisation'], 0.75)
+        self.assertEqual(samples['db_pool_requests_waiting'], 2)
+        self.assertEqual(samples['db_pool_wait_seconds_total'], 1.5)
+        self.assertEqual(samples['db_pool_errors_total'], 1)
+
+    def test_stats_are_logged_by_workers(self):
+        with mock.patch.object(db_pool, 'pool_stats', return_value=self.stats), \
+                mock.patch.object(db_pool, 'logger') as logger:
+            db_pool.log_pool_stats(force=True)
+        self.assertIn(
+            '3/4 in use, 2 waiting, 1500 ms waited over 10 requests, 1 errors', logger.info.call_args.args[0]
+        )
+
+class NotificationEmailTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        patcher = mock.patch.object(tasks, 'render_to_string', return_value='Quest completed')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sent_to_the_users_address(self):
+        user = User.objects.create_user('mailed', 'mailed@example.com', 'pw')
+        tasks.send_notification_email(user.pk, 'subject.txt', 'message.txt')
+        self.assertEqual(mail.outbox[-1].to, ['mailed@example.com'])
+
+    def test_sent_to_a_given_address_without_a_user(self):
+        tasks.send_notification_email(None, 'subject.txt', 'message.txt', email='erased@example.com')
+        self.assertEqual(mail.outbox[-1].to, ['erased@example.com'])
+
+    def test_needs_a_recipient(self):
+        with mock.patch.object(tasks.send_notification_email, 'retry') as retry:
+            with self.assertRaisesMessage(ValueError, 'needs a user_id or an email'):
+                tasks.send_notification_email(None, 'subject.txt', 'message.txt')
+        retry.assert_not_called()
+        self.assertEqual(mail.outbox, [])
+
+
+class StalledErasureTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='leaver', password='pass')
+        self.erasure = erasure.request_erasure(self.user)
+        # The worker picked it up, then died
+        self.erasure.status = 'running'
+        self.erasure.started_at = timezone.now()
+        self.erasure.save()
+        OutboxMessage.objects.all().delete()
+
+    def stall(self):
+        AccountErasure.objects.filter(pk=self.erasure.pk).update(
+            started_at=timezone.now() - erasure.ERASURE_STALL_TIMEOUT - timedelta(minutes=1)
+        )
+
+    def queued(self):
+        return list(OutboxMessage.objects.filter(task_name='api.tasks.erase_account').values_list('args', flat=True))
+
+    def test_running_erasures_are_left_alone(self):
+        erasure.request_erasure(self.user)
+        self.assertEqual(erasure.resume_stalled_erasures(), 0)
+        self.assertEqual(self.queued(), [])
+
+    def test_new_request_restarts_a_stalled_erasure(self):
+        self.stall()
+        erasure.request_erasure(self.user)
+        self.assertEqual(self.queued(), [[self.erasure.pk]])
+        # Its clock restarted, so it is not queued twice
+        self.assertEqual(erasure.resume_stalled_erasures(), 0)
+
+    def test_resume_stalled_erasures(self):
+        self.stall()
+        self.assertEqual(erasure.resume_stalled_erasures(), 1)
+        self.assertEqual(self.queued(), [[self.erasure.pk]])
+        self.assertEqual(erasure.resume_stalled_erasures(), 0)
+
+        erasure.erase(self.erasure.pk)
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+
+
+class QuestFeatureMatrixTests(SimpleTestCase):
+    def setUp(self):
+        self.matrix = recommendations.QuestFeatureMatrix(
+            [1, 2, 3], np.eye(3, dtype=np.float32), np.asarray([0, 0.5, 0.2], dtype=np.float32)
+        )
+
+    def top(self, history, excluded=()):
+        scores = self.matrix.score([history], [set(excluded)])
+        return self.matrix.top_n(scores, 3)[0]
+
+    def test_similar_quests_rank_first(self):
+        self.assertEqual(self.top({1: 1.0}), [1, 2, 3])
+
+    def test_disliked_quests_rank_last(self):
+        self.assertEqual(self.top({1: -0.3}), [2, 3, 1])
+
+    def test_excluded_quests_are_never_returned(self):
+        self.assertEqual(self.top({1: 1.0}, excluded={1}), [2, 3])
+
+    def test_empty_history_ranks_by_popularity(self):
+        self.assertEqual(self.top({}), [2, 3, 1])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RecommendationTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        recommendations._matrix = None
+        self.addCleanup(setattr, recommendations, '_matrix', None)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users = [
+                User.objects.create_user(f'walker{number}', f'walker{number}@example.com', 'pass')
+                for number in range(3)
+            ]
+            self.trail, self.ridge, self.gym = [
+                Quest.objects.create(
+                    title=title, description='d', quest_type=quest_type,
+                    difficulty=difficulty, duration_minutes=60, experience_reward=10,
+                )
+                for title, quest_type, difficulty in [
+                    ('Trail', 'outdoor', 1), ('Ridge', 'outdoor', 1), ('Gym', 'indoor', 4),
+                ]
+            ]
+        self.user = self.users[0]
+        self.set_status(self.trail, 'completed')
+
+    def set_status(self, quest, status):
+        with self.captureOnCommitCallbacks(using=sharding.shard_for_user(self.user.pk), execute=True):
+            UserQuestProgress.objects.for_user(self.user).filter(quest=quest).delete()
+            UserQuestProgress.objects.create(user=self.user, quest=quest, status=status)
+
+    def test_recommends_quests_like_the_completed_ones(self):
+        self.assertEqual(
+            recommendations.get_recommendations(self.user), [self.ridge.pk, self.gym.pk]
+        )
+
+    def test_progress_change_drops_the_cached_list(self):
+        recommendations.get_recommendations(self.user)
+        self.set_status(self.ridge, 'in_progress')
+        self.assertEqual(recommendations.get_recommendations(self.user), [self.gym.pk])
+
+    def test_precompute_walks_users_in_chunks(self):
+        with mock.patch.object(
+            recommendations, 'recommend_for_users', wraps=recommendations.recommend_for_users
+        ) as recommend:
+            self.assertEqual(recommendations.precompute_recommendations(chunk_size=2), 3)
+        self.assertEqual(
+            [call.args[0] for call in recommend.call_args_list],
+            [[user.pk for user in self.users[:2]], [self.users[2].pk]],
+        )
+        # Served from the cache without scoring again
+        with mock.patch.object(recommendations, 'recommend_for_users') as recommend:
+            self.assertEqual(
+                recommendations.get_recommendations(self.user), [self.ridge.pk, self.gym.pk]
+            )
+        recommend.assert_not_called()
+
+    def test_only_feature_edits_retire_the_lists(self):
+        version = recommendations._current_version()
+        self.ridge.title = 'High ridge'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ridge.save()
+        self.assertEqual(recommendations._current_version(), version)
+
+        self.ridge.difficulty = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ridge.save()
+        self.assertNotEqual(recommendations._current_version(), version)
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FacetTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        facets.invalidate_facet_index()
+        self.addCleanup(facets.invalidate_facet_index)
+        self.user = User.objects.create_user(username='browser', password='pass')
+        for title, quest_type, difficulty in [
+            ('Forest walk', 'outdoor', 1), ('River walk', 'outdoor', 2), ('Trivia night', 'indoor', 1),
+        ]:
+            Quest.objects.create(
+                title=title, description='d', quest_type=quest_type,
+                difficulty=difficulty, duration_minutes=30, experience_reward=10,
+            )
+
+    def get(self, **params):
+        request = APIRequestFactory().get('/api/quests/facets/', params)
+        force_authenticate(request, user=self.user)
+        return QuestViewSet.as_view({'get': 'facets'})(request)
+
+    def test_counts_leave_out_their_own_selection(self):
+        data = self.get(quest_type='indoor', difficulty='1').data
+        self.assertEqual([quest['title'] for quest in data['results']], ['Trivia night'])
+        self.assertEqual(data['facets']['quest_type'], {'outdoor': 1, 'indoor': 1})
+        self.assertEqual(data['facets']['difficulty'], {'1': 1, '2': 0})
+
+    def test_several_values_of_a_facet(self):
+        response = self.get(quest_type='outdoor,indoor', difficulty='2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([quest['title'] for quest in response.data['results']], ['River walk'])
+
+    def test_counts_apply_the_other_filters(self):
+        data = self.get(search='walk', quest_type='indoor').data
+        self.assertEqual(data['results'], [])
+        self.assertEqual(data['facets']['quest_type'], {'outdoor': 2, 'indoor': 0})
+        self.assertEqual(data['facets']['difficulty'], {'1': 0, '2': 0})
+
+    def test_evicted_version_does_not_revive_a_stale_index(self):
+        stale = facets.get_facet_index()
+        cache.delete(facets.FACET_VERSION_KEY)
+        # Another worker changes the catalog while this one keeps its index
+        facets.invalidate_facet_index()
+        facets._index = stale
+        self.assertIsNot(facets.get_facet_index(), stale)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StampedeTests(SimpleTestCase):
+    key = 'probe:page'
+
+    def setUp(self):
+        cache.clear()
+        self.compute = mock.Mock(return_value='new')
+
+    def fetch(self):
+        return stampede.fetch(self.key, self.compute, 60)
+
+    def cache_stale(self):
+        cache.set(self.key, ('old', time.time() - 1, 0.01), 60)
+
+    def test_fresh_entries_are_computed_once(self):
+        self.assertEqual([self.fetch(), self.fetch()], ['new', 'new'])
+        self.compute.assert_called_once()
+
+    def test_stale_entry_is_refreshed_by_the_lock_holder(self):
+        self.cache_stale()
+        self.assertEqual(self.fetch(), 'new')
+        self.assertFalse(cache.get(stampede.LOCK_KEY.format(key=self.key)))
+
+    def test_stale_entry_is_served_while_another_worker_refreshes(self):
+        self.cache_stale()
+        cache.add(stampede.LOCK_KEY.format(key=self.key), 1)
+        self.assertEqual(self.fetch(), 'old')
+        self.compute.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMPRESSION_MIN_SIZE=100)
+class CompressionMiddlewareTests(SimpleTestCase):
+    body = b'{"results": [%s]}' % b','.join([b'{"title": "Forest walk"}'] * 50)
+
+    def setUp(self):
+        cache.clear()
+        self.middleware = compression.CompressionMiddleware(lambda request: None)
+
+    def respond(self, body=None, accept_encoding='gzip', shared=False):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        response = HttpResponse(self.body if body is None else body, content_type='application/json')
+        response['ETag'] = '"v1"'
+        if shared:
+            compression.cache_variants(response)
+        return self.middleware.process_response(request, response)
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate('deflate, gzip;q=0.5'), 'gzip')
+        self.assertIsNone(compression.negotiate('gzip;q=0, identity'))
+        self.assertIsNone(compression.negotiate(''))
+
+    def test_compresses_large_bodies(self):
+        response = self.respond()
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.body)
+        self.assertEqual(response['ETag'], 'W/"v1"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_small_bodies_and_unwilling_clients_get_the_body_as_is(self):
+        for response in [self.respond(body=b'{}'), self.respond(accept_encoding='identity')]:
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_shared_pages_are_compressed_once(self):
+        gzip_compress = mock.Mock(wraps=compression.gzip_compress)
+        with mock.patch.dict(compression.ENCODERS, gzip=gzip_compress):
+            first, second = self.respond(shared=True), self.respond(shared=True)
+        gzip_compress.assert_called_once()
+        self.assertEqual(first.content, second.content)
+
+
+@override_settings(DATABASE_SHARDS=['shard1', 'shard2'])
+class ShardingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            # Users below bucket 512 live on the first shard, the rest on the second
+            self.near = User.objects.create_user('near', 'near@example.com', 'pass', id=5)
+            self.far = User.objects.create_user('far', 'far@example.com', 'pass', id=600)
+            self.quest = Quest.objects.create(
+                title='Ridge', description='d', quest_type='outdoor',
+                difficulty=1, duration_minutes=30, experience_reward=10,
+            )
+            for user in (self.near, self.far):
+                UserQuestProgress.objects.create(user=user, quest=self.quest, status='in_progress')
+
+    def on(self, alias, model=UserQuestProgress):
+        return sorted(model.objects.using(alias).values_list('user_id', flat=True))
+
+    def test_users_map_to_shards_by_bucket(self):
+        self.assertEqual(sharding.shard_for_user(5), 'shard1')
+        self.assertEqual(sharding.shard_for_user(600), 'shard2')
+        self.assertEqual(sharding.shard_for_user(sharding.SHARD_BUCKETS + 5), 'shard1')
+        self.assertEqual(sharding.group_by_shard([5, 600, 700]), {'shard1': [5], 'shard2': [600, 700]})
+
+    def test_rows_are_saved_on_the_owners_shard(self):
+        self.assertEqual(self.on('shard1'), [5])
+        self.assertEqual(self.on('shard2'), [600])
+        self.assertEqual(self.on('default'), [])
+
+    def test_for_user_reads_the_owners_shard(self):
+        progress = UserQuestProgress.objects.for_user(self.far)
+        self.assertEqual(progress.db, 'shard2')
+        row = progress.get()
+        self.assertEqual(row.user_id, 600)
+        # Related lookups go to the owner's shard, catalog lookups to the shared database
+        self.assertEqual(list(self.far.quest_progress.all()), [row])
+        self.assertEqual(row.quest, self.quest)
+        self.assertEqual(row.user, self.far)
+
+    def test_router_migrates_per_user_tables_to_the_shards_only(self):
+        self.assertTrue(router.allow_migrate('shard1', 'api', model_name='userquestprogress'))
+        self.assertFalse(router.allow_migrate('shard1', 'api', model_name='quest'))
+        self.assertFalse(router.allow_migrate('default', 'api', model_name='userquestprogress'))
+        self.assertTrue(router.allow_migrate('default', 'api', model_name='quest'))
+
+    def test_deleting_a_user_removes_their_rows_from_their_shard(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.far.delete()
+        self.assertEqual(self.on('shard2'), [])
+        self.assertEqual(self.on('shard1'), [5])
+
+    def test_deleting_a_quest_removes_its_rows_from_every_shard(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.quest.delete()
+        self.assertEqual(self.on('shard1'), [])
+        self.assertEqual(self.on('shard2'), [])
+
+    def test_catalog_reads_progress_only_for_the_status_filter(self):
+        client = APIClient()
+        client.force_authenticate(self.near)
+        with self.assertNumQueries(0, using='shard1'):
+            response = client.get('/api/quests/')
+        self.assertEqual(response.status_code, 200)
+
+        response = client.get('/api/quests/', {'user_status': 'in_progress'})
+        self.assertEqual([quest['id'] for quest in response.data['results']], [self.quest.pk])
+        response = client.get('/api/quests/', {'user_status': 'not_started'})
+        self.assertEqual(response.data['results'], [])
@@ -1,29 +1,42 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
 from . import views
+from .async_views import live_stream
 
 # Create a router and register our viewsets with it
 router = DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'categories', views.CategoryViewSet)
 router.register(r'quests', views.QuestViewSet)
-router.register(r'challenges', views.ChallengeViewSet)
+router.register(r'challenges', views.ChallengeViewSet, basename='challenge')
 router.register(r'quest-progress', views.UserQuestProgressViewSet, basename='questprogress')
 router.register(r'challenge-completions', views.UserChallengeCompletionViewSet, basename='challengecompletion')
 router.register(r'partners', views.PartnerOrganizationViewSet)
-router.register(r'partnerships', views.PartnershipViewSet)
+router.register(r'partnerships', views.PartnershipViewSet, basename='partnership')
+router.register(r'leaderboards', views.LeaderboardViewSet, basename='leaderboard')
 
 # The API URLs are now determined automatically by the router
 urlpatterns = [
+    # Server-sent live updates (see api.live)
+    path('users/me/live/', live_stream, name='live-stream'),
     path('', include(router.urls)),
     
     # Include authentication URLs for the browsable API
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     
     # JWT Authentication endpoints
-    path('auth/', include('rest_framework_simplejwt.urls')),
+    path('auth/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('auth/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
 ]
 
+# Hot read endpoints served by async views take precedence (see api.async_views)
+if settings.ASYNC_READ_VIEWS:
+    from .async_views import urlpatterns as async_urlpatterns
+    urlpatterns = async_urlpatterns + urlpatterns
+
 # Add a root view for the API
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
@@ -38,6 +51,7 @@ def api_root(request, format=None):
         'challenges': reverse('challenge-list', request=request, format=format),
         'partners': reverse('partnerorganization-list', request=request, format=format),
         'partnerships': reverse('partnership-list', request=request, format=format),
+        'leaderboards': reverse('leaderboard-list', request=request, format=format),
         'documentation': 'https://github.com/yourusername/napoleon-api/docs',
     })
 
@@ -1,27 +1,219 @@
+import hashlib
+
 from rest_framework import viewsets, status, permissions, generics, filters
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.parsers import MultiPartParser, JSONParser
+from rest_framework.parsers import MultiPartParser
+from rest_framework.settings import api_settings
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import F, Case, When, Value, IntegerField, BooleanField, Q, CharField
+from django.db.models import F, Case, When, Value, IntegerField, Q, CharField
 from django.contrib.auth import get_user_model
+from django.http import Http404
+from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
 from .models import (
     Category, Quest, Challenge, 
     UserQuestProgress, UserChallengeCompletion,
-    PartnerOrganization, Partnership
+    ArchivedQuestProgress, ArchivedChallengeCompletion,
+    PartnerOrganization, Partnership, ProgressEvent
 )
+from .authentication import full_user
+from .erasure import request_erasure
+from .facets import FACET_FIELDS, get_facet_index
+from . import leaderboards
+from .filters import ChallengeQuestFilter, NearFilter
+from . import events, refcache, replicas, stampede
+from .compression import cache_variants
+from .parsers import MessagePackParser, ORJSONParser
+from .recommendations import DEFAULT_TOP_N, get_recommendations
+from .xp import level_for_xp, pending_xp
 from .serializers import (
     UserSerializer, CategorySerializer, QuestSerializer, ChallengeSerializer,
     UserQuestProgressSerializer, UserChallengeCompletionSerializer,
-    PartnerOrganizationSerializer, PartnershipSerializer
+    PartnerOrganizationSerializer, PartnershipSerializer, LeaderboardEntrySerializer
 )
 
 User = get_user_model()
 
-class UserViewSet(viewsets.ModelViewSet):
+# Seconds a leaderboard page may lag behind XP awards
+LEADERBOARD_PAGE_TIMEOUT = 10
+
+def progress_statuses(model, user):
+    """(quest id, status) pairs of the user's ``model`` rows, oldest first"""
+    return model.objects.for_user(user).order_by('id').values_list('quest_id', 'status')
+
+class ReplicaReadMixin:
+    """
+    Serve safe requests from the read replicas.
+
+    A user who has just written through the API is pinned to the primary for a
+    short while, so they always read their own writes. Views opt out with
+    ``read_from_replica = False``, or per action by overriding
+    ``get_read_from_replica``.
+    """
+    read_from_replica = True
+
+    def get_read_from_replica(self):
+        return self.read_from_replica
+
+    def dispatch(self, request, *args, **kwargs):
+        self._replica_token = None
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # finalize_response is skipped when an unhandled exception propagates,
+            # and the flag would outlive the request on this thread
+            self._end_replica_reads()
+
+    def _end_replica_reads(self):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            replicas.end_replica_reads(token)
+            self._replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Authentication has run, so pins of the request's user are visible
+        read_replica = (
+            request.method in permissions.SAFE_METHODS
+            and self.get_read_from_replica()
+            and not replicas.is_pinned(request.user)
+        )
+        if read_replica:
+            self._replica_token = replicas.start_replica_reads()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self._end_replica_reads()
+        if request.method not in permissions.SAFE_METHODS and response.status_code < 400:
+            if request.user.is_authenticated:
+                replicas.pin_to_primary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+class ReferenceListMixin:
+    """
+    Serve unfiltered lists from a cached reference set (see ``api.refcache``).
+
+    ``reference_set`` names the ``refcache`` function returning the rows of the
+    list, in the order the viewset would list them. Requests with filter,
+    search or ordering parameters go to the database as usual.
+    """
+    reference_set = None
+
+    def list(self, request, *args, **kwargs):
+        params = set(request.query_params) - {'format'}
+        if self.paginator is not None:
+            params.discard(self.paginator.page_query_param)
+        if self.reference_set is None or params:
+            return super().list(request, *args, **kwargs)
+
+        rows = getattr(refcache, self.reference_set)()
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return cache_variants(self.get_paginated_response(self.get_serializer(page, many=True).data))
+        return cache_variants(Response(self.get_serializer(rows, many=True).data))
+
+def list_page_key(prefix, request, *parts):
+    """Cache key of the page ``request`` asks for, under ``prefix`` and ``parts``"""
+    uri = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return ':'.join([prefix, *map(str, parts), uri])
+
+class CachedListMixin:
+    """
+    Serve list pages shared by every user from the cache (see ``api.stampede``).
+
+    ``list_cache_key`` returns the key of a request's page, or ``None`` when the
+    page depends on the user. Pages stay fresh for ``list_cache_timeout``
+    seconds, and only one worker at a time rebuilds an expired page. Their
+    compressed bodies are cached too (see ``api.compression``).
+    """
+    list_cache_timeout = 30
+
+    def list_cache_key(self, request):
+        return None
+
+    def list(self, request, *args, **kwargs):
+        key = self.list_cache_key(request)
+        if key is None:
+            return super().list(request, *args, **kwargs)
+        parent = super()
+
+        def compute():
+            # A lagging replica would cache an old page for every user
+            with replicas.replica_reads(False):
+                return parent.list(request, *args, **kwargs).data
+
+        data = stampede.fetch(key, compute, self.list_cache_timeout)
+        return cache_variants(Response(data))
+
+
+class ArchiveFallbackMixin:
+    """
+    Serve a history endpoint from its hot table and its archive together.
+
+    Lists merge both tables in the requested order, and detail reads fall back
+    to the archive, so clients never see where a row is stored. Archived rows
+    are read-only.
+    """
+    archive_model = None
+
+    def get_archive_queryset(self):
+        if self.request.user.is_staff:
+            return self.archive_model.objects.all()
+        return self.archive_model.objects.for_user(self.request.user)
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            if self.request.method not in permissions.SAFE_METHODS:
+                raise
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        obj = get_object_or_404(
+            self.filter_queryset(self.get_archive_queryset()),
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        )
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def merge_querysets(self, hot, archived):
+        """
+        Return ``(archived, id, ...)`` rows of both tables in the requested order.
+
+        Pages are taken over these keys first, and only the page's rows loaded.
+        """
+        ordering = [
+            {'pk': 'id', '-pk': '-id'}.get(field, field) for field in hot.query.order_by
+        ]
+        if not {'id', '-id'} & set(ordering):
+            ordering.append('-id')
+        columns = list(dict.fromkeys(['id', *(field.lstrip('-') for field in ordering)]))
+        return hot.order_by().annotate(archived=Value(False)).values_list('archived', *columns).union(
+            archived.order_by().annotate(archived=Value(True)).values_list('archived', *columns),
+            all=True
+        ).order_by(*ordering)
+
+    def list(self, request, *args, **kwargs):
+        hot = self.filter_queryset(self.get_queryset())
+        archived = self.filter_queryset(self.get_archive_queryset())
+        merged = self.merge_querysets(hot, archived)
+        page = self.paginate_queryset(merged)
+        keys = merged if page is None else page
+        hot_rows = hot.in_bulk([key[1] for key in keys if not key[0]])
+        archived_rows = archived.in_bulk([key[1] for key in keys if key[0]])
+        objects = [
+            (archived_rows if key[0] else hot_rows).get(key[1]) for key in keys
+        ]
+        serializer = self.get_serializer([obj for obj in objects if obj is not None], many=True)
+        if page is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
+
+class UserViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for managing users"""
+    # Accounts also change outside their owner's requests (XP awards, erasure)
+    read_from_replica = False
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -41,11 +233,27 @@ class UserViewSet(viewsets.ModelViewSet):
             return User.objects.all()
         return User.objects.filter(id=self.request.user.id)
 
+    def destroy(self, request, *args, **kwargs):
+        """Deactivate the account now and erase its data in the background"""
+        erasure = request_erasure(self.get_object())
+        return Response(
+            {'erasure_id': erasure.id, 'status': erasure.status},
+            status=status.HTTP_202_ACCEPTED
+        )
+
     @action(detail=False, methods=['get'])
     def me(self, request):
         """Retrieve the current user's profile"""
-        serializer = UserSerializer(request.user)
-        return Response(serializer.data)
+        # Requests authenticate with a slim user
+        serializer = UserSerializer(full_user(request.user))
+        data = serializer.data
+        
+        # Include XP awarded but not yet flushed to the user row
+        pending = pending_xp(request.user.id)
+        if pending:
+            data['experience_points'] += pending
+            data['level'] = level_for_xp(data['experience_points'])
+        return Response(data)
 
     @action(detail=True, methods=['post'])
     def set_password(self, request, pk=None):
@@ -68,11 +276,12 @@ class UserViewSet(viewsets.ModelViewSet):
             )
         
         user.set_password(password)
-        user.save()
+        user.save(update_fields=['password'])
         return Response({"status": "password set"})
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(ReferenceListMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for managing categories"""
+    reference_set = 'categories'
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -80,12 +289,12 @@ class CategoryViewSet(viewsets.ModelViewSet):
     search_fields = ['name', 'description']
     ordering_fields = ['name']
 
-class QuestViewSet(viewsets.ModelViewSet):
+class QuestViewSet(CachedListMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for managing quests"""
     queryset = Quest.objects.all()
     serializer_class = QuestSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter, NearFilter]
     filterset_fields = ['quest_type', 'difficulty', 'is_active']
     search_fields = ['title', 'description']
     ordering_fields = ['title', 'difficulty', 'created_at']
@@ -94,39 +303,59 @@ class QuestViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Filter quests based on user's progress"""
         queryset = super().get_queryset()
-        
-        # Filter by user progress status if specified
+        # Only the ?user_status filter needs the user's progress; loading it
+        # on every request would put all of it into each catalog query
+        if self.request.user.is_authenticated and 'user_status' in self.request.query_params:
+            queryset = self.with_user_status(
+                queryset,
+                list(progress_statuses(UserQuestProgress, self.request.user)),
+                list(progress_statuses(ArchivedQuestProgress, self.request.user))
+            )
+        return queryset
+
+    def list_cache_key(self, request):
+        # The user's progress only filters the catalog; pages without that filter are shared
+        if 'user_status' in request.query_params:
+            return None
+        return list_page_key('catalog', request, stampede.version('catalog'))
+
+    def with_user_status(self, queryset, progress, archived):
+        """
+        Filter by ``?user_status`` and annotate quests with the user's status.
+
+        Progress lives on the user's shard, so it is passed in as (quest id,
+        status) pairs of the hot table and the archive instead of being joined.
+        """
         status_filter = self.request.query_params.get('user_status')
-        if status_filter and self.request.user.is_authenticated:
-            if status_filter == 'in_progress':
-                in_progress_quests = UserQuestProgress.objects.filter(
-                    user=self.request.user,
-                    status='in_progress'
-                ).values_list('quest_id', flat=True)
-                queryset = queryset.filter(id__in=in_progress_quests)
-            elif status_filter == 'completed':
-                completed_quests = UserQuestProgress.objects.filter(
-                    user=self.request.user,
-                    status='completed'
-                ).values_list('quest_id', flat=True)
-                queryset = queryset.filter(id__in=completed_quests)
-            elif status_filter == 'not_started':
-                started_quests = UserQuestProgress.objects.filter(
-                    user=self.request.user
-                ).values_list('quest_id', flat=True)
-                queryset = queryset.exclude(id__in=started_quests)
-        
-        # Annotate with user's progress status if authenticated
-        if self.request.user.is_authenticated:
-            queryset = queryset.annotate(
-                user_status=Case(
-                    When(user_progress__user=self.request.user, then=F('user_progress__status')),
-                    default=Value('not_started'),
-                    output_field=CharField()
-                )
+        if status_filter == 'in_progress':
+            queryset = queryset.filter(
+                id__in=[quest_id for quest_id, status in progress if status == 'in_progress']
             )
+        elif status_filter == 'completed':
+            # Quests completed long ago live in the archive
+            queryset = queryset.filter(
+                id__in={quest_id for quest_id, status in [*progress, *archived] if status == 'completed'}
+            )
+        elif status_filter == 'not_started':
+            queryset = queryset.exclude(id__in={quest_id for quest_id, _ in [*progress, *archived]})
         
-        return queryset
+        # The hot row wins over the archive, which is only consulted for quests
+        # without one
+        statuses = dict(archived)
+        statuses.update(progress)
+        quests_by_status = {}
+        for quest_id, user_status in statuses.items():
+            quests_by_status.setdefault(user_status, []).append(quest_id)
+        return queryset.annotate(
+            user_status=Case(
+                *(
+                    When(id__in=quest_ids, then=Value(user_status))
+                    for user_status, quest_ids in quests_by_status.items()
+                ),
+                default=Value('not_started'),
+                output_field=CharField()
+            )
+        )
 
     @action(detail=True, methods=['post'])
     def start_quest(self, request, pk=None):
@@ -134,22 +363,78 @@ class QuestViewSet(viewsets.ModelViewSet):
         quest = self.get_object()
         user = request.user
         
-        # Check if user already has progress for this quest
-        progress, created = UserQuestProgress.objects.get_or_create(
-            user=user,
-            quest=quest,
-            defaults={'status': 'in_progress', 'progress': 0}
-        )
-        
-        if not created and progress.status == 'abandoned':
-            progress.status = 'in_progress'
-            progress.save()
+        progress = UserQuestProgress.objects.for_user(user).filter(
+            quest=quest, status__in=['in_progress', 'completed']
+        ).first()
+        started = False
+        if progress is None:
+            # Log the start and project it right away for the response
+            events.append(ProgressEvent.QUEST_STARTED, quest.id, user_id=user.id)
+            progress, changed = events.project_stream(user.id, quest.id)
+            started = 'start_date' in changed
         
         serializer = UserQuestProgressSerializer(progress)
         return Response(serializer.data, 
-                      status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+                      status=status.HTTP_201_CREATED if started else status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """List active quests together with counts per type, difficulty and category"""
+        # Facet values may be repeated (?category=1&category=2) or comma separated
+        selected = {
+            field: [
+                value
+                for param in request.query_params.getlist(field)
+                for value in param.split(',') if value
+            ]
+            for field in FACET_FIELDS
+        }
+        # The facets select the quest type and difficulty themselves
+        self.filterset_fields = [field for field in self.filterset_fields if field not in FACET_FIELDS]
+        queryset = self.filter_queryset(self.get_queryset())
 
-class ChallengeViewSet(viewsets.ModelViewSet):
+        # Count within the other filters, if any; without them the index alone suffices
+        unfiltered = set(FACET_FIELDS) | {
+            self.paginator.page_query_param, filters.OrderingFilter.ordering_param,
+            api_settings.URL_FORMAT_OVERRIDE,
+        }
+        within = None
+        if any(param not in unfiltered for param in request.query_params):
+            within = queryset.values_list('id', flat=True)
+        quest_ids, counts = get_facet_index().query(selected, within)
+        queryset = queryset.filter(id__in=quest_ids)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+        else:
+            serializer = self.get_serializer(queryset, many=True)
+            response = Response({'results': serializer.data})
+
+        response.data['facets'] = counts
+        return response
+
+    @action(detail=False, methods=['get'])
+    def recommended(self, request):
+        """List the quests recommended for the current user, best first"""
+        try:
+            limit = min(int(request.query_params.get('limit', DEFAULT_TOP_N)), 100)
+        except ValueError:
+            return Response(
+                {"limit": ["A valid integer is required."]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        quest_ids = get_recommendations(request.user, top_n=max(limit, 1))
+        quests = Quest.objects.prefetch_related('challenges', 'categories').in_bulk(quest_ids)
+        serializer = self.get_serializer(
+            [quests[quest_id] for quest_id in quest_ids if quest_id in quests],
+            many=True
+        )
+        return Response(serializer.data)
+
+class ChallengeViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for managing challenges"""
     serializer_class = ChallengeSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -168,21 +453,15 @@ class ChallengeViewSet(viewsets.ModelViewSet):
         if quest_id:
             queryset = queryset.filter(quest_id=quest_id)
         
-        # Annotate with completion status if user is authenticated
-        if self.request.user.is_authenticated:
-            queryset = queryset.annotate(
-                is_completed=Case(
-                    When(completions__user=self.request.user, then=Value(True)),
-                    default=Value(False),
-                    output_field=BooleanField()
-                )
-            )
-        
+        # Completion flags are not annotated: completions live on the user's
+        # shard, so they could only be inlined as an id list, and the
+        # serializer does not output them
         return queryset
 
-class UserQuestProgressViewSet(viewsets.ModelViewSet):
+class UserQuestProgressViewSet(ReplicaReadMixin, ArchiveFallbackMixin, viewsets.ModelViewSet):
     """ViewSet for managing user quest progress"""
     serializer_class = UserQuestProgressSerializer
+    archive_model = ArchivedQuestProgress
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['quest', 'status']
@@ -193,19 +472,20 @@ class UserQuestProgressViewSet(viewsets.ModelViewSet):
         """Filter progress records for the current user"""
         if self.request.user.is_staff:
             return UserQuestProgress.objects.all()
-        return UserQuestProgress.objects.filter(user=self.request.user)
+        return UserQuestProgress.objects.for_user(self.request.user)
 
     def perform_create(self, serializer):
         """Set the user to the current user when creating a new progress record"""
         serializer.save(user=self.request.user)
 
-class UserChallengeCompletionViewSet(viewsets.ModelViewSet):
+class UserChallengeCompletionViewSet(ReplicaReadMixin, ArchiveFallbackMixin, viewsets.ModelViewSet):
     """ViewSet for managing user challenge completions"""
     serializer_class = UserChallengeCompletionSerializer
+    archive_model = ArchivedChallengeCompletion
     permission_classes = [permissions.IsAuthenticated]
-    parser_classes = [MultiPartParser, JSONParser]
-    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
-    filterset_fields = ['challenge', 'challenge__quest']
+    parser_classes = [MultiPartParser, ORJSONParser, MessagePackParser]
+    filter_backends = [DjangoFilterBackend, ChallengeQuestFilter, filters.OrderingFilter]
+    filterset_fields = ['challenge']
     ordering_fields = ['completed_at']
     ordering = ['-completed_at']
 
@@ -213,41 +493,16 @@ class UserChallengeCompletionViewSet(viewsets.ModelViewSet):
         """Filter completions for the current user"""
         if self.request.user.is_staff:
             return UserChallengeCompletion.objects.all()
-        return UserChallengeCompletion.objects.filter(user=self.request.user)
+        return UserChallengeCompletion.objects.for_user(self.request.user)
 
     def perform_create(self, serializer):
         """Set the user to the current user when creating a new completion"""
+        # Quest progress is recalculated by the post_save signal of the completion
         serializer.save(user=self.request.user)
-        
-        # Update quest progress
-        challenge = serializer.validated_data['challenge']
-        quest = challenge.quest
-        
-        # Get or create quest progress
-        progress, created = UserQuestProgress.objects.get_or_create(
-            user=self.request.user,
-            quest=quest,
-            defaults={'status': 'in_progress'}
-        )
-        
-        # Update progress percentage
-        total_challenges = quest.challenges.count()
-        completed_challenges = UserChallengeCompletion.objects.filter(
-            user=self.request.user,
-            challenge__quest=quest
-        ).values('challenge').distinct().count()
-        
-        progress.progress = int((completed_challenges / total_challenges) * 100)
-        
-        # Update status if completed
-        if progress.progress >= 100:
-            progress.status = 'completed'
-            progress.completion_date = timezone.now()
-        
-        progress.save()
 
-class PartnerOrganizationViewSet(viewsets.ModelViewSet):
+class PartnerOrganizationViewSet(ReferenceListMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for managing partner organizations"""
+    reference_set = 'partner_organizations'
     queryset = PartnerOrganization.objects.filter(is_active=True)
     serializer_class = PartnerOrganizationSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -256,14 +511,21 @@ class PartnerOrganizationViewSet(viewsets.ModelViewSet):
     ordering_fields = ['name', 'created_at']
     ordering = ['name']
 
-class PartnershipViewSet(viewsets.ReadOnlyModelViewSet):
+class PartnershipViewSet(CachedListMixin, ReferenceListMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for viewing partnerships"""
+    reference_set = 'current_partnerships'
     serializer_class = PartnershipSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, NearFilter]
     filterset_fields = ['organization', 'quest', 'is_featured']
     ordering_fields = ['start_date', 'end_date']
     ordering = ['-start_date']
+    near_field_prefix = 'organization__'
+
+    def list_cache_key(self, request):
+        # Retired with the cached current partnerships, and every day
+        version = refcache.reference_cache.versions()['current_partnerships']
+        return list_page_key('partnerships', request, version, timezone.now().date().isoformat())
 
     def get_queryset(self):
         """Filter active partnerships"""
@@ -279,3 +541,78 @@ class PartnershipViewSet(viewsets.ReadOnlyModelViewSet):
         )
         
         return queryset
+
+class LeaderboardViewSet(ReplicaReadMixin, viewsets.ViewSet):
+    """
+    ViewSet for XP leaderboards.
+
+    Every action accepts ``period`` (``all``, ``weekly`` or ``monthly``) and an
+    optional ``category`` id to select the board.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def _int_param(self, request, name, default, maximum=None):
+        try:
+            value = int(request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError({name: ["A valid integer is required."]})
+        if value < 0:
+            raise ValidationError({name: ["Must not be negative."]})
+        return min(value, maximum) if maximum is not None else value
+
+    def _board(self, request):
+        """Return the ``(period, category_id)`` selected by the query string"""
+        period = request.query_params.get('period', 'all')
+        if period not in leaderboards.PERIODS:
+            raise ValidationError(
+                {"period": [f"Must be one of: {', '.join(leaderboards.PERIODS)}."]}
+            )
+        category_id = request.query_params.get('category')
+        if category_id is not None:
+            category_id = self._int_param(request, 'category', None)
+        return period, category_id
+
+    def _with_users(self, entries):
+        """Attach usernames and levels to leaderboard entries in one query"""
+        users = User.objects.filter(
+            id__in=[entry['user_id'] for entry in entries]
+        ).only('id', 'username', 'level').in_bulk()
+        results = []
+        for entry in entries:
+            user = users.get(entry['user_id'])
+            if user is not None:
+                results.append({**entry, 'username': user.username, 'level': user.level})
+        return LeaderboardEntrySerializer(results, many=True).data
+
+    def list(self, request):
+        """Return a page of the leaderboard, best first"""
+        period, category_id = self._board(request)
+        offset = self._int_param(request, 'offset', 0)
+        limit = self._int_param(request, 'limit', 10, maximum=100)
+
+        def page():
+            entries, count = leaderboards.get_top(period, category_id, offset, limit)
+            return {'count': count, 'results': self._with_users(entries)}
+
+        key = f"leaderboard:{stampede.version('leaderboard')}:{period}:{category_id}:{offset}:{limit}"
+        return cache_variants(Response(stampede.fetch(key, page, LEADERBOARD_PAGE_TIMEOUT)))
+
+    @action(detail=False, methods=['get'])
+    def me(self, request):
+        """Return the current user's rank and score"""
+        period, category_id = self._board(request)
+        entry = leaderboards.get_rank(request.user.id, period, category_id)
+        if entry is None:
+            return Response(
+                {"detail": "You are not ranked on this leaderboard yet."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(self._with_users([entry])[0])
+
+    @action(detail=False, methods=['get'])
+    def around(self, request):
+        """Return the current user's position with their neighbours"""
+        period, category_id = self._board(request)
+        size = self._int_param(request, 'size', 5, maximum=50)
+        entries = leaderboards.get_around(request.user.id, period, category_id, size)
+        return Response({'results': self._with_users(entries)})
@@ -0,0 +1,159 @@
+"""
+Cache warm-up for new deployments.
+
+After a deploy the shared cache may be empty or hold entries of retired
+versions, and every process starts without its in-process indexes, so the
+first requests would all go to the database. ``warm`` precomputes what the
+hottest read paths serve: the reference sets, the first quest catalog pages,
+the partnership lists (all and featured), the top of every leaderboard, the
+quest facet index and the recommendation feature matrix.
+
+The ``warm_caches`` command runs it on deploy. With ``WARM_CACHES_ON_START``
+every web process also loads its own reference sets and indexes in the
+background when it starts (see ``warm_process_in_background``).
+
+Pages are rendered by their views, so they land in the cache under the keys
+real requests use. Those keys include the host the API is served from, taken
+from ``base_url``. Entries that are already cached are left as they are, so
+several instances warming at once compute each page once.
+"""
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections
+from rest_framework.settings import api_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from . import leaderboards, refcache
+from .facets import get_facet_index
+from .models import Category, Quest
+from .recommendations import get_feature_matrix
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_CATALOG_PAGES = 3
+
+
+def _page_warmer(viewset, actions, path, params, user, base_url):
+    """Return a warm-up task requesting ``path`` from ``viewset`` as ``user``"""
+    base = urlsplit(base_url)
+    factory = APIRequestFactory()
+
+    def warm():
+        request = factory.get(
+            path, params, HTTP_HOST=base.netloc, secure=base.scheme == 'https'
+        )
+        force_authenticate(request, user=user)
+        response = viewset.as_view(actions)(request)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path} answered {response.status_code}')
+        return response
+
+    return warm
+
+
+def page_tasks(user, base_url, catalog_pages=DEFAULT_CATALOG_PAGES):
+    """Return ``{name: task}`` rendering the cached list pages as ``user``"""
+    from .views import LeaderboardViewSet, PartnershipViewSet, QuestViewSet
+
+    tasks = {}
+    page_size = api_settings.PAGE_SIZE or Quest.objects.count() or 1
+    catalog_pages = min(catalog_pages, math.ceil(Quest.objects.count() / page_size))
+    for page in range(1, max(catalog_pages, 1) + 1):
+        # Clients ask for the first page without a page number
+        params = {'page': page} if page > 1 else {}
+        tasks[f'catalog page {page}'] = _page_warmer(
+            QuestViewSet, {'get': 'list'}, '/api/quests/', params, user, base_url
+        )
+    tasks['partnerships'] = _page_warmer(
+        PartnershipViewSet, {'get': 'list'}, '/api/partnerships/', {}, user, base_url
+    )
+    tasks['featured partnerships'] = _page_warmer(
+        PartnershipViewSet, {'get': 'list'}, '/api/partnerships/', {'is_featured': 'true'},
+        user, base_url
+    )
+    category_ids = [None, *Category.objects.values_list('id', flat=True)]
+    for period in leaderboards.PERIODS:
+        for category_id in category_ids:
+            params = {'period': period}
+            name = f'leaderboard {period}'
+            if category_id is not None:
+                params['category'] = category_id
+                name = f'{name} category {category_id}'
+            tasks[name] = _page_warmer(
+                LeaderboardViewSet, {'get': 'list'}, '/api/leaderboards/', params, user, base_url
+            )
+    return tasks
+
+
+def process_tasks():
+    """Return ``{name: task}`` loading the reference sets and this process's indexes"""
+    return {
+        'categories': refcache.categories,
+        'partner organizations': refcache.partner_organizations,
+        'current partnerships': refcache.current_partnerships,
+        'facet index': get_facet_index,
+        'feature matrix': get_feature_matrix,
+    }
+
+
+def warm_user():
+    """Return the user page requests authenticate as, or ``None`` without users"""
+    return User.objects.filter(is_active=True).order_by('-is_superuser', 'pk').first()
+
+
+def _run(name, task):
+    started = time.monotonic()
+    try:
+        task()
+        error = None
+    except Exception as e:
+        logger.warning(f"Warming {name} failed: {e}", exc_info=True)
+        error = str(e)
+    finally:
+        # Worker threads must not keep connections open once the pool is gone
+        connections.close_all()
+    return name, time.monotonic() - started, error
+
+
+def run_tasks(tasks, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Run ``{name: task}`` with at most ``concurrency`` at a time.
+
+    Returns ``(name, seconds, error)`` per task in the order given; ``error``
+    is ``None`` for tasks that succeeded. A failed task does not stop the others.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='warmup') as executor:
+        futures = [executor.submit(_run, name, task) for name, task in tasks.items()]
+        return [future.result() for future in futures]
+
+
+def warm(concurrency=DEFAULT_CONCURRENCY, catalog_pages=DEFAULT_CATALOG_PAGES, base_url=None):
+    """Warm the reference sets, indexes and cached pages; see ``run_tasks``"""
+    if base_url is None:
+        base_url = settings.SITE_URL
+    tasks = process_tasks()
+    user = warm_user()
+    if user is None:
+        logger.info("No active users; cached pages are not warmed.")
+    else:
+        tasks.update(page_tasks(user, base_url, catalog_pages))
+    return run_tasks(tasks, concurrency)
+
+
+def warm_process_in_background(concurrency=1):
+    """Run ``process_tasks`` in a daemon thread, so a new worker serves requests meanwhile"""
+    thread = threading.Thread(
+        target=run_tasks, args=(process_tasks(), concurrency), name='warmup', daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,344 @@
+"""
+Experience point awards and level computation.
+
+Every award is appended to the XP ledger first. The ledger's unique
+``(user, source_type, source_id)`` constraint makes awards idempotent, so code
+paths that both try to award the same quest are harmless. The user's total is
+then bumped with an atomic ``F()`` increment, so concurrent awards cannot lose
+updates, and the level is re-derived from a precomputed threshold table. The
+ledger lives on the user's shard; when that is not the shared database, the
+total is bumped after the ledger entry commits.
+
+With ``XP_WRITE_BEHIND`` enabled the increment is not applied to the ``User``
+row at award time. It is accumulated in a fast buffer (a Redis hash, or an
+in-process dict without Redis) and ``flush_pending_xp`` applies all pending
+deltas in batched updates, so bursts of completions by one user do not queue
+on that user's row lock.
+
+Once applied, every award is published to the user's live streams together
+with their new total (see ``api.live``).
+"""
+import bisect
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from . import leaderboards, live
+from .models import ExperienceFlushBatch, ExperienceLedgerEntry, User
+from .sharding import SHARED_DATABASE, shard_for_user
+from .stores import get_redis
+
+logger = logging.getLogger(__name__)
+
+MAX_LEVEL = 100
+
+# XP needed to reach each level: level ``n`` starts at LEVEL_THRESHOLDS[n - 1]
+LEVEL_THRESHOLDS = tuple(50 * level * (level - 1) for level in range(1, MAX_LEVEL + 1))
+
+PENDING_KEY = 'xp:pending'
+FLUSHING_SET_KEY = 'xp:flushing'
+FLUSH_BATCH_SIZE = 500
+FLUSH_HISTORY = timedelta(days=1)
+
+
+def level_for_xp(experience_points):
+    """Return the level reached with ``experience_points``"""
+    return bisect.bisect_right(LEVEL_THRESHOLDS, experience_points)
+
+
+def write_behind_enabled():
+    return getattr(settings, 'XP_WRITE_BEHIND', False)
+
+
+def _add_to_total(user_id, amount):
+    """Increment the user's XP and refresh their level"""
+    with transaction.atomic():
+        users = User.objects.filter(pk=user_id)
+        users.update(experience_points=F('experience_points') + amount)
+        # The row stays locked until commit, so this read sees our own increment
+        experience_points = users.values_list('experience_points', flat=True).get()
+        level = level_for_xp(experience_points)
+        users.exclude(level=level).update(level=level)
+
+
+def award_xp(user_id, amount, source_type, source_id, category_ids=()):
+    """
+    Award XP for a source at most once.
+
+    Returns ``True`` if the award was applied and ``False`` if this source had
+    already been awarded to the user.
+    """
+    shard = shard_for_user(user_id)
+    with transaction.atomic(using=shard):
+        try:
+            with transaction.atomic(using=shard):
+                ExperienceLedgerEntry.objects.using(shard).create(
+                    user_id=user_id,
+                    source_type=source_type,
+                    source_id=source_id,
+                    amount=amount,
+                )
+        except IntegrityError:
+            logger.debug(f"XP for {source_type} {source_id} already awarded to user {user_id}.")
+            return False
+
+        if write_behind_enabled():
+            transaction.on_commit(lambda: get_xp_buffer().add(user_id, amount), using=shard)
+        elif shard == SHARED_DATABASE:
+            _add_to_total(user_id, amount)
+        else:
+            # The total is on the shared database: bump it once the ledger entry
+            # is committed, so a failure in between loses XP rather than doubling it
+            transaction.on_commit(lambda: _add_to_total(user_id, amount), using=shard)
+
+    transaction.on_commit(lambda: leaderboards.record_xp(user_id, amount, category_ids), using=shard)
+    # Registered after the total is bumped, so the published total includes this award
+    transaction.on_commit(
+        lambda: publish_award(user_id, amount, source_type, source_id), using=shard, robust=True
+    )
+    return True
+
+
+def publish_award(user_id, amount, source_type, source_id):
+    """Push an award and the user's new total to their live streams"""
+    experience_points = User.objects.filter(pk=user_id).values_list('experience_points', flat=True).first()
+    if experience_points is None:
+        return
+    experience_points += pending_xp(user_id)
+    live.publish(user_id, live.message('xp', {
+        'amount': amount,
+        'source_type': source_type,
+        'source_id': source_id,
+        'experience_points': experience_points,
+        'level': level_for_xp(experience_points),
+    }))
+
+
+def award_quest_xp(user_id, quest):
+    """Award a completed quest's XP once"""
+    category_ids = list(quest.categories.values_list('id', flat=True))
+    return award_xp(user_id, quest.experience_reward, 'quest', quest.pk, category_ids)
+
+
+class LocalXPBuffer:
+    """In-process pending XP buffer used when Redis is not configured"""
+
+    def __init__(self):
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, amount):
+        with self._lock:
+            self._pending[user_id] = self._pending.get(user_id, 0) + amount
+
+    def pending(self, user_id):
+        """Return ``batch id -> delta`` for the user, ``None`` being the undrained delta"""
+        with self._lock:
+            pending = {
+                batch_id: batch[user_id]
+                for batch_id, batch in self._flushing.items() if user_id in batch
+            }
+            if user_id in self._pending:
+                pending[None] = self._pending[user_id]
+            return pending
+
+    def drain(self):
+        """Return ``(batch_id, deltas)`` pairs for every unacknowledged batch"""
+        with self._lock:
+            if self._pending:
+                self._flushing[uuid.uuid4().hex] = self._pending
+                self._pending = {}
+            return list(self._flushing.items())
+
+    def ack(self, batch_id):
+        with self._lock:
+            self._flushing.pop(batch_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._flushing.clear()
+
+
+class RedisXPBuffer:
+    """
+    Pending XP kept in a Redis hash of ``user id -> delta``.
+
+    Draining atomically renames the hash to a batch key registered in a set,
+    so awards keep accumulating in a fresh hash while the batch is applied and
+    a batch left behind by a crashed flush is picked up by the next one. Of
+    two concurrent drains only one renames the hash; the other finds it gone
+    and withdraws its batch key.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, user_id, amount):
+        self.client.hincrby(PENDING_KEY, user_id, amount)
+
+    def pending(self, user_id):
+        """Return ``batch id -> delta`` for the user, ``None`` being the undrained delta"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hget(PENDING_KEY, user_id)
+        pipe.smembers(FLUSHING_SET_KEY)
+        undrained, flushing = pipe.execute()
+        pending = {}
+        if flushing:
+            flushing = list(flushing)
+            pipe = self.client.pipeline(transaction=False)
+            for batch_key in flushing:
+                pipe.hget(batch_key, user_id)
+            pending = {
+                batch_key: int(value)
+                for batch_key, value in zip(flushing, pipe.execute()) if value is not None
+            }
+        if undrained is not None:
+            pending[None] = int(undrained)
+        return pending
+
+    def drain(self):
+        """Return ``(batch_id, deltas)`` pairs for every unacknowledged batch"""
+        if self.client.exists(PENDING_KEY):
+            batch_key = f'{PENDING_KEY}:{uuid.uuid4().hex}'
+            # Registered before the rename, so a flush that dies in between
+            # leaves an empty batch rather than an unregistered one
+            pipe = self.client.pipeline()
+            pipe.sadd(FLUSHING_SET_KEY, batch_key)
+            pipe.rename(PENDING_KEY, batch_key)
+            _, renamed = pipe.execute(raise_on_error=False)
+            if isinstance(renamed, Exception):
+                # "no such key": a concurrent drain renamed the hash after the
+                # EXISTS check
+                self.client.srem(FLUSHING_SET_KEY, batch_key)
+
+        batches = []
+        for batch_key in self.client.smembers(FLUSHING_SET_KEY):
+            deltas = {
+                int(user_id): int(amount)
+                for user_id, amount in self.client.hgetall(batch_key).items()
+            }
+            batches.append((batch_key, deltas))
+        return batches
+
+    def ack(self, batch_id):
+        pipe = self.client.pipeline()
+        pipe.srem(FLUSHING_SET_KEY, batch_id)
+        pipe.delete(batch_id)
+        pipe.execute()
+
+
+_local_buffer = LocalXPBuffer()
+
+
+def get_xp_buffer():
+    client = get_redis()
+    if client is None:
+        return _local_buffer
+    return RedisXPBuffer(client)
+
+
+def pending_xp(user_id):
+    """Return XP awarded to the user that has not been flushed yet"""
+    if not write_behind_enabled():
+        return 0
+    pending = get_xp_buffer().pending(user_id)
+    # A batch stays in the buffer from the moment it is applied until it is acknowledged
+    batch_ids = [batch_id for batch_id in pending if batch_id is not None]
+    if batch_ids:
+        for batch_id in ExperienceFlushBatch.objects.filter(
+            batch_id__in=batch_ids
+        ).values_list('batch_id', flat=True):
+            del pending[batch_id]
+    return sum(pending.values())
+
+
+def _apply_deltas(deltas, batch_size):
+    """Add XP deltas to user totals and refresh their levels in batched updates"""
+    user_ids = sorted(deltas)
+    for start in range(0, len(user_ids), batch_size):
+        chunk = user_ids[start:start + batch_size]
+        User.objects.filter(pk__in=chunk).update(
+            experience_points=F('experience_points') + Case(
+                *[When(pk=user_id, then=Value(deltas[user_id])) for user_id in chunk],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+        changed = [
+            User(pk=pk, level=level_for_xp(experience_points))
+            for pk, experience_points, level in User.objects.filter(
+                pk__in=chunk
+            ).values_list('pk', 'experience_points', 'level')
+            if level != level_for_xp(experience_points)
+        ]
+        if changed:
+            User.objects.bulk_update(changed, ['level'])
+
+
+def flush_pending_xp(batch_size=FLUSH_BATCH_SIZE):
+    """
+    Apply buffered XP to ``User.experience_points`` and ``level``.
+
+    Each drained batch is applied in one transaction that also records the
+    batch id, so a batch whose acknowledgement was lost is never applied twice.
+    Returns the number of users updated.
+    """
+    if not write_behind_enabled():
+        return 0
+    buffer = get_xp_buffer()
+    flushed = 0
+    for batch_id, deltas in buffer.drain():
+        if not ExperienceFlushBatch.objects.filter(batch_id=batch_id).exists():
+            with transaction.atomic():
+                ExperienceFlushBatch.objects.create(
+                    batch_id=batch_id,
+                    user_count=len(deltas),
+                    total_amount=sum(deltas.values()),
+                )
+                _apply_deltas(deltas, batch_size)
+            flushed += len(deltas)
+        buffer.ack(batch_id)
+
+    ExperienceFlushBatch.objects.filter(
+        flushed_at__lt=timezone.now() - FLUSH_HISTORY
+    ).delete()
+    if flushed:
+        logger.info(f"Flushed pending XP for {flushed} users.")
+    return flushed
+
+
+def recompute_levels(chunk_size=1000):
+    """
+    Re-derive ``User.level`` from ``experience_points`` for every user.
+
+    Users are walked in primary key order in chunks, and only rows whose level
+    is out of date are written back.
+    """
+    users = User.objects.order_by('pk').only('pk', 'experience_points', 'level')
+    updated = 0
+    last_pk = 0
+    while True:
+        chunk = list(users.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        changed = []
+        for user in chunk:
+            level = level_for_xp(user.experience_points)
+            if user.level != level:
+                user.level = level
+                changed.append(user)
+        if changed:
+            User.objects.bulk_update(changed, ['level'])
+        updated += len(changed)
+        last_pk = chunk[-1].pk
+
+    logger.info(f"Recomputed levels, {updated} users changed.")
+    return updated
@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
+import sys
 from pathlib import Path
 
 from django.core.asgi import get_asgi_application
@@ -9,8 +9,45 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.urls import reverse
+
+from config import db_pool
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+
+class LiveStreamASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, minus the thread per live stream.
+
+    Django gives every request a thread of its own for its sync code (signal
+    receivers, middleware, ORM calls) and keeps it until the response has been
+    sent, which for a live stream is as long as the client stays connected.
+    Live stream requests share one thread instead; their sync code is short
+    and done before the stream starts.
+    """
+    live_stream_path = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            if self.live_stream_path is None:
+                self.live_stream_path = reverse('live-stream')
+            if scope['path'] == self.live_stream_path:
+                return await self.handle(scope, receive, send)
+        return await super().__call__(scope, receive, send)
+
+
+django.setup(set_prefix=False)
+application = LiveStreamASGIHandler()
+
+# Size the database pools for a web process and export their metrics
+db_pool.configure('web')
+db_pool.register_metrics()
+
+# Load the reference data and indexes before the first requests need them
+if settings.WARM_CACHES_ON_START:
+    from api.warmup import warm_process_in_background
+    warm_process_in_background()
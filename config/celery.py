@@ -2,8 +2,11 @@ import os
 from datetime import timedelta
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import task_postrun, worker_init
 from django.conf import settings
 
+from . import db_pool
+
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
@@ -20,12 +23,40 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 app.conf.beat_schedule = {
     'update-quest-status': {
         'task': 'api.tasks.update_quest_status',
-        'schedule': timedelta(hours=1),  # Run every hour
+        'schedule': timedelta(hours=1),  # Catch up on events a failed request left unprojected
     },
     'send-daily-digest': {
         'task': 'api.tasks.send_daily_digest',
         'schedule': crontab(hour=8, minute=0),  # Run daily at 8 AM
     },
+    'relay-outbox': {
+        'task': 'api.tasks.relay_outbox',
+        'schedule': timedelta(seconds=5),  # Publish tasks queued by signals
+    },
+    'flush-pending-xp': {
+        'task': 'api.tasks.flush_pending_xp',
+        'schedule': timedelta(seconds=15),  # Only does work with XP_WRITE_BEHIND
+    },
+    'rebuild-leaderboards': {
+        'task': 'api.tasks.rebuild_leaderboards',
+        'schedule': timedelta(hours=6),  # Run every 6 hours
+    },
+    'precompute-recommendations': {
+        'task': 'api.tasks.precompute_recommendations',
+        'schedule': crontab(hour=4, minute=0),  # Run daily at 4 AM
+    },
+    'compact-counters': {
+        'task': 'api.tasks.compact_counters',
+        'schedule': crontab(hour=2, minute=30),  # Run daily at 2:30 AM
+    },
+    'archive-finished-progress': {
+        'task': 'api.tasks.archive_finished_progress',
+        'schedule': crontab(hour=3, minute=30),  # Run daily at 3:30 AM
+    },
+    'resume-stalled-erasures': {
+        'task': 'api.tasks.resume_stalled_erasures',
+        'schedule': timedelta(minutes=15),  # Requeue erasures whose worker died
+    },
     'cleanup-expired-sessions': {
         'task': 'django.contrib.sessions.clearsessions',
         'schedule': crontab(hour=3, minute=0),  # Run daily at 3 AM
@@ -51,6 +82,18 @@ app.conf.result_expires = timedelta(days=1)
 app.conf.broker_connection_retry_on_startup = True
 app.conf.broker_connection_max_retries = 10
 
+# Database pools are per process: size them for a worker, and close any the
+# parent opened so forked children do not share its connections
+@worker_init.connect
+def configure_worker_pools(**kwargs):
+    db_pool.configure('worker')
+    db_pool.close_pools()
+
+
+@task_postrun.connect
+def log_worker_pool_stats(**kwargs):
+    db_pool.log_pool_stats()
+
 # Add custom task error handling
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
@@ -0,0 +1,153 @@
+"""
+Database connection pooling.
+
+Production databases use psycopg's connection pool (Django's ``"pool"``
+database option) instead of one persistent connection per thread. Every
+process keeps between ``DB_POOL_MIN_SIZE`` and ``DB_POOL_MAX_SIZE``
+connections per database. A request waits at most ``DB_POOL_TIMEOUT`` seconds
+for one. Pooled databases set ``CONN_HEALTH_CHECKS``, which makes Django give
+the pool a check, so each connection is tested before it is handed out.
+Default sizes depend on the process role, which each entry point passes to
+``configure`` before the first connection is made:
+
+    web     config.wsgi / config.asgi   one request at a time per worker
+    worker  config.celery               one task at a time per child
+
+Raise ``DB_POOL_MAX_SIZE`` to the thread count when running threaded workers.
+
+Pool wait time and utilisation are exported by ``PoolCollector`` through the
+Prometheus ``/metrics`` endpoint of web processes. Celery children do not
+serve HTTP, so ``log_pool_stats`` writes the same figures to the log.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Role -> (min_size, max_size)
+POOL_SIZES = {
+    'web': (1, 4),
+    'worker': (1, 2),
+}
+POOL_LOG_INTERVAL = 60
+
+_last_logged = 0
+
+
+def pool_options(role='web'):
+    """Return the ``OPTIONS['pool']`` of a pooled database in a process of ``role``"""
+    min_size, max_size = POOL_SIZES[role]
+    min_size = int(os.getenv('DB_POOL_MIN_SIZE', min_size))
+    return {
+        'min_size': min_size,
+        'max_size': max(int(os.getenv('DB_POOL_MAX_SIZE', max_size)), min_size),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 1800)),
+    }
+
+
+def configure(role):
+    """Size the pools of every pooled database for a process of ``role``"""
+    from django.conf import settings
+
+    for database in settings.DATABASES.values():
+        options = database.get('OPTIONS', {}).get('pool')
+        if isinstance(options, dict):
+            options.update(pool_options(role))
+
+
+def open_pools():
+    """Return ``{alias: pool}`` for the pools this process has opened"""
+    from django.db import connections
+
+    pools = {}
+    for alias in connections:
+        # Reading ``connection.pool`` would open a pool that is not in use yet
+        pool = getattr(connections[alias], '_connection_pools', {}).get(alias)
+        if pool is not None:
+            pools[alias] = pool
+    return pools
+
+
+def pool_stats():
+    """Return ``{alias: stats}`` for the pools this process has opened"""
+    return {alias: pool.get_stats() for alias, pool in open_pools().items()}
+
+
+def close_pools():
+    """Close this process's pools, e.g. before forking children"""
+    from django.db import connections
+
+    for alias in open_pools():
+        connections[alias].close_pool()
+
+
+def log_pool_stats(force=False):
+    """Log pool figures at most once per ``POOL_LOG_INTERVAL`` seconds"""
+    global _last_logged
+    now = time.monotonic()
+    if not force and now - _last_logged < POOL_LOG_INTERVAL:
+        return
+    _last_logged = now
+    for alias, stats in pool_stats().items():
+        in_use = stats.get('pool_size', 0) - stats.get('pool_available', 0)
+        logger.info(
+            f"Database pool {alias}: {in_use}/{stats.get('pool_max', 0)} in use, "
+            f"{stats.get('requests_waiting', 0)} waiting, "
+            f"{stats.get('requests_wait_ms', 0)} ms waited over {stats.get('requests_num', 0)} requests, "
+            f"{stats.get('requests_errors', 0)} errors",
+            extra={'db_alias': alias, 'db_pool': stats},
+        )
+
+
+class PoolCollector:
+    """Prometheus collector reading the pool statistics at scrape time"""
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        size = GaugeMetricFamily('db_pool_size', 'Open pooled connections', labels=['alias'])
+        available = GaugeMetricFamily('db_pool_available', 'Idle pooled connections', labels=['alias'])
+        maximum = GaugeMetricFamily('db_pool_max_size', 'Maximum pool size', labels=['alias'])
+        utilisation = GaugeMetricFamily(
+            'db_pool_utilisation', 'Share of the maximum pool size checked out', labels=['alias']
+        )
+        waiting = GaugeMetricFamily(
+            'db_pool_requests_waiting', 'Requests waiting for a connection', labels=['alias']
+        )
+        requests = CounterMetricFamily('db_pool_requests', 'Connection requests', labels=['alias'])
+        wait = CounterMetricFamily(
+            'db_pool_wait_seconds', 'Time spent waiting for a connection', labels=['alias']
+        )
+        errors = CounterMetricFamily(
+            'db_pool_errors', 'Connection requests that failed or timed out', labels=['alias']
+        )
+        for alias, stats in pool_stats().items():
+            in_use = stats.get('pool_size', 0) - stats.get('pool_available', 0)
+            size.add_metric([alias], stats.get('pool_size', 0))
+            available.add_metric([alias], stats.get('pool_available', 0))
+            maximum.add_metric([alias], stats.get('pool_max', 0))
+            utilisation.add_metric([alias], in_use / max(stats.get('pool_max', 0), 1))
+            waiting.add_metric([alias], stats.get('requests_waiting', 0))
+            requests.add_metric([alias], stats.get('requests_num', 0))
+            wait.add_metric([alias], stats.get('requests_wait_ms', 0) / 1000)
+            errors.add_metric([alias], stats.get('requests_errors', 0))
+        return [size, available, maximum, utilisation, waiting, requests, wait, errors]
+
+
+_registered = False
+
+
+def register_metrics():
+    """Export pool metrics through prometheus_client, when it is installed"""
+    global _registered
+    try:
+        from prometheus_client import REGISTRY
+    except ImportError:
+        return False
+    if not _registered:
+        REGISTRY.register(PoolCollector())
+        _registered = True
+    return True
@@ -37,6 +37,10 @@ elif not SECRET_KEY:
     raise ValueError('SECRET_KEY environment variable is not set')
 
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
+
+# Scheme and host clients use to reach the API, for links in emails and the
+# absolute URLs of warmed pages
+SITE_URL = os.getenv('SITE_URL', 'http://localhost:8000').rstrip('/')
 CORS_ALLOW_ALL_ORIGINS = True
 
 # For production, you should specify allowed origins:
@@ -66,6 +70,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -105,6 +110,18 @@ DATABASES = {
     }
 }
 
+# Databases holding per-user progress data, in bucket order (see api.sharding).
+# Aliases other than 'default' need a DATABASES entry of their own.
+DATABASE_SHARDS = [
+    alias.strip() for alias in os.getenv('DATABASE_SHARDS', 'default').split(',') if alias.strip()
+]
+DATABASE_ROUTERS = ['api.sharding.ShardRouter', 'api.replicas.ReplicaRouter']
+
+# Read replicas of each primary alias (see api.replicas), and how long a user is
+# kept on the primary after a write; keep it above the worst replication lag.
+DATABASE_REPLICAS = {}
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -156,15 +173,30 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Custom user model
 AUTH_USER_MODEL = 'api.User'
 
+# Serve the hottest read endpoints with async views (see api.async_views);
+# meant for ASGI deployments (config.asgi under an ASGI server)
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False').strip().lower() in ('true', '1', 't', 'yes', 'y')
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.ORJSONParser',
+        'api.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
 }
@@ -173,6 +205,16 @@ REST_FRAMEWORK = {
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
+# Redis for leaderboards and other fast shared state.
+# Leave unset to use in-process fallbacks (single process only).
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Buffer XP awards and apply them to User rows in periodic batches
+XP_WRITE_BEHIND = os.getenv('XP_WRITE_BEHIND', 'False').strip().lower() in ('true', '1', 't', 'yes', 'y')
+
+# Move completed and abandoned quest progress to the archive tables after this many months
+PROGRESS_ARCHIVE_AFTER_MONTHS = int(os.getenv('PROGRESS_ARCHIVE_AFTER_MONTHS', 12))
+
 # JWT Settings
 from datetime import timedelta
 
@@ -180,3 +222,19 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
 }
+
+# Reference data cache (see api.refcache): entries kept in each process, and
+# how often a process looks for changes made by the others
+REFERENCE_CACHE_L1_SIZE = int(os.getenv('REFERENCE_CACHE_L1_SIZE', 256))
+REFERENCE_CACHE_VERSION_CHECK_SECONDS = float(os.getenv('REFERENCE_CACHE_VERSION_CHECK_SECONDS', 5))
+
+# Responses smaller than this many bytes are not compressed (see api.compression)
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+
+# Warm the caches when a container starts (docker-entrypoint.sh runs
+# warm_caches) and load each web process's indexes as it starts (see api.warmup)
+WARM_CACHES_ON_START = os.getenv('WARM_CACHES_ON_START', 'False').strip().lower() in ('true', '1', 't', 'yes', 'y')
+
+# How long each process trusts a user's cached active/staff flags when
+# authenticating tokens (see api.authentication)
+AUTH_USER_CACHE_SECONDS = int(os.getenv('AUTH_USER_CACHE_SECONDS', 30))
@@ -1,9 +1,12 @@
 from .base import *
+import importlib.util
 import os
 import dj_database_url
 import sentry_sdk
 from sentry_sdk.integrations.django import DjangoIntegration
 
+from config.db_pool import pool_options
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('SECRET_KEY')
 
@@ -24,14 +27,41 @@ SECURE_HSTS_PRELOAD = True
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 # Database
+# Connections come from a per-process pool (see config.db_pool), which
+# replaces persistent connections
+def pooled(database):
+    database['CONN_MAX_AGE'] = 0
+    # Django then passes the pool a check, so it hands out only connections that still answer
+    database['CONN_HEALTH_CHECKS'] = True
+    database.setdefault('OPTIONS', {})['pool'] = pool_options()
+    return database
+
+
 DATABASES = {
-    'default': dj_database_url.config(
-        default=os.getenv('DATABASE_URL'),
-        conn_max_age=600,
-        conn_health_checks=True,
-    )
+    'default': pooled(dj_database_url.config(default=os.getenv('DATABASE_URL')))
 }
 
+# Each additional shard is configured with DATABASE_URL_<ALIAS>
+for alias in DATABASE_SHARDS:
+    if alias not in DATABASES:
+        DATABASES[alias] = pooled(dj_database_url.config(env=f'DATABASE_URL_{alias.upper()}'))
+
+# Read replicas of each primary are listed, space separated, in
+# DATABASE_REPLICA_URLS_<ALIAS>
+DATABASE_REPLICAS = {}
+for alias in list(DATABASES):
+    urls = os.getenv(f'DATABASE_REPLICA_URLS_{alias.upper()}', '').split()
+    for number, url in enumerate(urls, start=1):
+        replica = f'{alias}_replica{number}'
+        DATABASES[replica] = pooled(dj_database_url.parse(url))
+        DATABASES[replica]['TEST'] = {'MIRROR': alias}
+        DATABASE_REPLICAS.setdefault(alias, []).append(replica)
+
+# Prometheus /metrics, including the database pool figures (see config.db_pool).
+# Like the collectors, it is only enabled when the package is installed.
+if importlib.util.find_spec('django_prometheus') is not None:
+    INSTALLED_APPS = INSTALLED_APPS + ['django_prometheus']
+
 # Media files (S3)
 DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
@@ -122,6 +152,9 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# Redis
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/1')
+
 # Security middleware
 SECURE_REFERRER_POLICY = 'same-origin'
 SECURE_CROSS_ORIGIN_OPENER_POLICY = 'same-origin-allow-popups'
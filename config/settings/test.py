@@ -1,3 +1,6 @@
+import os
+
+from .base import *  # noqa: F401, F403
 from .development import *  # noqa: F401, F403
 
 # Use a faster password hasher for testing
@@ -10,7 +13,22 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
-    }
+    },
+    # Never receives the primary's writes, so it acts as a lagging replica in
+    # tests that enable it through DATABASE_REPLICAS
+    'default_replica1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    # Shards for tests that enable them through DATABASE_SHARDS
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 # Disable password validation during testing
@@ -28,6 +46,13 @@ CACHES = {
     }
 }
 
+# Use in-process fallbacks instead of Redis
+REDIS_URL = None
+
+# Publish tasks to an in-memory broker; the outbox relay can be run directly
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+
 # Use faster JWT settings for tests
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=5),
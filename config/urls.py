@@ -26,14 +26,15 @@ urlpatterns = [
     # API endpoints
     path('api/', include('api.urls')),
     
-    # JWT Authentication
-    path('auth/', include('rest_framework_simplejwt.urls')),
-    
     # REST Framework auth endpoints
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('admin/', admin.site.urls),
 ]
 
+# Prometheus metrics
+if 'django_prometheus' in settings.INSTALLED_APPS:
+    urlpatterns += [path('', include('django_prometheus.urls'))]
+
 # Serve media files in development
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
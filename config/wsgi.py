@@ -9,8 +9,20 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
+from config import db_pool
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Size the database pools for a web process and export their metrics
+db_pool.configure('web')
+db_pool.register_metrics()
+
+# Load the reference data and indexes before the first requests need them
+if settings.WARM_CACHES_ON_START:
+    from api.warmup import warm_process_in_background
+    warm_process_in_background()
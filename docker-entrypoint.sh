@@ -36,5 +36,14 @@ EOF
 echo "Seeding database..."
 python manage.py seed_data
 
+# Precompute cached pages so the new instance takes traffic warm; a failure
+# only costs a cold start
+case "$(echo "${WARM_CACHES_ON_START:-False}" | tr '[:upper:]' '[:lower:]')" in
+    true|1|t|yes|y)
+        echo "Warming caches..."
+        python manage.py warm_caches ${SITE_URL:+--base-url "$SITE_URL"} || echo "Cache warm-up failed; starting cold"
+        ;;
+esac
+
 # Start the application
 exec "$@"
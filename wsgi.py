@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
 import os
+import sys
 from pathlib import Path
 
 from django.core.wsgi import get_wsgi_application